@@ -1,16 +1,22 @@
 import asyncio
+import multiprocessing
 import signal
 from multiprocessing import freeze_support
 
 from .config import Config
 from .db import Db
+from .files import remove_orphaned_origs
+from .image_codec import benchmark, print_benchmark
 from .server import app
-from .tasks import drink_detection
+from .tasks import drink_detection, similarity, workers
 
 
 def capture():
     print("Starting in capture mode")
-    drink_detection.drink_detection(app.config)
+    load_config()
+    # runs outside the server, which picks up its captures by watching
+    # the database instead of being notified
+    drink_detection.drink_detection(app.config, multiprocessing.Event())
 
 
 def _sig_handler(*_: any) -> None:
@@ -23,9 +29,35 @@ def _sig_handler(*_: any) -> None:
 
 def init_db():
     app.config.from_object(Config)
-    db = Db(app.config["DB"])
+    db = Db.from_config(app.config)
     db._init_db_()
 
+
+def bench_codecs():
+    """Compares image storage formats on the latest captures, see IMG_FORMAT"""
+    load_config()
+    print_benchmark(benchmark(app.config))
+
+
+def embed_captures():
+    """Embeds originals captured before embeddings were kept, see EMBEDDINGS_DIR"""
+    load_config()
+    similarity.embed_stored_files(app.config)
+
+
+def prune_origs():
+    """Removes stored originals no capture refers to, such as those of failed uploads"""
+    load_config()
+    removed = remove_orphaned_origs(app.config, Db.from_config(app.config))
+    print(f"Removed {removed} unused originals")
+
+
+def worker():
+    """Runs inference jobs for a server with WORKER_LISTEN set"""
+    load_config()
+    workers.serve_worker(app.config)
+
+
 def load_config() -> None:
     app.config.from_object(Config())
     Config.setup()
@@ -0,0 +1,170 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from .db import (
+    PAGINATION_SIZE,
+    CaptureCreatedBy,
+    CaptureCursor,
+    CaptureRow,
+    CaptureType,
+    ConnectionPool,
+    Db,
+    JobRow,
+    JobState,
+    UnitOfWork,
+)
+
+READER_THREADS = 4
+
+
+class AsyncDb:
+    """
+    Awaitable facade over Db for use on the event loop. Reads run on a pool
+    of reader threads and writes on a single writer thread, each thread
+    holding its own pooled connection, so a query waiting on the SQLite
+    lock no longer stalls every other request and SSE stream.
+    """
+
+    def __init__(self, pool: ConnectionPool, readers: int = READER_THREADS):
+        self.pool = pool
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.dbs: list[Db] = []
+        self.read_executor = ThreadPoolExecutor(readers, thread_name_prefix="db-read")
+        self.write_executor = ThreadPoolExecutor(1, thread_name_prefix="db-write")
+        # always the same thread, so always the same connection, which
+        # PRAGMA data_version needs to be meaningful
+        self.watch_executor = ThreadPoolExecutor(1, thread_name_prefix="db-watch")
+
+    def _thread_db(self) -> Db:
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = self.pool.acquire()
+            self.local.db = db
+            with self.lock:
+                self.dbs.append(db)
+        return db
+
+    def _call(self, method: str, *args, **kwargs):
+        return getattr(self._thread_db(), method)(*args, **kwargs)
+
+    async def _run(self, executor: ThreadPoolExecutor, method: str, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(
+            executor, partial(self._call, method, *args, **kwargs)
+        )
+
+    async def _read(self, method: str, *args, **kwargs):
+        return await self._run(self.read_executor, method, *args, **kwargs)
+
+    async def _write(self, method: str, *args, **kwargs):
+        return await self._run(self.write_executor, method, *args, **kwargs)
+
+    def close(self) -> None:
+        for executor in [self.read_executor, self.write_executor, self.watch_executor]:
+            executor.shutdown(wait=True)
+        with self.lock:
+            dbs, self.dbs = self.dbs, []
+        for db in dbs:
+            db.close()
+
+    async def data_version(self) -> int:
+        return await self._run(self.watch_executor, "data_version")
+
+    async def fetch_last_result_id(self) -> int | None:
+        return await self._read("fetch_last_result_id")
+
+    async def migrate(self) -> int:
+        return await self._write("migrate")
+
+    async def fetch_captures(
+        self,
+        limit: int = PAGINATION_SIZE,
+        cap_type: list[CaptureCreatedBy] | None = None,
+        after: CaptureCursor | None = None,
+        since: float | None = None,
+        until: float | None = None,
+    ) -> list[CaptureRow]:
+        return await self._read("fetch_captures", limit, cap_type, after, since, until)
+
+    async def fetch_latest_capture(
+        self, cap_type: list[CaptureCreatedBy] | None = None
+    ) -> CaptureRow | None:
+        return await self._read("fetch_latest_capture", cap_type)
+
+    async def fetch_image_name(self, file_id: int) -> str | None:
+        return await self._read("fetch_image_name", file_id)
+
+    async def fetch_image_for_capture(
+        self, capture_id: int, type: CaptureType, ind: int
+    ) -> str | None:
+        return await self._read("fetch_image_for_capture", capture_id, type, ind)
+
+    async def fetch_result(self, capture_id: int) -> object | None:
+        return await self._read("fetch_result", capture_id)
+
+    async def claim_jobs(
+        self, owner: str, lease: float, batch_sizes: dict[str, int]
+    ) -> list[JobRow]:
+        return await self._write("claim_jobs", owner, lease, batch_sizes)
+
+    async def fetch_next_job_at(self, kinds: list[str]) -> float | None:
+        return await self._read("fetch_next_job_at", kinds)
+
+    async def extend_job_leases(
+        self, job_ids: list[int], owner: str, lease: float
+    ) -> None:
+        return await self._write("extend_job_leases", job_ids, owner, lease)
+
+    async def complete_job(self, job_id: int, owner: str) -> None:
+        return await self._write("complete_job", job_id, owner)
+
+    async def fail_job(
+        self, job_id: int, owner: str, error: str, retry_delay: float
+    ) -> JobState | None:
+        return await self._write("fail_job", job_id, owner, error, retry_delay)
+
+    async def fetch_job_depth(self) -> int:
+        return await self._read("fetch_job_depth")
+
+    async def fetch_job_counts(self) -> dict[str, int]:
+        return await self._read("fetch_job_counts")
+
+    async def prune_jobs(self, before: float) -> int:
+        return await self._write("prune_jobs", before)
+
+    async def fetch_file_hashes(self, file_ids: list[int]) -> dict[int, str | None]:
+        return await self._read("fetch_file_hashes", file_ids)
+
+    async def fetch_cached_result(
+        self, sha256: str, model: str, query: str
+    ) -> object | None:
+        return await self._read("fetch_cached_result", sha256, model, query)
+
+    async def fetch_file_id_for_capture(
+        self, capture_id: int, type: CaptureType, ind: int
+    ) -> int | None:
+        return await self._read("fetch_file_id_for_capture", capture_id, type, ind)
+
+    async def fetch_captures_for_files(
+        self, file_ids: list[int]
+    ) -> dict[int, list[tuple[int, int]]]:
+        return await self._read("fetch_captures_for_files", file_ids)
+
+    async def fetch_stock_counts(
+        self, cap_type: list[CaptureCreatedBy] | None = None
+    ) -> dict[str, int] | None:
+        return await self._read("fetch_stock_counts", cap_type)
+
+    async def fetch_stock_series(
+        self, resolution: int, since: float, until: float
+    ) -> list[dict]:
+        return await self._read("fetch_stock_series", resolution, since, until)
+
+    def unit_of_work(self, capture_id: int | None = None) -> UnitOfWork:
+        """Starts collecting writes for a capture, to be passed to commit_unit"""
+        return UnitOfWork(None, capture_id)
+
+    async def commit_unit(self, uow: UnitOfWork) -> int:
+        return await self._write("commit_unit", uow)
@@ -1,14 +1,21 @@
 import asyncio
+import collections
+import queue
+from collections.abc import AsyncGenerator
 from dataclasses import dataclass
 from functools import partial
-from typing import AsyncGenerator, Optional
 from uuid import UUID
 
 from quart import Request, abort, make_response, request
 
-from .db import Db
+from .snapshot import SnapshotCache
 
 UPDATE_RATE = 10
+# how often forward_notifications checks for shutdown while idle
+NOTIFY_POLL_INTERVAL = 1
+# events buffered per feed connection before the overflow policy kicks in
+SSE_BUFFER_SIZE = 16
+SSE_OVERFLOW_POLICY = "drop_oldest"
 
 
 @dataclass
@@ -30,64 +37,202 @@ class ServerSentEvent:
         return message
 
 
+class Subscription:
+    """
+    A bounded buffer of encoded events for one SSE connection. Publishing
+    never waits on it: once size events are pending, "drop_oldest" throws
+    away the oldest one, while "coalesce" first replaces a pending event of
+    the same type, since only the newest capture is worth showing.
+    """
+
+    def __init__(self, uuid: UUID | None, size: int, policy: str) -> None:
+        self.uuid = uuid
+        self.size = size
+        self.policy = policy
+        self.pending: collections.deque[tuple[str | None, str]] = collections.deque()
+        self.waiter: asyncio.Future | None = None
+        self.closed = False
+        self.dropped = 0
+
+    def push(self, event: str | None, message: str) -> int:
+        """Queues message, returning how many pending ones it pushed out"""
+        dropped = 0
+        if self.policy == "coalesce":
+            for pending in self.pending:
+                if pending[0] == event:
+                    self.pending.remove(pending)
+                    dropped += 1
+                    break
+        while len(self.pending) >= self.size:
+            self.pending.popleft()
+            dropped += 1
+        self.pending.append((event, message))
+        self.dropped += dropped
+        self.wake()
+        return dropped
+
+    def wake(self) -> None:
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def drain(self) -> str | None:
+        """Waits for pending events and returns them all at once, or None once closed"""
+        while len(self.pending) == 0:
+            if self.closed:
+                return None
+            self.waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self.waiter
+            finally:
+                self.waiter = None
+        messages = "".join(message for _, message in self.pending)
+        self.pending.clear()
+        return messages
+
+    def close(self) -> None:
+        self.closed = True
+        self.wake()
+
+
 class FeedBroker:
-    def __init__(self) -> None:
-        self.connections: dict[asyncio.Queue[ServerSentEvent], Optional[UUID]] = dict()
+    def __init__(
+        self, buffer_size: int = SSE_BUFFER_SIZE, policy: str = SSE_OVERFLOW_POLICY
+    ) -> None:
+        if policy not in ("drop_oldest", "coalesce"):
+            raise ValueError(f"Unknown SSE overflow policy {policy}")
+        self.buffer_size = buffer_size
+        self.policy = policy
+        self.connections: set[Subscription] = set()
+        self.by_uuid: dict[UUID, set[Subscription]] = dict()
+        self.dropped = 0
+        self.closed = False
 
-    async def publish(self, event: ServerSentEvent, target: Optional[UUID] = None) -> None:
-        for conn, uuid in self.connections.items():
-            if target is None or uuid == target:
-                await conn.put(event.encode())
+    def publish(self, event: ServerSentEvent, target: UUID | None = None) -> None:
+        """Encodes event once and queues it for every subscriber, or those of target"""
+        message = event.encode()
+        conns = self.connections if target is None else self.by_uuid.get(target, ())
+        for conn in conns:
+            self.dropped += conn.push(event.event, message)
 
-    def subscribe(self, uuid: Optional[UUID] = None) -> asyncio.Queue:
-        conn = asyncio.Queue()
-        self.connections[conn] = uuid
+    def subscribe(self, uuid: UUID | None = None) -> Subscription:
+        conn = Subscription(uuid, self.buffer_size, self.policy)
+        if self.closed:
+            conn.close()
+        self.connections.add(conn)
+        if uuid is not None:
+            self.by_uuid.setdefault(uuid, set()).add(conn)
         return conn
 
-    def unsubscribe(self, conn: asyncio.Queue) -> None:
+    def unsubscribe(self, conn: Subscription) -> None:
         try:
-            del self.connections[conn]
+            self.connections.remove(conn)
         except KeyError as err:
-            raise Exception("Tried unsubscribing with unknown queue!") from err
+            raise Exception("Tried unsubscribing with unknown subscription!") from err
+        if conn.uuid is not None:
+            by_uuid = self.by_uuid[conn.uuid]
+            by_uuid.discard(conn)
+            if len(by_uuid) == 0:
+                del self.by_uuid[conn.uuid]
+
+    def close(self) -> None:
+        """Ends every feed, including ones subscribing from now on"""
+        self.closed = True
+        for conn in self.connections:
+            conn.close()
+
+    def stats(self) -> dict:
+        return {
+            "subscribers": len(self.connections),
+            "dropped": self.dropped,
+        }
+
+
+async def close_on_shutdown(broker: FeedBroker, feed_shutdown_event: asyncio.Event):
+    """Closes broker once feed_shutdown_event is set, so open feeds end"""
+    await feed_shutdown_event.wait()
+    broker.close()
+
+
+async def forward_notifications(
+    notify_queue: queue.Queue,
+    feed_shutdown_event: asyncio.Event,
+    update_now_event: asyncio.Event,
+    poll_interval: float = NOTIFY_POLL_INTERVAL,
+):
+    """Wakes update_check for every capture completed in another process"""
+    while not feed_shutdown_event.is_set():
+        try:
+            capture_id = await asyncio.to_thread(notify_queue.get, True, poll_interval)
+        except queue.Empty:
+            continue
+        print(f"Notified of capture {capture_id}")
+        update_now_event.set()
+    print("Notification forwarder stopping")
 
 
 async def update_check(
-    db_url: str,
+    snapshot: SnapshotCache,
     broker: FeedBroker,
     feed_shutdown_event: asyncio.Event,
     update_now_event: asyncio.Event,
     update_rate=UPDATE_RATE,
 ):
+    """
+    Publishes the latest capture whenever update_now_event is set. Every
+    update_rate seconds it also checks the database's data_version, which
+    is cheap, to catch captures from processes that can't notify us. Job
+    leases and heartbeats change that too, so it only counts as an update
+    once the latest capture result changed as well. Any update invalidates
+    snapshot, and the reloaded one is what gets sent, so each new capture
+    is read once however many clients are watching.
+    """
+    db = snapshot.db
     most_recent: int
-    db = Db(db_url)
+    last_result_id: int | None
     shutdown_wait_task = asyncio.create_task(feed_shutdown_event.wait())
     update_now_task = asyncio.create_task(update_now_event.wait())
 
     try:
-        row = db.fetch_latest_capture()
+        row = (await snapshot.get()).capture
         most_recent = row.created_at if row is not None else 0
+        data_version = await db.data_version()
+        last_result_id = await db.fetch_last_result_id()
 
         while True:
-            print("Checking for feed updates...")
-            row = db.fetch_latest_capture()
-            if row is not None:
-                if row.created_at > most_recent:
-                    print("Update found, publishing")
-                    await broker.publish(ServerSentEvent(row.created_at))
-                most_recent = row.created_at
             await asyncio.wait(
                 (shutdown_wait_task, update_now_task),
                 timeout=update_rate,
                 return_when=asyncio.FIRST_COMPLETED,
             )
+            if feed_shutdown_event.is_set():
+                break
+            changed = False
             if update_now_event.is_set():
                 update_now_event.clear()
                 update_now_task = asyncio.create_task(update_now_event.wait())
-            if feed_shutdown_event.is_set():
-                break
+                changed = True
+            new_data_version = await db.data_version()
+            if new_data_version != data_version:
+                data_version = new_data_version
+                new_result_id = await db.fetch_last_result_id()
+                changed = changed or new_result_id != last_result_id
+                last_result_id = new_result_id
+            if not changed:
+                continue
+            snapshot.invalidate()
+
+            print("Checking for feed updates...")
+            latest = await snapshot.get()
+            row = latest.capture
+            if row is not None:
+                if row.created_at > most_recent:
+                    print("Update found, publishing")
+                    broker.publish(ServerSentEvent(latest.payload))
+                most_recent = row.created_at
     finally:
         print("Update checker stopping")
-        db.close()
+        shutdown_wait_task.cancel()
+        update_now_task.cancel()
 
 
 async def return_sse(gen: AsyncGenerator[str, None]) -> Request:
@@ -105,40 +250,21 @@ async def return_sse(gen: AsyncGenerator[str, None]) -> Request:
     return res
 
 
-async def _send_feed_updates(
-    broker: FeedBroker, feed_shutdown_event: asyncio.Event, uuid: Optional[UUID] = None
-):
+async def _send_feed_updates(broker: FeedBroker, uuid: UUID | None = None):
     print(f"Subscribing to feed{f' ({uuid})' if uuid is not None else ''}")
     subscription = broker.subscribe(uuid)
-    subscription_task: asyncio.Task
-    cancel_event_task: asyncio.Task
     try:
         while True:
-            subscription_task = asyncio.create_task(subscription.get())
-            cancel_event_task = asyncio.create_task(feed_shutdown_event.wait())
-            done, pending = await asyncio.wait(
-                (subscription_task, cancel_event_task),
-                return_when=asyncio.FIRST_COMPLETED,
-            )
-            for task in pending:
-                task.cancel()
-            if feed_shutdown_event.is_set():
+            messages = await subscription.drain()
+            if messages is None:
                 print("Stopping feed due to shutdown")
                 return
-            for task in done:
-                if task is subscription_task:
-                    print("Sending feed update")
-                    event = ServerSentEvent(await task)
-                    yield event.encode()
+            yield messages
     except asyncio.CancelledError:
         print("Feed connection closed")
     finally:
         broker.unsubscribe(subscription)
-        subscription_task.cancel()
-        cancel_event_task.cancel()
 
 
-def send_feed_updates(
-    broker: FeedBroker, feed_shutdown_event: asyncio.Event, uuid: Optional[UUID] = None
-):
-    return return_sse(partial(_send_feed_updates, broker, feed_shutdown_event, uuid))
+def send_feed_updates(broker: FeedBroker, uuid: UUID | None = None):
+    return return_sse(partial(_send_feed_updates, broker, uuid))
@@ -5,15 +5,50 @@ from dataclasses import InitVar, dataclass, field
 from dotenv import dotenv_values
 from jsonschema import validate
 
-env = dotenv_values(".env")
+# settings from .env, any of which can be overridden from the environment
+env = {**dotenv_values(".env"), **os.environ}
 
 
 @dataclass
 class Config:
     DB = env.get("DRINKS_DB", "drinks.db")
+    # SQLite connection settings, see db.DEFAULT_PRAGMAS
+    DB_JOURNAL_MODE = env.get("DRINKS_DB_JOURNAL_MODE", "WAL")
+    DB_SYNCHRONOUS = env.get("DRINKS_DB_SYNCHRONOUS", "NORMAL")
+    DB_MMAP_SIZE = int(env.get("DRINKS_DB_MMAP_SIZE", 256 * 1024 * 1024))
+    DB_CACHE_SIZE = int(env.get("DRINKS_DB_CACHE_SIZE", -64 * 1024))
+    DB_BUSY_TIMEOUT = int(env.get("DRINKS_DB_BUSY_TIMEOUT", 5000))
+    # idle connections the server keeps open between requests
+    DB_POOL_SIZE = int(env.get("DRINKS_DB_POOL_SIZE", 8))
+    # threads the server runs database reads on, writes always get one thread
+    DB_READER_THREADS = int(env.get("DRINKS_DB_READER_THREADS", 4))
     IMAGE_OUT = env.get("DRINKS_IMAGE_OUT", "drinks_out")
     CAPTURE_DEVICE = int(env.get("DRINKS_CAPTURE_DEVICE", "0"))
     RATE = int(env.get("DRINKS_CAPTURE_RATE", 60))
+    # the capture loop runs as a pipeline of capture, inference, file storage
+    # and database stages, with queues of at most CAPTURE_QUEUE_DEPTH frames
+    # between them. CAPTURE_DROP_POLICY decides what happens to a frame when
+    # the next queue is full: "block" waits for room, "drop_oldest" throws
+    # away the oldest queued frame, "drop_newest" throws away the new one.
+    # Stored frames always wait for the database, so no files are orphaned
+    CAPTURE_QUEUE_DEPTH = int(env.get("DRINKS_CAPTURE_QUEUE_DEPTH", 2))
+    CAPTURE_DROP_POLICY = env.get("DRINKS_CAPTURE_DROP_POLICY", "block")
+    # each /feed/sse connection buffers at most SSE_BUFFER_SIZE events, a
+    # slow client then loses the oldest ones ("drop_oldest") or has older
+    # events of the same type replaced by the newest ("coalesce")
+    SSE_BUFFER_SIZE = int(env.get("DRINKS_SSE_BUFFER_SIZE", 16))
+    SSE_OVERFLOW_POLICY = env.get("DRINKS_SSE_OVERFLOW_POLICY", "coalesce")
+    # frames differing from the last processed one by less than this mean
+    # pixel difference (0-255, on a small grayscale copy) reuse its detection
+    # result instead of running the model, 0 processes every frame. The
+    # capture loop logs how many frames it skipped and the differences it
+    # saw every few minutes, to tune this by
+    CHANGE_THRESHOLD = float(env.get("DRINKS_CHANGE_THRESHOLD", 0))
+    # also link the last stored original to unchanged frames instead of
+    # storing a new one
+    SKIP_UNCHANGED_ORIG = (
+        env.get("DRINKS_SKIP_UNCHANGED_ORIG", "false").lower() == "true"
+    )
     # QUERY = env.get("DRINKS_QUERY", "a can:azure,a bottle:fuchsia,a juice box:tomato")
     # QUERY_ITEMS: dict[str, str] = field(init=False)
     STOCK_TYPES_FILE = env.get("DRINKS_STOCK_TYPES_FILE", "stock_types.json")
@@ -24,15 +59,12 @@ class Config:
         "items": {
             "type": "object",
             "properties": {
-                "name": { "type": "string" },
-                "query": { "type": "string" },
-                "color": { "type": "string" },
-                "categories": {
-                    "type": "array",
-                    "items": { "type": "string" }
-                }
-            }
-        }
+                "name": {"type": "string"},
+                "query": {"type": "string"},
+                "color": {"type": "string"},
+                "categories": {"type": "array", "items": {"type": "string"}},
+            },
+        },
     }
     OTHER_COLOR = env.get("DRINKS_OTHER_COLOR", "chocolate")
     OBJ_DET_MODEL = env.get("DRINKS_OBJ_DET_MODEL", "IDEA-Research/grounding-dino-base")
@@ -42,6 +74,86 @@ class Config:
     OUT_DIR = os.path.join(os.getcwd(), IMAGE_OUT)
     ORIG_DIR = os.path.join(OUT_DIR, "orig")
     ANNO_DIR = os.path.join(OUT_DIR, "anno")
+    # how captured and annotated images are stored: "png" at compress level
+    # IMG_COMPRESS_LEVEL (0-9, higher is smaller but slower), "jpeg" or
+    # "webp" at IMG_QUALITY, or "webp_lossless" trying IMG_QUALITY hard to
+    # compress. IMG_WEBP_METHOD trades WebP encoding speed (0) for size (6).
+    # Uploaded originals are always kept as they were sent.
+    # `poetry run bench_codecs` compares them on the latest captures
+    IMG_FORMAT = env.get("DRINKS_IMG_FORMAT", "png")
+    IMG_COMPRESS_LEVEL = int(env.get("DRINKS_IMG_COMPRESS_LEVEL", 1))
+    IMG_QUALITY = int(env.get("DRINKS_IMG_QUALITY", 90))
+    IMG_WEBP_METHOD = int(env.get("DRINKS_IMG_WEBP_METHOD", 4))
+    # largest image in megabytes a request can upload, and most images a
+    # similarity request can compare, uploaded or from earlier captures.
+    # Quart's limit on the whole request body leaves room for all of them
+    UPLOAD_MAX_SIZE = int(env.get("DRINKS_UPLOAD_MAX_SIZE", 32))
+    SIMILARITY_MAX_IMAGES = int(env.get("DRINKS_SIMILARITY_MAX_IMAGES", 50))
+    MAX_CONTENT_LENGTH = (SIMILARITY_MAX_IMAGES * UPLOAD_MAX_SIZE + 1) * 1024 * 1024
+    # whether annotated copies of every capture are written to ANNO_DIR. The
+    # pages draw the boxes over the original themselves, so this is only
+    # needed for the ?annotated image URLs, which otherwise render one on
+    # first use and keep it
+    STORE_ANNOTATED = env.get("DRINKS_STORE_ANNOTATED", "true").lower() == "true"
+    # resized copies of images served for /image?w=, generated on first use.
+    # Requested widths are rounded up to one of THUMB_WIDTHS, and the least
+    # recently used thumbnails are deleted once they take up more than
+    # THUMB_CACHE_SIZE megabytes
+    THUMB_DIR = os.path.join(OUT_DIR, "thumb")
+    THUMB_WIDTHS = [
+        int(w) for w in env.get("DRINKS_THUMB_WIDTHS", "160,320,640").split(",")
+    ]
+    THUMB_CACHE_SIZE = int(env.get("DRINKS_THUMB_CACHE_SIZE", 256))
+    # pooled IMG_FEAT_MODEL embeddings of original images, from the capture
+    # loop and uploads, are kept in EMBEDDINGS_DIR next to the database for
+    # /similar to search. `poetry run embed_captures` embeds the ones from
+    # before. Turning EMBED_IMAGES off keeps the capture loop from loading
+    # that model as well
+    EMBEDDINGS_DIR = env.get(
+        "DRINKS_EMBEDDINGS_DIR", f"{os.path.splitext(DB)[0]}_embeddings"
+    )
+    EMBED_IMAGES = env.get("DRINKS_EMBED_IMAGES", "true").lower() == "true"
+    # number of past captures /similar returns by default
+    SIMILAR_COUNT = int(env.get("DRINKS_SIMILAR_COUNT", 10))
+    # number of long-lived inference worker processes, and which models
+    # each of them loads on startup (any of "detection", "similarity")
+    WORKER_COUNT = int(env.get("DRINKS_WORKER_COUNT", 1))
+    WORKER_MODELS = env.get("DRINKS_WORKER_MODELS", "detection,similarity").split(",")
+    # with WORKER_LISTEN set, as host:port or unix:path, the server starts
+    # no workers of its own and runs jobs on those started with `poetry run
+    # worker` instead, up to WORKER_SLOTS batches at once. Those connect to
+    # WORKER_CONNECT, run up to WORKER_CAPACITY jobs at once each, and need
+    # the server's ORIG_DIR but not its database, as they send results back
+    # for the server to store. They're pinged every WORKER_PING_INTERVAL
+    # seconds, and dropped if they don't answer within WORKER_PING_TIMEOUT.
+    # Workers connecting over TCP must send the server's WORKER_TOKEN, and
+    # a unix socket is only open to those with access to its path
+    WORKER_LISTEN = env.get("DRINKS_WORKER_LISTEN", "")
+    WORKER_CONNECT = env.get("DRINKS_WORKER_CONNECT", WORKER_LISTEN or "localhost:8090")
+    WORKER_TOKEN = env.get("DRINKS_WORKER_TOKEN", "")
+    WORKER_SLOTS = int(env.get("DRINKS_WORKER_SLOTS", 4))
+    WORKER_CAPACITY = int(env.get("DRINKS_WORKER_CAPACITY", 1))
+    WORKER_PING_INTERVAL = float(env.get("DRINKS_WORKER_PING_INTERVAL", 5))
+    WORKER_PING_TIMEOUT = float(env.get("DRINKS_WORKER_PING_TIMEOUT", 10))
+    # detection requests arriving close together are run as one batch, of at
+    # most DETECTION_BATCH_SIZE images, waiting at most DETECTION_BATCH_WAIT
+    # seconds after the first one for others to join
+    DETECTION_BATCH_SIZE = int(env.get("DRINKS_DETECTION_BATCH_SIZE", 8))
+    DETECTION_BATCH_WAIT = float(env.get("DRINKS_DETECTION_BATCH_WAIT", 0.05))
+    # detection and similarity requests are queued as jobs in the database.
+    # A worker holds a job for JOB_LEASE seconds at a time, after which
+    # another may take it over, and a failed job is retried after
+    # JOB_RETRY_DELAY seconds, doubling each time, up to JOB_MAX_ATTEMPTS
+    # runs in all. Finished jobs are kept for JOB_RETENTION seconds.
+    JOB_LEASE = float(env.get("DRINKS_JOB_LEASE", 30))
+    JOB_RETRY_DELAY = float(env.get("DRINKS_JOB_RETRY_DELAY", 5))
+    JOB_MAX_ATTEMPTS = int(env.get("DRINKS_JOB_MAX_ATTEMPTS", 3))
+    JOB_RETENTION = float(env.get("DRINKS_JOB_RETENTION", 24 * 60 * 60))
+    # with JOB_QUEUE_SOFT_LIMIT jobs waiting or running, only detection
+    # requests are still taken, with JOB_QUEUE_LIMIT none are, and clients
+    # are told when to retry
+    JOB_QUEUE_SOFT_LIMIT = int(env.get("DRINKS_JOB_QUEUE_SOFT_LIMIT", 50))
+    JOB_QUEUE_LIMIT = int(env.get("DRINKS_JOB_QUEUE_LIMIT", 200))
 
     def __post_init__(self, stock_types_schema):
         print("post init")
@@ -59,3 +171,5 @@ class Config:
     def setup():
         os.makedirs(Config.ORIG_DIR, exist_ok=True)
         os.makedirs(Config.ANNO_DIR, exist_ok=True)
+        os.makedirs(Config.THUMB_DIR, exist_ok=True)
+        os.makedirs(Config.EMBEDDINGS_DIR, exist_ok=True)
@@ -1,13 +1,45 @@
+import collections
 import enum
 import functools
 import json
 import sqlite3
+import threading
+from collections.abc import Callable
 from dataclasses import dataclass, field
 from datetime import datetime
 from typing import Optional, Self
-from uuid import UUID, uuid4
+from uuid import UUID
 
 PAGINATION_SIZE = 10
+# idle connections kept open by a ConnectionPool
+POOL_SIZE = 8
+# bucket widths in seconds the stock series is rolled up at, with how many
+# seconds of history to keep at each, None to keep all of it
+SERIES_RESOLUTIONS = {
+    60: 14 * 24 * 60 * 60,
+    60 * 60: 400 * 24 * 60 * 60,
+    24 * 60 * 60: None,
+}
+# applied to every new connection, WAL lets readers carry on while the
+# capture loop writes. Overridden by the DB_* settings in Config.
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 256 * 1024 * 1024,
+    # negative sizes are in KiB
+    "cache_size": -64 * 1024,
+    "busy_timeout": 5000,
+}
+
+# (captures.created_at, captures.id) of the last row of a page
+CaptureCursor = tuple[float, int]
+
+
+def to_timestamp(value: datetime | float) -> float:
+    """Timestamps are stored as unix time, but often passed around as datetimes"""
+    if isinstance(value, datetime):
+        return value.timestamp()
+    return value
 
 
 class CaptureCreatedBy(enum.Enum):
@@ -52,7 +84,7 @@ class CaptureCreatedBy(enum.Enum):
 
 
 class CaptureType(enum.Enum):
-    ORIG = "orig",
+    ORIG = ("orig",)
     ANNO = "anno"
 
     def __new__(cls, *args, **kwargs):
@@ -69,9 +101,26 @@ class CaptureType(enum.Enum):
         return CaptureType(capture_type.decode("UTF-8"))
 
 
+class JobState(enum.Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    # out of attempts
+    FAILED = "failed"
+
+    @staticmethod
+    def adapt(state):
+        return state.value
+
+    @staticmethod
+    def convert(state):
+        return JobState(state.decode("UTF-8"))
+
+
 @dataclass
 class CaptureRow:
     """A completed capture, combining a row from captures and capture_results"""
+
     id: int
     uuid: str
     model: str
@@ -81,16 +130,35 @@ class CaptureRow:
     created_at: datetime
     timestamp: str = field(init=False)
     filename_divider: str = ":"
+    # when the capture was started, which captures are ordered by
+    captured_at: float | None = None
 
     def __post_init__(self):
         self.timestamp = datetime.fromtimestamp(self.created_at).isoformat(
             sep=" ", timespec="seconds"
         )
 
+    @property
+    def cursor(self) -> CaptureCursor:
+        """Keyset position of this row, to fetch the captures after it"""
+        return (self.captured_at, self.id)
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "uuid": self.uuid,
+            "model": self.model,
+            "result": self.result,
+            "created_by": self.created_by.value,
+            "created_at": self.created_at,
+            "captured_at": self.captured_at,
+            "timestamp": self.timestamp,
+        }
+
     @staticmethod
     def row_factory(cursor: sqlite3.Cursor, row: tuple) -> Self:
         fields = [column[0] for column in cursor.description]
-        row = {key: value for key, value in zip(fields, row)}
+        row = {key: value for key, value in zip(fields, row, strict=False)}
 
     @staticmethod
     def from_row(row) -> Self:
@@ -109,276 +177,1184 @@ class CaptureRow:
             row["filenames"].split(CaptureRow.filename_divider),
             row["created_by"],
             row["created_at"],
+            captured_at=row["captured_at"],
         )
 
 
 @dataclass
 class DetectionRow(CaptureRow):
-    objects: list = field(init=False)
-
-    def __post_init__(self):
-        super().__post_init__()
-        self.objects = [
+    # only built when a page actually shows the objects, stock levels
+    # come from the stock_counts table instead
+    @functools.cached_property
+    def objects(self) -> list:
+        return [
             {
                 "label": label,
                 "score": float(score),
                 "box": box,
             }
             for label, score, box in zip(
-                self.result["labels"], self.result["scores"], self.result["boxes"]
+                self.result["labels"],
+                self.result["scores"],
+                self.result["boxes"],
+                strict=False,
             )
         ]
 
-    def object_counts(self):
-        def upsert(counts: dict, label: str) -> dict:
-            if label in counts:
-                counts[label] += 1
-            else:
-                counts[label] = 1
-            return counts
-        return functools.reduce(lambda counts, obj: upsert(counts, obj["label"]), self.objects, {})
-
 
 @dataclass
 class SimilarityRow(CaptureRow):
-    similarity: float = field(init=False)
+    # pairwise similarities of the capture's images, in the order of
+    # file_ids. Captures from before those were stored compared two images
+    # and only kept their similarity
+    similarity: list[list[float]] = field(init=False)
+    file_ids: list[int] | None = field(init=False)
 
     def __post_init__(self):
         super().__post_init__()
-        self.similarity = self.result["similarity"]
+        similarity = self.result["similarity"]
+        if not isinstance(similarity, list):
+            similarity = [[1.0, similarity], [similarity, 1.0]]
+        self.similarity = similarity
+        self.file_ids = self.result.get("file_ids")
+
+
+@dataclass
+class JobRow:
+    """A claimed job, see Db.claim_jobs"""
+
+    id: int
+    kind: str
+    capture_id: int
+    payload: dict
+    priority: int
+    # including the current one
+    attempts: int
+    max_attempts: int
+
+    @staticmethod
+    def from_row(row) -> Self:
+        return JobRow(
+            row["id"],
+            row["kind"],
+            row["capture_id"],
+            json.loads(row["payload"]),
+            row["priority"],
+            row["attempts"],
+            row["max_attempts"],
+        )
+
+
+def _text_timestamps_to_unix_(cur: sqlite3.Cursor) -> None:
+    # datetimes used to be passed straight to sqlite3, which stores them as
+    # ISO 8601 text in local time
+    for table in ["captures", "capture_results", "files", "capture_files"]:
+        rows = cur.execute(
+            f"SELECT rowid, created_at FROM {table} WHERE typeof(created_at) = 'text'"
+        ).fetchall()
+        cur.executemany(
+            f"UPDATE {table} SET created_at = ? WHERE rowid = ?",
+            [
+                (datetime.fromisoformat(created_at).timestamp(), rowid)
+                for rowid, created_at in rows
+            ],
+        )
+
+
+def is_detection_result(result: object) -> bool:
+    return isinstance(result, dict) and all(
+        key in result for key in ["labels", "scores", "boxes"]
+    )
+
+
+def _write_detections_(cur: sqlite3.Cursor, capture_id: int, result: dict) -> None:
+    """Writes the normalized detections of a result and their per-label counts"""
+    cur.executemany(
+        """
+            INSERT INTO detections (capture_id, label, score, x1, y1, x2, y2)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+        [
+            (capture_id, label, float(score), *box)
+            for label, score, box in zip(
+                result["labels"], result["scores"], result["boxes"], strict=False
+            )
+        ],
+    )
+    cur.executemany(
+        """
+            INSERT INTO stock_counts (capture_id, label, count)
+            VALUES (?, ?, ?)
+        """,
+        [
+            (capture_id, label, count)
+            for label, count in collections.Counter(result["labels"]).items()
+        ],
+    )
+
+
+def _write_stock_series_(
+    cur: sqlite3.Cursor, counts: dict[str, int], at: float
+) -> None:
+    """Adds a sample of stock counts to the bucket containing at, at each resolution"""
+    for resolution, retention in SERIES_RESOLUTIONS.items():
+        bucket = int(at // resolution) * resolution
+        cur.execute(
+            """
+                INSERT INTO stock_series_samples (resolution, bucket, samples, last_at)
+                VALUES (?, ?, 1, ?)
+                ON CONFLICT(resolution, bucket) DO UPDATE SET
+                    samples = samples + 1,
+                    last_at = max(last_at, excluded.last_at)
+            """,
+            (resolution, bucket, at),
+        )
+        cur.executemany(
+            """
+                INSERT INTO stock_series (
+                    resolution, bucket, label,
+                    total_count, max_count, last_count, last_at
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(resolution, bucket, label) DO UPDATE SET
+                    total_count = total_count + excluded.total_count,
+                    max_count = max(max_count, excluded.max_count),
+                    last_count = CASE
+                        WHEN excluded.last_at >= last_at THEN excluded.last_count
+                        ELSE last_count
+                    END,
+                    last_at = max(last_at, excluded.last_at)
+            """,
+            [
+                (resolution, bucket, label, count, count, count, at)
+                for label, count in counts.items()
+            ],
+        )
+        if retention is not None:
+            for table in ["stock_series", "stock_series_samples"]:
+                cur.execute(
+                    f"DELETE FROM {table} WHERE resolution = ? AND bucket < ?",
+                    (resolution, bucket - retention),
+                )
+
+
+class UnitOfWork:
+    """
+    Collects the rows written for one capture: the capture itself, its
+    result, new files and links to existing ones. Db.commit_unit then
+    writes them all in a single transaction. Usable as a context manager,
+    committing on exit unless an exception was raised.
+    """
+
+    def __init__(self, db: Optional["Db"], capture_id: int | None = None):
+        # None when committed through AsyncDb.commit_unit instead
+        self.db = db
+        # set for an in-progress capture, or once committed
+        self.capture_id = capture_id
+        self.capture: tuple | None = None
+        self.result: tuple[object, float, bool] | None = None
+        self.new_files: list[tuple[str, CaptureType, float, str | None]] = []
+        # ids of new_files, in the same order, once committed
+        self.new_file_ids: list[int] = []
+        self.file_ids: list[int] = []
+        # (sha256, model, query) to memoize the result under
+        self.memo_key: tuple[str, str, str] | None = None
+        self.jobs: list[tuple[str, dict, int, int]] = []
+        # ids of jobs, in the same order, once committed
+        self.new_job_ids: list[int] = []
+
+    def create_capture(
+        self,
+        uuid: UUID,
+        model: str,
+        created_by: CaptureCreatedBy,
+        created_at: datetime | float,
+    ) -> Self:
+        self.capture = (uuid.hex, model, created_by, to_timestamp(created_at))
+        return self
+
+    def complete(
+        self, result: object, created_at: datetime | float, with_file_ids: bool = False
+    ) -> Self:
+        """
+        Stores the capture's result. With with_file_ids, the result, a dict,
+        also gets the ids of its files as "file_ids", in the same order as
+        job payloads do, since those of new files are only known on commit.
+        """
+        self.result = (result, to_timestamp(created_at), with_file_ids)
+        return self
+
+    def add_file(
+        self,
+        filename: str,
+        type: CaptureType,
+        created_at: datetime | float,
+        sha256: str | None = None,
+    ) -> Self:
+        """
+        Adds a file to the capture. A file already stored under the same
+        name, as content-addressed originals are, is linked instead.
+        """
+        self.new_files.append((filename, type, to_timestamp(created_at), sha256))
+        return self
+
+    def enqueue(
+        self, kind: str, payload: dict, priority: int, max_attempts: int
+    ) -> Self:
+        """
+        Queues a job to work on the capture, see Db.claim_jobs. Its payload
+        also gets the ids of the capture's files as "file_ids", new files
+        first, then linked ones, each in the order they were added.
+        """
+        self.jobs.append((kind, payload, priority, max_attempts))
+        return self
+
+    def memoize(self, sha256: str, model: str, query: str) -> Self:
+        """
+        Also caches the result for later requests on the same input, see
+        Db.fetch_cached_result
+        """
+        self.memo_key = (sha256, model, query)
+        return self
+
+    def link_file(self, file_id: int) -> Self:
+        self.file_ids.append(file_id)
+        return self
+
+    def commit(self) -> int:
+        return self.db.commit_unit(self)
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            self.commit()
+
+
+def _backfill_detections_(cur: sqlite3.Cursor) -> None:
+    rows = cur.execute(
+        """
+            SELECT r.capture_id, r.result
+            FROM capture_results r
+            WHERE r.capture_id NOT IN (SELECT capture_id FROM stock_counts)
+        """
+    ).fetchall()
+    for capture_id, result in rows:
+        result = json.loads(result)
+        if is_detection_result(result):
+            _write_detections_(cur, capture_id, result)
+
+
+def _backfill_stock_series_(cur: sqlite3.Cursor) -> None:
+    rows = cur.execute(
+        "SELECT result, created_at FROM capture_results ORDER BY created_at"
+    ).fetchall()
+    for result, created_at in rows:
+        result = json.loads(result)
+        if is_detection_result(result):
+            _write_stock_series_(cur, collections.Counter(result["labels"]), created_at)
+
+
+# Schema migrations, applied in order. Each one is a list of statements, or
+# functions taking a cursor, and bumps PRAGMA user_version by one. Databases
+# created before versioning report version 0, and since version 1 only
+# creates missing tables they're picked up from there.
+MIGRATIONS: list[list[str | Callable[[sqlite3.Cursor], None]]] = [
+    # 1: initial schema
+    [
+        """
+            CREATE TABLE IF NOT EXISTS captures (
+                id INTEGER PRIMARY KEY,
+                uuid TEXT NOT NULL UNIQUE,
+                model TEXT NOT NULL,
+                created_by capture_created_by NOT NULL,
+                created_at INTEGER NOT NULL
+            )
+        """,
+        """
+            CREATE TABLE IF NOT EXISTS capture_results (
+                id INTEGER PRIMARY KEY,
+                capture_id INTEGER NOT NULL UNIQUE,
+                result TEXT NOT NULL,
+                created_at INTEGER NOT NULL,
+                FOREIGN KEY(capture_id) REFERENCES captures(id)
+            )
+        """,
+        """
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY,
+                filename TEXT NOT NULL,
+                type capture_type NOT NULL,
+                created_at INTEGER NOT NULL,
+                UNIQUE(filename, type)
+            )
+        """,
+        """
+            CREATE TABLE IF NOT EXISTS capture_files (
+                capture_id INTEGER NOT NULL,
+                file_id INTEGER NOT NULL,
+                created_at INTEGER NOT NULL,
+                FOREIGN KEY(capture_id) REFERENCES captures(id),
+                FOREIGN KEY(file_id) REFERENCES files(id)
+            )
+        """,
+    ],
+    # 2: indexes for listing captures and looking up their files
+    [
+        """
+            CREATE INDEX IF NOT EXISTS captures_created_at
+            ON captures(created_at)
+        """,
+        """
+            CREATE INDEX IF NOT EXISTS captures_created_by_created_at
+            ON captures(created_by, created_at)
+        """,
+        """
+            CREATE INDEX IF NOT EXISTS capture_files_capture_id
+            ON capture_files(capture_id, file_id)
+        """,
+        """
+            CREATE INDEX IF NOT EXISTS capture_files_file_id
+            ON capture_files(file_id, capture_id)
+        """,
+    ],
+    # 3: store all timestamps as unix time, so captures can be ordered and
+    # filtered by them
+    [_text_timestamps_to_unix_],
+    # 4: detections split out of the result JSON, with per-capture counts
+    # for the stock pages
+    [
+        """
+            CREATE TABLE IF NOT EXISTS detections (
+                id INTEGER PRIMARY KEY,
+                capture_id INTEGER NOT NULL,
+                label TEXT NOT NULL,
+                score REAL NOT NULL,
+                x1 REAL NOT NULL,
+                y1 REAL NOT NULL,
+                x2 REAL NOT NULL,
+                y2 REAL NOT NULL,
+                FOREIGN KEY(capture_id) REFERENCES captures(id)
+            )
+        """,
+        """
+            CREATE INDEX IF NOT EXISTS detections_capture_id
+            ON detections(capture_id)
+        """,
+        """
+            CREATE INDEX IF NOT EXISTS detections_label
+            ON detections(label, capture_id)
+        """,
+        """
+            CREATE TABLE IF NOT EXISTS stock_counts (
+                capture_id INTEGER NOT NULL,
+                label TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY(capture_id, label),
+                FOREIGN KEY(capture_id) REFERENCES captures(id)
+            ) WITHOUT ROWID
+        """,
+        _backfill_detections_,
+    ],
+    # 5: stock counts over time, rolled up per minute, hour and day as
+    # captures complete
+    [
+        """
+            CREATE TABLE IF NOT EXISTS stock_series_samples (
+                resolution INTEGER NOT NULL,
+                bucket INTEGER NOT NULL,
+                samples INTEGER NOT NULL,
+                last_at REAL NOT NULL,
+                PRIMARY KEY(resolution, bucket)
+            ) WITHOUT ROWID
+        """,
+        """
+            CREATE TABLE IF NOT EXISTS stock_series (
+                resolution INTEGER NOT NULL,
+                bucket INTEGER NOT NULL,
+                label TEXT NOT NULL,
+                total_count INTEGER NOT NULL,
+                max_count INTEGER NOT NULL,
+                last_count INTEGER NOT NULL,
+                last_at REAL NOT NULL,
+                PRIMARY KEY(resolution, bucket, label)
+            ) WITHOUT ROWID
+        """,
+        _backfill_stock_series_,
+    ],
+    # 6: content hashes of stored originals, and results memoized by the
+    # hash of the image they're for, the model and its query
+    [
+        "ALTER TABLE files ADD COLUMN sha256 TEXT",
+        """
+            CREATE INDEX IF NOT EXISTS files_sha256
+            ON files(sha256) WHERE sha256 IS NOT NULL
+        """,
+        """
+            CREATE TABLE IF NOT EXISTS cached_results (
+                sha256 TEXT NOT NULL,
+                model TEXT NOT NULL,
+                query TEXT NOT NULL,
+                result TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY(sha256, model, query)
+            ) WITHOUT ROWID
+        """,
+    ],
+    # 7: work queued for the inference workers, so it survives restarts
+    [
+        """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                kind TEXT NOT NULL,
+                capture_id INTEGER NOT NULL,
+                payload TEXT NOT NULL,
+                state job_state NOT NULL,
+                priority INTEGER NOT NULL,
+                attempts INTEGER NOT NULL,
+                max_attempts INTEGER NOT NULL,
+                -- not claimed before then, retries wait out a backoff
+                available_at REAL NOT NULL,
+                lease_owner TEXT,
+                lease_until REAL,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                FOREIGN KEY(capture_id) REFERENCES captures(id)
+            )
+        """,
+        """
+            CREATE INDEX IF NOT EXISTS jobs_pending
+            ON jobs(priority DESC, id) WHERE state IN ('queued', 'running')
+        """,
+        """
+            CREATE INDEX IF NOT EXISTS jobs_state_updated_at
+            ON jobs(state, updated_at)
+        """,
+    ],
+    # 8: claim_jobs only picks from queued jobs, in an order this index
+    # hands back as is, with what it filters on alongside
+    [
+        "DROP INDEX IF EXISTS jobs_pending",
+        """
+            CREATE INDEX IF NOT EXISTS jobs_queued
+            ON jobs(state, priority DESC, id, kind, available_at)
+        """,
+    ],
+]
 
 
 sqlite3.register_adapter(CaptureCreatedBy, CaptureCreatedBy.adapt)
 sqlite3.register_converter("capture_created_by", CaptureCreatedBy.convert)
 sqlite3.register_adapter(CaptureType, CaptureType.adapt)
 sqlite3.register_converter("capture_type", CaptureType.convert)
+sqlite3.register_adapter(JobState, JobState.adapt)
+sqlite3.register_converter("job_state", JobState.convert)
+
+
+def pragmas_from_config(config) -> dict[str, object]:
+    return {
+        "journal_mode": config["DB_JOURNAL_MODE"],
+        "synchronous": config["DB_SYNCHRONOUS"],
+        "mmap_size": config["DB_MMAP_SIZE"],
+        "cache_size": config["DB_CACHE_SIZE"],
+        "busy_timeout": config["DB_BUSY_TIMEOUT"],
+    }
+
+
+def connect(db_url, pragmas: dict[str, object] | None = None) -> sqlite3.Connection:
+    # connections from a pool can end up used from other threads, but
+    # never from two at once
+    con = sqlite3.connect(
+        db_url, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False
+    )
+    con.row_factory = sqlite3.Row
+    for name, value in (pragmas if pragmas is not None else DEFAULT_PRAGMAS).items():
+        # PRAGMA doesn't take parameters, values only come from the config
+        con.execute(f"PRAGMA {name} = {value}")
+    return con
+
 
 class Db:
-    def __init__(self, db_url, pagination_size=PAGINATION_SIZE):
+    def __init__(
+        self,
+        db_url,
+        pagination_size=PAGINATION_SIZE,
+        pragmas: dict[str, object] | None = None,
+        con: sqlite3.Connection | None = None,
+        pool: Optional["ConnectionPool"] = None,
+    ):
         self.pagination_size = pagination_size
-        db_con = sqlite3.connect(db_url, detect_types=sqlite3.PARSE_DECLTYPES)
-        db_con.row_factory = sqlite3.Row
-        self.con = db_con
+        self.con = con if con is not None else connect(db_url, pragmas)
+        self.pool = pool
         # DEBUG
         # self.con.set_trace_callback(lambda s: print("Query:", s))
 
+    @staticmethod
+    def from_config(config) -> "Db":
+        return Db(config["DB"], pragmas=pragmas_from_config(config))
+
     def __new_cur__(self) -> sqlite3.Cursor:
         cur = self.con.cursor()
         cur.arraysize = self.pagination_size
         return cur
 
     def _init_db_(self) -> None:
-        with self.con:
-            cur = self.__new_cur__()
-            cur.execute(
-                """
-                    CREATE TABLE IF NOT EXISTS captures (
-                        id INTEGER PRIMARY KEY,
-                        uuid TEXT NOT NULL UNIQUE,
-                        model TEXT NOT NULL,
-                        created_by capture_created_by NOT NULL,
-                        created_at INTEGER NOT NULL
-                    )
-                """
-            )
-            cur.execute(
-                """
-                    CREATE TABLE IF NOT EXISTS capture_results (
-                        id INTEGER PRIMARY KEY,
-                        capture_id INTEGER NOT NULL UNIQUE,
-                        result TEXT NOT NULL,
-                        created_at INTEGER NOT NULL,
-                        FOREIGN KEY(capture_id) REFERENCES captures(id)
-                    )
-                """
-            )
-            cur.execute(
-                """
-                    CREATE TABLE IF NOT EXISTS files (
-                        id INTEGER PRIMARY KEY,
-                        filename TEXT NOT NULL,
-                        type capture_type NOT NULL,
-                        created_at INTEGER NOT NULL,
-                        UNIQUE(filename, type)
-                    )
-                """
-            )
-            cur.execute(
-                """
-                    CREATE TABLE IF NOT EXISTS capture_files (
-                        capture_id INTEGER NOT NULL,
-                        file_id INTEGER NOT NULL,
-                        created_at INTEGER NOT NULL,
-                        FOREIGN KEY(capture_id) REFERENCES captures(id),
-                        FOREIGN KEY(file_id) REFERENCES files(id)
-                    )
-                """
-            )
+        self.migrate()
+
+    def schema_version(self) -> int:
+        return self.__new_cur__().execute("PRAGMA user_version").fetchone()[0]
+
+    def migrate(self) -> int:
+        """
+        Brings the schema up to date by running every migration past the
+        version stored in user_version, each in its own transaction
+        """
+        version = self.schema_version()
+        for new_version, migration in enumerate(
+            MIGRATIONS[version:], start=version + 1
+        ):
+            print(f"Migrating database to version {new_version}")
+            with self.con:
+                cur = self.__new_cur__()
+                cur.execute("BEGIN")
+                for step in migration:
+                    if callable(step):
+                        step(cur)
+                    else:
+                        cur.execute(step)
+                # PRAGMA doesn't take parameters
+                cur.execute(f"PRAGMA user_version = {int(new_version)}")
+            version = new_version
+        return version
 
     def close(self) -> None:
-        self.con.close()
+        """Closes the connection, or hands it back if it came from a pool"""
+        if self.pool is not None:
+            self.pool.release(self)
+        else:
+            self.con.close()
+
+    def data_version(self) -> int:
+        """Changes whenever another connection commits to the database"""
+        return self.__new_cur__().execute("PRAGMA data_version").fetchone()[0]
 
-    def __fetch_captures__(self, limit: int, cap_types: Optional[list[CaptureCreatedBy]] = None) -> list[CaptureRow]:
+    def fetch_last_result_id(self) -> int | None:
+        """Id of the latest capture result, which changes when a capture completes"""
+        return (
+            self.__new_cur__()
+            .execute("SELECT MAX(id) FROM capture_results")
+            .fetchone()[0]
+        )
+
+    def __fetch_captures__(
+        self,
+        limit: int,
+        cap_types: list[CaptureCreatedBy] | None = None,
+        after: CaptureCursor | None = None,
+        since: float | None = None,
+        until: float | None = None,
+    ) -> list[CaptureRow]:
         if cap_types is None:
             cap_types = CaptureCreatedBy.__members__.values()
         caps_type = [c.value for c in cap_types]
-        return list(map(
-            CaptureRow.from_row,
-            self.__new_cur__().execute(
-                f"""
+        # a single type walks captures_created_by_created_at newest first.
+        # With several, the unary + keeps the planner off that index, which
+        # would need sorting every matching capture, so it walks
+        # captures_created_at instead. Either way it stops at the limit, and
+        # filenames are looked up per capture rather than grouping the full join
+        if len(caps_type) == 1:
+            conditions = ["c.created_by = ?"]
+        else:
+            conditions = [f"+c.created_by IN ({', '.join('?' * len(caps_type))})"]
+        params = list(caps_type)
+        # the cursor starts the walk right after the last row of the
+        # previous page, so any page costs the same as the first
+        if after is not None:
+            conditions.append("(c.created_at, c.id) < (?, ?)")
+            params += [to_timestamp(after[0]), after[1]]
+        if since is not None:
+            conditions.append("c.created_at >= ?")
+            params.append(to_timestamp(since))
+        if until is not None:
+            conditions.append("c.created_at < ?")
+            params.append(to_timestamp(until))
+        return list(
+            map(
+                CaptureRow.from_row,
+                self.__new_cur__()
+                .execute(
+                    f"""
                     SELECT c.id, c.uuid, c.model, r.result, c.created_by, r.created_at,
-                        GROUP_CONCAT(f.filename, "{CaptureRow.filename_divider}")
-                        AS filenames
+                        c.created_at AS captured_at,
+                        (
+                            SELECT GROUP_CONCAT(
+                                f.filename, '{CaptureRow.filename_divider}'
+                            )
+                            FROM capture_files cf
+                            INNER JOIN files f ON cf.file_id = f.id
+                            WHERE cf.capture_id = c.id
+                        ) AS filenames
                     FROM captures c
-                    LEFT JOIN capture_files cf ON c.id = cf.capture_id
-                    LEFT JOIN files f ON cf.file_id = f.id
                     INNER JOIN capture_results r ON c.id = r.capture_id
-                    WHERE c.created_by IN ({", ".join("?" * len(caps_type))})
-                    GROUP BY c.id
-                    ORDER BY c.created_at DESC LIMIT ?
+                    WHERE {" AND ".join(conditions)}
+                    ORDER BY c.created_at DESC, c.id DESC LIMIT ?
                 """,
-                caps_type + [limit]
-            ).fetchmany()))
-        
+                    params + [limit],
+                )
+                .fetchall(),
+            )
+        )
 
-    def fetch_captures(self, limit: int=PAGINATION_SIZE, cap_type: Optional[list[CaptureCreatedBy]] = None) -> list[CaptureRow]:
-        return self.__fetch_captures__(limit, cap_type)
+    def fetch_captures(
+        self,
+        limit: int = PAGINATION_SIZE,
+        cap_type: list[CaptureCreatedBy] | None = None,
+        after: CaptureCursor | None = None,
+        since: float | None = None,
+        until: float | None = None,
+    ) -> list[CaptureRow]:
+        """
+        Fetches a page of completed captures, newest first. Pass the cursor
+        of the last row of a page as after to get the next one.
+        """
+        return self.__fetch_captures__(limit, cap_type, after, since, until)
 
-    def fetch_latest_capture(self, cap_type: Optional[list[CaptureCreatedBy]] = None) -> Optional[CaptureRow]:
+    def fetch_latest_capture(
+        self, cap_type: list[CaptureCreatedBy] | None = None
+    ) -> CaptureRow | None:
         rows = self.__fetch_captures__(1, cap_type)
         if len(rows) != 1:
             return None
         else:
             return rows[0]
 
-    def create_in_progress_capture(
-        self,
-        uuid: UUID,
-        model: str,
-        created_by: CaptureCreatedBy,
-        created_at: int
-    ) -> int:
-        with self.con:
-            cur = self.__new_cur__()
-            cur.execute(
+    def fetch_stock_counts(
+        self, cap_type: list[CaptureCreatedBy] | None = None
+    ) -> dict[str, int] | None:
+        """
+        Counts of each detected label in the latest completed capture, or
+        None if there is no capture yet
+        """
+        if cap_type is None:
+            cap_type = CaptureCreatedBy.__members__.values()
+        caps_type = [c.value for c in cap_type]
+        cur = self.__new_cur__()
+        row = cur.execute(
+            f"""
+                SELECT c.id
+                FROM captures c
+                INNER JOIN capture_results r ON c.id = r.capture_id
+                WHERE +c.created_by IN ({", ".join("?" * len(caps_type))})
+                ORDER BY c.created_at DESC, c.id DESC LIMIT 1
+            """,
+            caps_type,
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            row["label"]: row["count"]
+            for row in cur.execute(
+                "SELECT label, count FROM stock_counts WHERE capture_id = ?",
+                (row["id"],),
+            ).fetchall()
+        }
+
+    def fetch_stock_series(
+        self, resolution: int, since: float, until: float
+    ) -> list[dict]:
+        """
+        Stock levels in each bucket of the series at resolution between
+        since and until. A label's average counts captures where it wasn't
+        detected at all as zero.
+        """
+        points = {}
+        for row in (
+            self.__new_cur__()
+            .execute(
                 """
-                    INSERT INTO CAPTURES (uuid, model, created_by, created_at)
-                    VALUES (?, ?, ?, ?)
-                """,
-                (uuid, model, created_by, created_at)
+                SELECT n.bucket, n.samples, n.last_at AS bucket_last_at,
+                    s.label, s.total_count, s.max_count, s.last_count, s.last_at
+                FROM stock_series_samples n
+                LEFT JOIN stock_series s
+                    ON s.resolution = n.resolution AND s.bucket = n.bucket
+                WHERE n.resolution = ? AND n.bucket >= ? AND n.bucket < ?
+                ORDER BY n.bucket
+            """,
+                (resolution, int(since // resolution) * resolution, until),
+            )
+            .fetchall()
+        ):
+            point = points.setdefault(
+                row["bucket"],
+                {
+                    "bucket": row["bucket"],
+                    "samples": row["samples"],
+                    "counts": {},
+                },
             )
-            return cur.lastrowid
+            if row["label"] is None:
+                continue
+            point["counts"][row["label"]] = {
+                "avg": row["total_count"] / row["samples"],
+                "max": row["max_count"],
+                # not detected in the bucket's last capture
+                "last": row["last_count"]
+                if row["last_at"] >= row["bucket_last_at"]
+                else 0,
+            }
+        return list(points.values())
 
-    def complete_capture(
-        self,
-        capture_id: int,
-        result: object,
-        created_at: int,
-        files: Optional[list[int]]=None
-    ) -> int:
-        if files is None:
-            files = []
+    def unit_of_work(self, capture_id: int | None = None) -> "UnitOfWork":
+        """Starts collecting writes for a capture, see UnitOfWork"""
+        return UnitOfWork(self, capture_id)
+
+    def commit_unit(self, uow: "UnitOfWork") -> int:
+        """Writes all collected in uow in one transaction, returning the capture id"""
+        with self.con:
+            cur = self.__new_cur__()
+            capture_id = uow.capture_id
+            if uow.capture is not None:
+                cur.execute(
+                    """
+                        INSERT INTO captures (uuid, model, created_by, created_at)
+                        VALUES (?, ?, ?, ?)
+                    """,
+                    uow.capture,
+                )
+                capture_id = cur.lastrowid
+            if capture_id is None:
+                raise Exception("unit of work has no capture to write to")
+            linked_at = datetime.now().timestamp()
+            if len(uow.new_files) > 0:
+                cur.executemany(
+                    """
+                        INSERT INTO files (filename, type, created_at, sha256)
+                        VALUES (?, ?, ?, ?)
+                        ON CONFLICT(filename, type) DO NOTHING
+                    """,
+                    uow.new_files,
+                )
+                # executemany can't hand back the new ids, so link through
+                # the files(filename, type) unique index instead, once for
+                # an image given more than once
+                cur.executemany(
+                    """
+                        INSERT INTO capture_files (capture_id, file_id, created_at)
+                        SELECT ?, id, ? FROM files WHERE filename = ? AND type = ?
+                    """,
+                    [
+                        (capture_id, linked_at, filename, type)
+                        for filename, type in dict.fromkeys(
+                            (filename, type) for filename, type, _, _ in uow.new_files
+                        )
+                    ],
+                )
+                uow.new_file_ids = [
+                    cur.execute(
+                        "SELECT id FROM files WHERE filename = ? AND type = ?",
+                        (filename, type),
+                    ).fetchone()["id"]
+                    for filename, type, _, _ in uow.new_files
+                ]
+            if len(uow.file_ids) > 0:
+                cur.executemany(
+                    """
+                        INSERT INTO capture_files (capture_id, file_id, created_at)
+                        VALUES (?, ?, ?)
+                    """,
+                    [(capture_id, file_id, linked_at) for file_id in uow.file_ids],
+                )
+            if uow.result is not None:
+                (result, created_at, with_file_ids) = uow.result
+                if with_file_ids:
+                    result = {**result, "file_ids": uow.new_file_ids + uow.file_ids}
+                cur.execute(
+                    """
+                        INSERT INTO capture_results (capture_id, result, created_at)
+                        VALUES (?, ?, ?)
+                    """,
+                    (capture_id, json.dumps(result), created_at),
+                )
+                if is_detection_result(result):
+                    _write_detections_(cur, capture_id, result)
+                    _write_stock_series_(
+                        cur, collections.Counter(result["labels"]), created_at
+                    )
+                if uow.memo_key is not None:
+                    cur.execute(
+                        """
+                            INSERT OR REPLACE INTO cached_results
+                            (sha256, model, query, result, created_at)
+                            VALUES (?, ?, ?, ?, ?)
+                        """,
+                        (*uow.memo_key, json.dumps(result), created_at),
+                    )
+            uow.new_job_ids = [
+                cur.execute(
+                    """
+                        INSERT INTO jobs (
+                            kind, capture_id, payload, state, priority, attempts,
+                            max_attempts, available_at, created_at, updated_at
+                        )
+                        VALUES (?, ?, ?, ?, ?, 0, ?, ?, ?, ?)
+                    """,
+                    (
+                        kind,
+                        capture_id,
+                        json.dumps(
+                            {**payload, "file_ids": uow.new_file_ids + uow.file_ids}
+                        ),
+                        JobState.QUEUED,
+                        priority,
+                        max_attempts,
+                        linked_at,
+                        linked_at,
+                        linked_at,
+                    ),
+                ).lastrowid
+                for kind, payload, priority, max_attempts in uow.jobs
+            ]
+        uow.capture_id = capture_id
+        return capture_id
+
+    def claim_jobs(
+        self, owner: str, lease: float, batch_sizes: dict[str, int]
+    ) -> list[JobRow]:
+        """
+        Leases the highest priority job that's ready to run to owner for
+        lease seconds, along with up to its kind's batch size of others of
+        the same kind. A job whose lease ran out without it finishing, its
+        worker having died, is queued again first, unless it's out of
+        attempts, so only queued jobs have to be searched.
+        """
+        now = datetime.now().timestamp()
+        ready = "state = 'queued' AND available_at <= :now"
         with self.con:
             cur = self.__new_cur__()
             cur.execute(
                 """
-                    INSERT INTO capture_results (capture_id, result, created_at)
-                    VALUES (?, ?, ?)
+                    UPDATE jobs
+                    SET state = CASE
+                            WHEN attempts >= max_attempts THEN :failed ELSE :queued
+                        END,
+                        error = 'lease expired', available_at = lease_until,
+                        lease_owner = NULL, lease_until = NULL, updated_at = :now
+                    WHERE state = 'running' AND lease_until < :now
                 """,
-                (capture_id, json.dumps(result), created_at),
+                {"failed": JobState.FAILED, "queued": JobState.QUEUED, "now": now},
             )
-            for file_id in files:
-                self.link_file(capture_id, file_id)
-            return capture_id
-
-    def create_capture_with_files(
-        self,
-        uuid: UUID,
-        model: str,
-        created_by: CaptureCreatedBy,
-        created_at: int,
-        files: Optional[list[int]]=None
-    ) -> int:
-        if files is None:
-            files = []
-        capture_id = self.create_in_progress_capture(
-            uuid.hex, model, created_by, created_at
+            kinds = {f"kind{i}": kind for i, kind in enumerate(batch_sizes)}
+            first = cur.execute(
+                f"""
+                    SELECT kind FROM jobs
+                    WHERE {ready}
+                        AND kind IN ({", ".join(f":{key}" for key in kinds)})
+                    ORDER BY priority DESC, id
+                    LIMIT 1
+                """,
+                {"now": now, **kinds},
+            ).fetchone()
+            if first is None:
+                return []
+            rows = cur.execute(
+                f"""
+                    UPDATE jobs
+                    SET state = :running, lease_owner = :owner, lease_until = :until,
+                        attempts = attempts + 1, updated_at = :now
+                    WHERE id IN (
+                        SELECT id FROM jobs
+                        WHERE {ready} AND kind = :kind
+                        ORDER BY priority DESC, id
+                        LIMIT :limit
+                    )
+                    RETURNING
+                        id, kind, capture_id, payload, priority, attempts, max_attempts
+                """,
+                {
+                    "running": JobState.RUNNING,
+                    "owner": owner,
+                    "until": now + lease,
+                    "now": now,
+                    "kind": first["kind"],
+                    "limit": batch_sizes[first["kind"]],
+                },
+            ).fetchall()
+        return sorted(
+            map(JobRow.from_row, rows), key=lambda job: (-job.priority, job.id)
         )
-        for file_id in files:
-            self.link_file(capture_id, file_id)
-        return capture_id
 
-    def create_completed_capture(
-        self,
-        model: str,
-        created_by: CaptureCreatedBy,
-        created_at: int,
-        result: object,
-        files: Optional[list[int]]=None
-    ) -> int:
-        if files is None:
-            files = []
-        uuid = uuid4().hex
-        capture_id = self.create_in_progress_capture(
-            uuid, model, created_by, created_at
+    def fetch_next_job_at(self, kinds: list[str]) -> float | None:
+        """
+        When the next job of one of kinds is ready to be claimed, a queued
+        one once its backoff runs out and a running one once its lease does,
+        or None if there are none. Read only, so checking an idle queue
+        doesn't take the write lock the way claim_jobs does.
+        """
+        return (
+            self.__new_cur__()
+            .execute(
+                f"""
+                SELECT MIN(
+                    CASE WHEN state = 'queued' THEN available_at ELSE lease_until END
+                )
+                FROM jobs
+                WHERE state IN ('queued', 'running')
+                    AND kind IN ({", ".join("?" * len(kinds))})
+            """,
+                kinds,
+            )
+            .fetchone()[0]
         )
-        self.complete_capture(capture_id, result, created_at)
-        for file_id in files:
-            self.link_file(capture_id, file_id)
-        return capture_id
 
-    def insert_file(self, filename: str, type: CaptureType, created_at: int) -> int:
+    def extend_job_leases(self, job_ids: list[int], owner: str, lease: float) -> None:
         with self.con:
-            cur = self.__new_cur__()
-            cur.execute(
-                """
-                    INSERT INTO files (filename, type, created_at)
-                    VALUES (?, ?, ?)
+            self.__new_cur__().execute(
+                f"""
+                    UPDATE jobs SET lease_until = ?
+                    WHERE id IN ({", ".join("?" * len(job_ids))})
+                        AND state = 'running' AND lease_owner = ?
                 """,
-                (filename, type, created_at)
+                [datetime.now().timestamp() + lease, *job_ids, owner],
             )
-            return cur.lastrowid
 
-    def link_file(self, capture_id: int, file_id: int) -> None:
+    def complete_job(self, job_id: int, owner: str) -> None:
+        now = datetime.now().timestamp()
         with self.con:
             self.__new_cur__().execute(
                 """
-                    INSERT INTO capture_files (capture_id, file_id, created_at)
-                    VALUES (?, ?, ?)
+                    UPDATE jobs
+                    SET state = ?, lease_owner = NULL, lease_until = NULL,
+                        updated_at = ?
+                    WHERE id = ? AND lease_owner = ?
                 """,
-                (capture_id, file_id, datetime.now().timestamp())
+                (JobState.DONE, now, job_id, owner),
             )
 
-    def fetch_image_name(self, file_id: int) -> Optional[str]:
+    def fail_job(
+        self, job_id: int, owner: str, error: str, retry_delay: float
+    ) -> JobState | None:
+        """
+        Queues a failed job again after retry_delay seconds, doubled for
+        every attempt after the first, or marks it failed for good once it's
+        out of attempts. Returns its new state, None if owner lost the lease.
+        """
+        now = datetime.now().timestamp()
         with self.con:
-            row_opt = self.__new_cur__().execute(
-                """
+            row = (
+                self.__new_cur__()
+                .execute(
+                    """
+                    UPDATE jobs
+                    SET state = CASE WHEN attempts >= max_attempts THEN ? ELSE ? END,
+                        available_at = ? + ? * (1 << MAX(attempts - 1, 0)),
+                        error = ?, lease_owner = NULL, lease_until = NULL,
+                        updated_at = ?
+                    WHERE id = ? AND lease_owner = ?
+                    RETURNING state
+                """,
+                    (
+                        JobState.FAILED,
+                        JobState.QUEUED,
+                        now,
+                        retry_delay,
+                        error,
+                        now,
+                        job_id,
+                        owner,
+                    ),
+                )
+                .fetchone()
+            )
+        return None if row is None else JobState(row["state"])
+
+    def fetch_job_depth(self) -> int:
+        """Jobs waiting or running"""
+        return (
+            self.__new_cur__()
+            .execute("SELECT COUNT(*) FROM jobs WHERE state IN ('queued', 'running')")
+            .fetchone()[0]
+        )
+
+    def fetch_job_counts(self) -> dict[str, int]:
+        return {
+            JobState(row["state"]).value: row["count"]
+            for row in self.__new_cur__().execute(
+                "SELECT state, COUNT(*) AS count FROM jobs GROUP BY state"
+            )
+        }
+
+    def prune_jobs(self, before: float) -> int:
+        """Deletes jobs done before the given time, returning how many"""
+        with self.con:
+            return (
+                self.__new_cur__()
+                .execute(
+                    "DELETE FROM jobs WHERE state = ? AND updated_at < ?",
+                    (JobState.DONE, before),
+                )
+                .rowcount
+            )
+
+    def fetch_image_name(self, file_id: int) -> str | None:
+        with self.con:
+            row_opt = (
+                self.__new_cur__()
+                .execute(
+                    """
                     SELECT filename
                     FROM files
                     WHERE id = ?
                 """,
-                (file_id,)
-            ).fetchone()
+                    (file_id,),
+                )
+                .fetchone()
+            )
             if row_opt is None:
                 return None
             return row_opt["filename"]
 
-    def fetch_image_for_capture(self, capture_id: int, type: CaptureType, ind: int) -> Optional[str]:
+    def fetch_image_for_capture(
+        self, capture_id: int, type: CaptureType, ind: int
+    ) -> str | None:
         with self.con:
-            rows = self.__new_cur__().execute(
-                """
+            row = (
+                self.__new_cur__()
+                .execute(
+                    """
                     SELECT f.filename
-                    FROM files f
-                    LEFT JOIN capture_files cf ON f.id = cf.file_id
-                    LEFT JOIN captures c ON cf.capture_id = c.id
-                    WHERE c.id = ? AND f.type = ?
-                    ORDER BY f.created_at DESC
+                    FROM capture_files cf
+                    INNER JOIN files f ON cf.file_id = f.id
+                    WHERE cf.capture_id = ? AND f.type = ?
+                    -- newest first, file ids grow with created_at, and the
+                    -- capture_files index already holds them in order
+                    ORDER BY cf.file_id DESC
+                    LIMIT 1 OFFSET ?
                 """,
-                (capture_id, type)
-            ).fetchmany()
-            if len(rows) <= ind:
+                    (capture_id, type, ind),
+                )
+                .fetchone()
+            )
+            if row is None:
                 return None
-            return rows[ind]["filename"]
+            return row["filename"]
+
+    def fetch_file_id_for_capture(
+        self, capture_id: int, type: CaptureType, ind: int
+    ) -> int | None:
+        row = (
+            self.__new_cur__()
+            .execute(
+                """
+                SELECT f.id
+                FROM capture_files cf
+                INNER JOIN files f ON cf.file_id = f.id
+                WHERE cf.capture_id = ? AND f.type = ?
+                ORDER BY cf.file_id DESC
+                LIMIT 1 OFFSET ?
+            """,
+                (capture_id, type, ind),
+            )
+            .fetchone()
+        )
+        if row is None:
+            return None
+        return row["id"]
+
+    def fetch_file_ids(self, type: CaptureType) -> list[int]:
+        return [
+            row["id"]
+            for row in self.__new_cur__().execute(
+                "SELECT id FROM files WHERE type = ? ORDER BY id", (type,)
+            )
+        ]
+
+    def fetch_file_names(self, type: CaptureType) -> list[str]:
+        return [
+            row["filename"]
+            for row in self.__new_cur__().execute(
+                "SELECT filename FROM files WHERE type = ?", (type,)
+            )
+        ]
+
+    def fetch_captures_for_files(
+        self, file_ids: list[int]
+    ) -> dict[int, list[tuple[int, int]]]:
+        """
+        The captures each original belongs to, latest first, as (capture id,
+        index of the file among the capture's originals) as used by /image
+        """
+        captures: dict[int, list[tuple[int, int]]] = {
+            file_id: [] for file_id in file_ids
+        }
+        placeholders = ", ".join("?" * len(file_ids))
+        for row in self.__new_cur__().execute(
+            f"""
+                SELECT file_id, capture_id, ind
+                FROM (
+                    SELECT
+                        cf.file_id,
+                        cf.capture_id,
+                        ROW_NUMBER() OVER (
+                            PARTITION BY cf.capture_id ORDER BY cf.file_id DESC
+                        ) - 1 AS ind
+                    FROM capture_files cf
+                    INNER JOIN files f ON cf.file_id = f.id
+                    WHERE f.type = ? AND cf.capture_id IN (
+                        SELECT capture_id FROM capture_files
+                        WHERE file_id IN ({placeholders})
+                    )
+                )
+                WHERE file_id IN ({placeholders})
+                ORDER BY capture_id DESC
+            """,
+            [CaptureType.ORIG, *file_ids, *file_ids],
+        ):
+            captures[row["file_id"]].append((row["capture_id"], row["ind"]))
+        return captures
+
+    def fetch_file_hashes(self, file_ids: list[int]) -> dict[int, str | None]:
+        """sha256 of each file's contents, None for files stored before it was kept"""
+        return {
+            row["id"]: row["sha256"]
+            for row in self.__new_cur__().execute(
+                "SELECT id, sha256 FROM files"
+                f" WHERE id IN ({', '.join('?' * len(file_ids))})",
+                file_ids,
+            )
+        }
+
+    def fetch_cached_result(self, sha256: str, model: str, query: str) -> object | None:
+        """A result memoized with UnitOfWork.memoize, or None"""
+        row = (
+            self.__new_cur__()
+            .execute(
+                """
+                SELECT result
+                FROM cached_results
+                WHERE sha256 = ? AND model = ? AND query = ?
+            """,
+                (sha256, model, query),
+            )
+            .fetchone()
+        )
+        if row is None:
+            return None
+        return json.loads(row["result"])
+
+    def fetch_result(self, capture_id: int) -> object | None:
+        """The result stored for a capture, or None if it isn't complete"""
+        row = (
+            self.__new_cur__()
+            .execute(
+                "SELECT result FROM capture_results WHERE capture_id = ?", (capture_id,)
+            )
+            .fetchone()
+        )
+        if row is None:
+            return None
+        return json.loads(row["result"])
 
     # def fetch_image(self, created_at) -> Optional[list[str]]:
     #     # skip the usual row factory
@@ -391,3 +1367,51 @@ class Db:
     #     if row_opt is not None:
     #         return json.loads(row_opt["filenames"])
     #     return None
+
+
+class ConnectionPool:
+    """
+    Keeps up to size idle connections open for reuse, handing them out as
+    Db instances. Closing one of those returns its connection to the pool.
+    """
+
+    def __init__(
+        self, db_url, size: int = POOL_SIZE, pragmas: dict[str, object] | None = None
+    ):
+        self.db_url = db_url
+        self.size = size
+        self.pragmas = pragmas
+        self.idle: list[sqlite3.Connection] = []
+        self.lock = threading.Lock()
+        self.closed = False
+
+    @staticmethod
+    def from_config(config) -> "ConnectionPool":
+        return ConnectionPool(
+            config["DB"], config["DB_POOL_SIZE"], pragmas_from_config(config)
+        )
+
+    def acquire(self, pagination_size=PAGINATION_SIZE) -> Db:
+        with self.lock:
+            con = self.idle.pop() if len(self.idle) > 0 else None
+        if con is None:
+            con = connect(self.db_url, self.pragmas)
+        return Db(self.db_url, pagination_size, con=con, pool=self)
+
+    def release(self, db: Db) -> None:
+        con = db.con
+        db.pool = None
+        if con.in_transaction:
+            con.rollback()
+        with self.lock:
+            if not self.closed and len(self.idle) < self.size:
+                self.idle.append(con)
+                return
+        con.close()
+
+    def close(self) -> None:
+        with self.lock:
+            self.closed = True
+            idle, self.idle = self.idle, []
+        for con in idle:
+            con.close()
@@ -0,0 +1,136 @@
+import fcntl
+import json
+import os
+import re
+import threading
+
+import numpy as np
+
+ID_DTYPE = np.dtype("<i8")
+VECTOR_DTYPE = np.dtype("<f4")
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """Scales each row to unit length, so cosine similarity is a dot product"""
+    vectors = np.asarray(vectors, dtype=VECTOR_DTYPE)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, np.finfo(VECTOR_DTYPE).tiny)
+
+
+class EmbeddingStore:
+    """
+    Pooled embeddings of original images, keyed by file id, for one model.
+    They're kept as a float32 matrix in dir, one row per file, with the file
+    ids in a matching array alongside, and memory-mapped for searching.
+    Rows are only ever appended, by any process, under a lock on the ids
+    file. The ids are written last, so readers never see a partial row.
+    """
+
+    def __init__(self, dir: str, model: str) -> None:
+        self.model = model
+        name = re.sub(r"[^\w.-]", "_", model)
+        self.ids_path = os.path.join(dir, f"{name}.ids")
+        self.vectors_path = os.path.join(dir, f"{name}.f32")
+        self.meta_path = os.path.join(dir, f"{name}.json")
+        self.dim: int | None = None
+        self.ids = np.empty(0, ID_DTYPE)
+        self.vectors = np.empty((0, 0), VECTOR_DTYPE)
+        # file id to row
+        self.rows: dict[int, int] = {}
+        # the server searches from several threads at once
+        self.lock = threading.Lock()
+        os.makedirs(dir, exist_ok=True)
+        self.refresh()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def refresh(self) -> None:
+        """Maps any rows other processes appended since the last call"""
+        try:
+            count = os.path.getsize(self.ids_path) // ID_DTYPE.itemsize
+        except OSError:
+            return
+        with self.lock:
+            if count <= len(self.ids):
+                return
+            if self.dim is None:
+                with open(self.meta_path) as f:
+                    self.dim = json.load(f)["dim"]
+            ids = np.memmap(self.ids_path, ID_DTYPE, "r", shape=(count,))
+            self.vectors = np.memmap(
+                self.vectors_path, VECTOR_DTYPE, "r", shape=(count, self.dim)
+            )
+            for row in range(len(self.ids), count):
+                self.rows[int(ids[row])] = row
+            self.ids = ids
+
+    def get(self, file_id: int) -> np.ndarray | None:
+        self.refresh()
+        row = self.rows.get(file_id)
+        return None if row is None else self.vectors[row]
+
+    def add(self, file_ids: list[int], vectors: np.ndarray) -> int:
+        """Appends the embeddings of files not stored yet, returns how many were"""
+        vectors = normalize(vectors).reshape(len(file_ids), -1)
+        with open(self.ids_path, "ab") as ids_file:
+            fcntl.flock(ids_file, fcntl.LOCK_EX)
+            try:
+                self.refresh()
+                if self.dim is None:
+                    self.dim = vectors.shape[1]
+                    with open(self.meta_path, "w") as f:
+                        json.dump({"model": self.model, "dim": self.dim}, f)
+                elif vectors.shape[1] != self.dim:
+                    raise ValueError(
+                        f"expected {self.dim} dimensional embeddings,"
+                        f" got {vectors.shape[1]}"
+                    )
+                new = [
+                    i
+                    for i, file_id in enumerate(file_ids)
+                    if file_id not in self.rows and file_id not in file_ids[:i]
+                ]
+                if len(new) == 0:
+                    return 0
+                with open(self.vectors_path, "ab") as vectors_file:
+                    # drops rows left behind by a writer that died before its ids
+                    vectors_file.truncate(
+                        len(self.ids) * self.dim * VECTOR_DTYPE.itemsize
+                    )
+                    vectors_file.write(vectors[new].tobytes())
+                ids_file.write(np.asarray(file_ids, ID_DTYPE)[new].tobytes())
+                ids_file.flush()
+                self.refresh()
+                return len(new)
+            finally:
+                fcntl.flock(ids_file, fcntl.LOCK_UN)
+
+    def search(
+        self, vector: np.ndarray, k: int, exclude: set[int] | None = None
+    ) -> list[tuple[int, float]]:
+        """The k stored files most similar to vector, as (file id, cosine similarity)"""
+        self.refresh()
+        with self.lock:
+            (ids, vectors) = (self.ids, self.vectors)
+        if len(ids) == 0:
+            return []
+        scores = vectors[: len(ids)] @ normalize(vector).reshape(-1)
+        for file_id in exclude or ():
+            row = self.rows.get(file_id)
+            if row is not None and row < len(ids):
+                scores[row] = -np.inf
+        k = min(k, len(scores))
+        top = np.argpartition(scores, -k)[-k:]
+        top = top[np.argsort(scores[top])[::-1]]
+        return [
+            (int(ids[row]), float(scores[row])) for row in top if scores[row] != -np.inf
+        ]
+
+    def stats(self) -> dict:
+        self.refresh()
+        return {
+            "model": self.model,
+            "count": len(self),
+            "dim": self.dim,
+        }
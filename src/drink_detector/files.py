@@ -1,73 +1,214 @@
-import mimetypes
+import asyncio
+import hashlib
 import os
+import tempfile
+import time
+from dataclasses import dataclass
 from datetime import datetime
-from tempfile import NamedTemporaryFile
-from typing import BinaryIO, Optional
 
-from aiofiles import open
 from PIL import Image
+from werkzeug.security import safe_join
 
 from .db import CaptureType, Db
+from .image_codec import image_codec, save_image
 
+# uploads are written to disk in chunks of at least this many bytes
+WRITE_BUFFER_SIZE = 1 << 20
+# bytes needed to tell apart the formats sniff_image knows
+HEADER_SIZE = 12
+# originals no capture refers to are only removed once they're this many
+# seconds old, so those still being uploaded or committed are left alone
+ORPHAN_MIN_AGE = 24 * 60 * 60
 
-async def async_pipe(in_io: BinaryIO, out_path: os.PathLike, buffer_size: int = 16384) -> int:
-    written = 0
-    async with open(out_path, "wb") as file_:
-        data = in_io.read(buffer_size)
-        while data != b"":
-            written += await file_.write(data)
-            data = in_io.read(buffer_size)
-    return written
-
-async def save_raw_orig(
-    db: Db,
-    config,
-    f: BinaryIO,
-    ext: str,
-    dt: Optional[datetime] = None,
-    ind: Optional[int] = None
-) -> int:
-    dt = dt or datetime.now()
-    ts = dt.timestamp()
-
-    with NamedTemporaryFile() as out_temp:
-        written = await async_pipe(f, out_temp.name)
-        if written == 0:
-            raise OSError("input file was empty")
-
-        fmt = f"{ts}{ext}" if ind is None else f"{ts}_{ind}{ext}"
-
-        os.rename(out_temp.name, os.path.join(config["ORIG_DIR"], fmt))
-
-    return db.insert_file(fmt, CaptureType.ORIG, datetime.now().timestamp())
-
-async def save_orig(
-    db: Db,
-    config,
-    f: BinaryIO,
-    mimetype: str,
-    dt: Optional[datetime] = None,
-    ind: Optional[int] = None
-) -> int:
-    ext = mimetypes.guess_extension(mimetype)
-    if ext is None:
-        raise Exception(f"unknown mime type: {mimetype}")
-    return await save_raw_orig(db, config, f, ext, dt, ind)
-
-def save_anno(
-    db: Db,
-    config,
-    image: Image,
-    ext: str,
-    dt: Optional[datetime],
-    ind: Optional[int] = None
-) -> int:
-    dt = dt or datetime.now()
-    ts = dt.timestamp()
-
-    fmt = f"{ts}{ext}" if ind is None else f"{ts}_{ind}{ext}"
-
-    image.save(os.path.join(config["ANNO_DIR"], fmt))
-
-    return db.insert_file(fmt, CaptureType.ANNO, datetime.now().timestamp())
-    
+
+def sniff_image(header: bytes) -> str | None:
+    """
+    File extension for the image format header starts with, None if it
+    isn't one we take
+    """
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return ".png"
+    if header.startswith(b"\xff\xd8\xff"):
+        return ".jpg"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return ".webp"
+    if header[:6] in (b"GIF87a", b"GIF89a"):
+        return ".gif"
+    if header.startswith(b"BM"):
+        return ".bmp"
+    return None
+
+
+class InvalidImage(Exception):
+    pass
+
+
+class ImageTooLarge(Exception):
+    pass
+
+
+@dataclass
+class StoredOrig:
+    filename: str
+    sha256: str
+    size: int
+
+
+class OrigWriter:
+    """
+    Streams an uploaded original into a temporary file inside ORIG_DIR,
+    hashing it on the way, and renames it into place once complete, named
+    by its hash so an image uploaded again takes no extra space. Other
+    requests may link the same file at any time, so it's never removed by
+    the request that stored it, see remove_orphaned_origs. The
+    format is checked from the first bytes, and writing stops as soon as
+    the image goes over max_size, so neither has to wait for the whole
+    upload. Disk writes happen in a thread, in WRITE_BUFFER_SIZE chunks.
+    """
+
+    def __init__(self, config, max_size: int | None = None) -> None:
+        self.dir = config["ORIG_DIR"]
+        self.max_size = max_size
+        self.file = None
+        self.temp_path: str | None = None
+        self.buffer = bytearray()
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.ext: str | None = None
+
+    async def write(self, data: bytes) -> None:
+        self.size += len(data)
+        self.buffer += data
+        if self.ext is None and len(self.buffer) >= HEADER_SIZE:
+            self.check_header()
+        if self.max_size is not None and self.size > self.max_size:
+            raise ImageTooLarge(f"image is larger than {self.max_size} bytes")
+        if len(self.buffer) >= WRITE_BUFFER_SIZE:
+            await self.flush()
+
+    def check_header(self) -> None:
+        self.ext = sniff_image(bytes(self.buffer[:HEADER_SIZE]))
+        if self.ext is None:
+            raise InvalidImage("not a supported image format")
+
+    async def flush(self) -> None:
+        chunk = bytes(self.buffer)
+        self.buffer.clear()
+        await asyncio.to_thread(self._write_, chunk)
+
+    def _write_(self, chunk: bytes) -> None:
+        if self.file is None:
+            (fd, self.temp_path) = tempfile.mkstemp(dir=self.dir, suffix=".part")
+            self.file = os.fdopen(fd, "wb")
+        self.hash.update(chunk)
+        self.file.write(chunk)
+
+    async def finish(self) -> StoredOrig:
+        """Moves the complete image into ORIG_DIR"""
+        if self.size == 0:
+            raise InvalidImage("input file was empty")
+        if self.ext is None:
+            self.check_header()
+        await self.flush()
+        sha256 = self.hash.hexdigest()
+        filename = f"{sha256}{self.ext}"
+        await asyncio.to_thread(self._finish_, filename)
+        return StoredOrig(filename, sha256, self.size)
+
+    def _finish_(self, filename: str) -> None:
+        self.file.close()
+        self.file = None
+        # an identical copy already there is replaced rather than kept,
+        # which also makes it new again for remove_orphaned_origs
+        os.replace(self.temp_path, os.path.join(self.dir, filename))
+        self.temp_path = None
+
+    def discard(self) -> None:
+        """Removes what was written of an image that won't be finished"""
+        if self.file is not None:
+            self.file.close()
+        if self.temp_path is not None:
+            try:
+                os.remove(self.temp_path)
+            except OSError as e:
+                print(f"Failed to remove partial upload {self.temp_path}: {e}")
+            self.temp_path = None
+
+
+def orig_path(config, filename: str) -> str:
+    """
+    Path of an original in ORIG_DIR, for filenames sent from elsewhere, such
+    as by the server to workers
+    """
+    path = safe_join(config["ORIG_DIR"], filename)
+    if path is None:
+        raise ValueError(f"not a file in ORIG_DIR: {filename}")
+    return path
+
+
+def image_name(ext: str, dt: datetime | None, ind: int | None = None) -> str:
+    ts = (dt or datetime.now()).timestamp()
+    return f"{ts}{ext}" if ind is None else f"{ts}_{ind}{ext}"
+
+
+def write_image(
+    config, dir: str, image: Image, dt: datetime | None, ind: int | None = None
+) -> str:
+    """Encodes image into dir with the configured codec, returning its filename"""
+    (format, ext, options) = image_codec(config)
+    fmt = image_name(ext, dt, ind)
+    save_image(image, os.path.join(dir, fmt), format, options)
+    return fmt
+
+
+def write_orig_image(
+    config, image: Image, dt: datetime | None, ind: int | None = None
+) -> str:
+    return write_image(config, config["ORIG_DIR"], image, dt, ind)
+
+
+def write_anno(
+    config, image: Image, dt: datetime | None, ind: int | None = None
+) -> str:
+    return write_image(config, config["ANNO_DIR"], image, dt, ind)
+
+
+def write_encoded(dir: str, data: bytes, ext: str, dt: datetime | None) -> str:
+    """
+    Writes an image encoded elsewhere, such as by a remote worker, into
+    dir the way write_image would have, returning its filename
+    """
+    filename = image_name(ext, dt)
+    path = os.path.join(dir, filename)
+    temp_path = f"{path}.tmp"
+    try:
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return filename
+
+
+def remove_orphaned_origs(config, db: Db, min_age: float = ORPHAN_MIN_AGE) -> int:
+    """
+    Removes the originals, and partly written files, in ORIG_DIR that no
+    capture refers to and that are older than min_age, such as those of
+    failed uploads. Returns how many were.
+    """
+    known = set(db.fetch_file_names(CaptureType.ORIG))
+    cutoff = time.time() - min_age
+    removed = 0
+    for entry in os.scandir(config["ORIG_DIR"]):
+        if not entry.is_file() or entry.name in known:
+            continue
+        try:
+            if entry.stat().st_mtime >= cutoff:
+                continue
+            os.remove(entry.path)
+            removed += 1
+        except OSError as e:
+            print(f"Failed to remove {entry.name}: {e}")
+    return removed
@@ -0,0 +1,152 @@
+import io
+import os
+import statistics
+import time
+from tempfile import TemporaryDirectory
+
+from PIL import Image
+
+# IMG_FORMAT values, with the PIL format and file extension each saves as
+CODECS = {
+    "png": ("PNG", ".png"),
+    "jpeg": ("JPEG", ".jpg"),
+    "webp": ("WEBP", ".webp"),
+    "webp_lossless": ("WEBP", ".webp"),
+}
+# frame size the benchmark uses when there are no captures to sample
+BENCH_FRAME_SIZE = (1280, 720)
+BENCH_RUNS = 5
+
+
+def image_codec(config) -> tuple[str, str, dict]:
+    """PIL format, file extension and save options for the configured IMG_FORMAT"""
+    codec = config["IMG_FORMAT"]
+    if codec not in CODECS:
+        raise ValueError(f"Unknown image format {codec}")
+    (format, ext) = CODECS[codec]
+    match codec:
+        case "png":
+            options = {"compress_level": config["IMG_COMPRESS_LEVEL"]}
+        case "jpeg":
+            options = {"quality": config["IMG_QUALITY"]}
+        case "webp":
+            options = {
+                "quality": config["IMG_QUALITY"],
+                "method": config["IMG_WEBP_METHOD"],
+            }
+        case "webp_lossless":
+            # quality is how hard to try compressing for lossless WebP
+            options = {
+                "lossless": True,
+                "quality": config["IMG_QUALITY"],
+                "method": config["IMG_WEBP_METHOD"],
+            }
+    return (format, ext, options)
+
+
+def save_image(image: Image, path: str, format: str, options: dict) -> None:
+    """
+    Encodes image straight into the file at path. It's written under a
+    temporary name first, so readers never see a partly written image.
+    """
+    if format == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    temp_path = f"{path}.tmp"
+    try:
+        image.save(temp_path, format, **options)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def encode_image(image: Image, format: str, options: dict) -> bytes:
+    """
+    Encodes image in memory, for images stored by another process, see
+    files.write_encoded
+    """
+    if format == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format, **options)
+    return buffer.getvalue()
+
+
+def benchmark_frames(config, count: int) -> list[Image]:
+    """The latest stored originals, or a synthetic frame if there are none"""
+    orig_dir = config["ORIG_DIR"]
+    try:
+        paths = sorted(
+            (entry.path for entry in os.scandir(orig_dir) if entry.is_file()),
+            key=os.path.getmtime,
+            reverse=True,
+        )
+    except OSError:
+        paths = []
+    frames = []
+    for path in paths:
+        if len(frames) >= count:
+            break
+        try:
+            with Image.open(path) as image:
+                frames.append(image.convert("RGB"))
+        except OSError:
+            continue
+    if len(frames) == 0:
+        print(f"No captures in {orig_dir}, using a synthetic {BENCH_FRAME_SIZE} frame")
+        gradient = Image.linear_gradient("L").resize(BENCH_FRAME_SIZE)
+        noise = Image.effect_noise(BENCH_FRAME_SIZE, 32)
+        frames.append(
+            Image.merge(
+                "RGB", (gradient, noise, gradient.transpose(Image.FLIP_LEFT_RIGHT))
+            )
+        )
+    return frames
+
+
+def benchmark(config, codecs: list[dict] | None = None, count: int = 3) -> list[dict]:
+    """
+    Encodes sample frames with each codec setting, overriding the config
+    with each entry of codecs, and reports the median encode time and the
+    mean size on disk
+    """
+    if codecs is None:
+        codecs = [
+            {"IMG_FORMAT": "png", "IMG_COMPRESS_LEVEL": 6},
+            {"IMG_FORMAT": "png", "IMG_COMPRESS_LEVEL": 1},
+            {"IMG_FORMAT": "jpeg", "IMG_QUALITY": 90},
+            {"IMG_FORMAT": "webp", "IMG_QUALITY": 80, "IMG_WEBP_METHOD": 0},
+            {"IMG_FORMAT": "webp", "IMG_QUALITY": 80, "IMG_WEBP_METHOD": 4},
+            {"IMG_FORMAT": "webp_lossless", "IMG_QUALITY": 0, "IMG_WEBP_METHOD": 0},
+        ]
+    frames = benchmark_frames(config, count)
+    results = []
+    with TemporaryDirectory() as out_dir:
+        for overrides in codecs:
+            (format, ext, options) = image_codec({**config, **overrides})
+            times = []
+            sizes = []
+            for i, frame in enumerate(frames):
+                path = os.path.join(out_dir, f"{i}{ext}")
+                for _ in range(BENCH_RUNS):
+                    start = time.perf_counter()
+                    save_image(frame, path, format, options)
+                    times.append(time.perf_counter() - start)
+                sizes.append(os.path.getsize(path))
+            results.append(
+                {
+                    "codec": overrides,
+                    "frame_size": frames[0].size,
+                    "encode_ms": statistics.median(times) * 1000,
+                    "kilobytes": statistics.mean(sizes) / 1024,
+                }
+            )
+    return results
+
+
+def print_benchmark(results: list[dict]) -> None:
+    print(f"{'codec':<60} {'encode ms':>10} {'KiB':>10}")
+    for result in results:
+        codec = ", ".join(f"{key}={val}" for key, val in result["codec"].items())
+        print(f"{codec:<60} {result['encode_ms']:>10.1f} {result['kilobytes']:>10.1f}")
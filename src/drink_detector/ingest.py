@@ -0,0 +1,159 @@
+from quart import Request, abort
+from werkzeug.sansio.multipart import (
+    Data,
+    Epilogue,
+    Field,
+    File,
+    MultipartDecoder,
+    NeedData,
+)
+
+from .files import ImageTooLarge, InvalidImage, OrigWriter, StoredOrig
+
+# form fields other than images are small, and kept in memory
+MAX_FIELD_SIZE = 64 * 1024
+# the decoder holds whatever it's given in memory until parsed, and counts
+# that against MAX_FIELD_SIZE, so the body is fed to it in slices
+DECODE_SIZE = 16 * 1024
+
+
+async def ingest_images(
+    config, request: Request, fields: list[str]
+) -> list[StoredOrig]:
+    """
+    Stores the images uploaded in the given fields of a multipart request
+    as originals, in order, parsing the body as it arrives rather than
+    waiting for all of it. Aborts with 400 if one is missing or isn't an
+    image, and with 413 if one is larger than UPLOAD_MAX_SIZE. Originals
+    already stored by a request that fails are left for
+    files.remove_orphaned_origs.
+    """
+    receiver = ImageReceiver(config, fields, len(fields))
+    await receive(receiver, request)
+    by_field = {field: orig for (field, orig) in receiver.stored}
+    if any(field not in by_field for field in fields):
+        abort(400)
+    return [by_field[field] for field in fields]
+
+
+async def ingest_image_set(
+    config, request: Request, fields: list[str], max_images: int
+) -> tuple[list[StoredOrig], dict[str, list[str]]]:
+    """
+    Like ingest_images, but any of fields can hold any number of images, up
+    to max_images in all, which are returned in the order they were sent.
+    Also returns the values of the request's other form fields.
+    """
+    receiver = ImageReceiver(config, fields, max_images, repeat=True)
+    await receive(receiver, request)
+    return ([orig for (_, orig) in receiver.stored], receiver.form)
+
+
+async def receive(receiver: "ImageReceiver", request: Request) -> None:
+    """Feeds a multipart request body to receiver, aborting the request if invalid"""
+    boundary = request.mimetype_params.get("boundary")
+    if request.mimetype != "multipart/form-data" or boundary is None:
+        abort(400)
+    decoder = MultipartDecoder(boundary.encode(), MAX_FIELD_SIZE)
+    status: int | None = None
+    try:
+        async for chunk in request.body:
+            for start in range(0, len(chunk), DECODE_SIZE):
+                decoder.receive_data(chunk[start : start + DECODE_SIZE])
+                await receiver.handle_events(decoder)
+            if receiver.done:
+                break
+    except ImageTooLarge:
+        status = 413
+    except (InvalidImage, TooManyImages, ValueError):
+        # ValueError is malformed multipart data
+        status = 400
+    finally:
+        receiver.discard_unfinished()
+    if status is not None:
+        abort(status)
+
+
+class TooManyImages(Exception):
+    pass
+
+
+class ImageReceiver:
+    """
+    Hands the parts of a multipart body that hold the wanted images to
+    OrigWriters, and keeps the values of the other form fields
+    """
+
+    def __init__(
+        self,
+        config,
+        fields: list[str],
+        max_images: int,
+        repeat: bool = False,
+    ) -> None:
+        self.config = config
+        self.fields = fields
+        self.max_images = max_images
+        # whether a field can hold more than one image
+        self.repeat = repeat
+        self.max_size = config["UPLOAD_MAX_SIZE"] * 1024 * 1024
+        # in the order they were sent
+        self.stored: list[tuple[str, StoredOrig]] = []
+        self.form: dict[str, list[str]] = {}
+        # the part currently being received, an image or another form field
+        self.current: str | None = None
+        self.writer: OrigWriter | None = None
+        self.value = bytearray()
+        self.done = False
+
+    async def handle_events(self, decoder: MultipartDecoder) -> None:
+        event = decoder.next_event()
+        while not isinstance(event, (NeedData, Epilogue)):
+            if isinstance(event, File):
+                self.start_file(event)
+            elif isinstance(event, Field):
+                self.current = event.name
+                self.value.clear()
+            elif isinstance(event, Data) and self.current is not None:
+                await self.receive_data(event)
+            event = decoder.next_event()
+        if isinstance(event, Epilogue):
+            self.done = True
+
+    def start_file(self, event: File) -> None:
+        seen = any(field == event.name for (field, _) in self.stored)
+        # browsers send an empty part for a file input left empty
+        if (
+            event.name not in self.fields
+            or event.filename == ""
+            or (seen and not self.repeat)
+        ):
+            self.current = None
+            return
+        if len(self.stored) >= self.max_images:
+            raise TooManyImages(f"more than {self.max_images} images")
+        self.current = event.name
+        self.writer = OrigWriter(self.config, self.max_size)
+
+    async def receive_data(self, event: Data) -> None:
+        if self.writer is None:
+            self.value.extend(event.data)
+            if len(self.value) > MAX_FIELD_SIZE:
+                raise ValueError(f"form field {self.current} is too large")
+            if not event.more_data:
+                self.form.setdefault(self.current, []).append(
+                    self.value.decode(errors="replace")
+                )
+                self.current = None
+            return
+        await self.writer.write(event.data)
+        if not event.more_data:
+            orig = await self.writer.finish()
+            self.stored.append((self.current, orig))
+            self.writer = None
+            self.current = None
+
+    def discard_unfinished(self) -> None:
+        if self.writer is not None:
+            self.writer.discard()
+            self.writer = None
@@ -0,0 +1,207 @@
+import asyncio
+import math
+import os
+import socket
+import time
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
+from datetime import datetime
+from uuid import uuid4
+
+from .async_db import AsyncDb
+from .db import JobRow, JobState
+
+# how often done jobs past JOB_RETENTION are deleted, which is also the
+# longest an idle worker slot waits before looking at the queue again
+PRUNE_INTERVAL = 60 * 60
+# weight of the latest run in the average job duration
+DURATION_SMOOTHING = 0.2
+
+
+@dataclass
+class JobRunner:
+    """How to run one kind of job, run taking a batch of at most batch_size"""
+
+    # returns one outcome per job, an exception marking that job as failed
+    run: Callable[[list[JobRow]], Awaitable[list]]
+    batch_size: int = 1
+    # jobs of higher priority are claimed first
+    priority: int = 0
+
+
+class JobDispatcher:
+    """
+    Runs the jobs queued in the database through the runner for their kind,
+    with one slot per inference worker. Each slot claims a batch of jobs
+    under a lease, which it keeps extending while they run. A job whose
+    server went away is claimed again once its lease runs out. Failed jobs
+    are retried after a backoff until they're out of attempts. Idle slots
+    sleep until a job is queued, or until the next backoff or lease runs
+    out, so an empty queue costs no writes.
+    """
+
+    def __init__(
+        self,
+        db: AsyncDb,
+        runners: dict[str, JobRunner],
+        on_done: Callable[[JobRow, object, JobState], None],
+        slots: int,
+        lease: float,
+        retry_delay: float,
+        batch_wait: float,
+        retention: float,
+    ) -> None:
+        self.db = db
+        self.runners = runners
+        # called with the job, its outcome and the state it ended up in
+        self.on_done = on_done
+        self.slots = slots
+        self.lease = lease
+        self.retry_delay = retry_delay
+        self.batch_wait = batch_wait
+        self.retention = retention
+        # identifies this server's leases
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        self.wake = asyncio.Event()
+        self.tasks: list[asyncio.Task] = []
+        self.running = 0
+        # smoothed seconds a single job takes, for Retry-After estimates
+        self.job_duration = 1.0
+        self.last_prune = 0.0
+
+    def start(self) -> None:
+        self.tasks = [
+            asyncio.create_task(self.run_slot(slot)) for slot in range(self.slots)
+        ]
+
+    async def stop(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def notify(self) -> None:
+        """Wakes the slots after a job was queued"""
+        self.wake.set()
+
+    async def wait(self, next_at: float | None) -> None:
+        """Waits for notify, or until next_at when the next job is ready by itself"""
+        timeout = PRUNE_INTERVAL
+        if next_at is not None:
+            timeout = min(max(next_at - datetime.now().timestamp(), 0), timeout)
+        try:
+            await asyncio.wait_for(self.wake.wait(), timeout)
+            # give jobs queued right after this one the chance to join its batch
+            await asyncio.sleep(self.batch_wait)
+        except TimeoutError:
+            pass
+        self.wake.clear()
+
+    async def claim(
+        self, owner: str, batch_sizes: dict[str, int]
+    ) -> tuple[list[JobRow], float | None]:
+        """
+        Claims a batch of jobs if one is ready, otherwise returns when the
+        next one will be. Checking first keeps idle slots off the write lock
+        the capture loop needs.
+        """
+        next_at = await self.db.fetch_next_job_at(list(batch_sizes))
+        if next_at is None or next_at > datetime.now().timestamp():
+            return ([], next_at)
+        jobs = await self.db.claim_jobs(owner, self.lease, batch_sizes)
+        if len(jobs) == 0:
+            # another slot got to them first
+            next_at = await self.db.fetch_next_job_at(list(batch_sizes))
+        return (jobs, next_at)
+
+    async def run_slot(self, slot: int) -> None:
+        owner = f"{self.owner}:{slot}"
+        batch_sizes = {
+            kind: runner.batch_size
+            for kind, runner in sorted(
+                self.runners.items(), key=lambda item: -item[1].priority
+            )
+        }
+        while True:
+            try:
+                (jobs, next_at) = await self.claim(owner, batch_sizes)
+            except Exception as e:
+                print(f"Failed to claim jobs: {e}")
+                (jobs, next_at) = ([], datetime.now().timestamp() + self.retry_delay)
+            if len(jobs) == 0:
+                await self.prune()
+                await self.wait(next_at)
+                continue
+            await self.run(owner, jobs)
+
+    async def run(self, owner: str, jobs: list[JobRow]) -> None:
+        print(f"Running {len(jobs)} {jobs[0].kind} jobs")
+        job_ids = [job.id for job in jobs]
+        keep_leases = asyncio.create_task(self.keep_leases(owner, job_ids))
+        self.running += len(jobs)
+        start = time.monotonic()
+        try:
+            outcomes = await self.runners[jobs[0].kind].run(jobs)
+        except Exception as e:
+            outcomes = [e] * len(jobs)
+        finally:
+            self.running -= len(jobs)
+            keep_leases.cancel()
+        duration = (time.monotonic() - start) / len(jobs)
+        self.job_duration += DURATION_SMOOTHING * (duration - self.job_duration)
+        for job, outcome in zip(jobs, outcomes, strict=False):
+            if isinstance(outcome, BaseException):
+                print(f"Job {job.id} failed on attempt {job.attempts}: {outcome}")
+                state = await self.db.fail_job(
+                    job.id, owner, str(outcome), self.retry_delay
+                )
+            else:
+                await self.db.complete_job(job.id, owner)
+                state = JobState.DONE
+            if state == JobState.QUEUED:
+                # idle slots were waiting on its lease, not its backoff
+                self.notify()
+            if state is not None:
+                self.on_done(job, outcome, state)
+
+    async def keep_leases(self, owner: str, job_ids: list[int]) -> None:
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                await self.db.extend_job_leases(job_ids, owner, self.lease)
+            except Exception as e:
+                print(f"Failed to extend job leases: {e}")
+
+    async def prune(self) -> None:
+        now = datetime.now().timestamp()
+        if now - self.last_prune < PRUNE_INTERVAL:
+            return
+        self.last_prune = now
+        pruned = await self.db.prune_jobs(now - self.retention)
+        if pruned > 0:
+            print(f"Pruned {pruned} done jobs")
+
+    def retry_after(self, depth: int) -> int:
+        """Seconds until a backlog of depth jobs is likely worked off"""
+        return max(1, math.ceil(depth * self.job_duration / self.slots))
+
+    def stats(self) -> dict:
+        return {
+            "slots": self.slots,
+            "running": self.running,
+            "job_seconds": self.job_duration,
+        }
+
+
+def admission(depth: int, priority: int, soft_limit: int, limit: int) -> int | None:
+    """
+    Status to turn a new job away with given the number of jobs already
+    queued or running, None to accept it. Past soft_limit only jobs of
+    positive priority are still taken, so the cheaper, more urgent kinds
+    keep flowing while a burst is worked off. Past limit nothing is.
+    """
+    if depth >= limit:
+        return 503
+    if depth >= soft_limit and priority <= 0:
+        return 429
+    return None
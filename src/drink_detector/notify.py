@@ -0,0 +1,21 @@
+import queue
+
+# set in processes that complete captures outside the server process,
+# a multiprocessing.Manager queue read by broker.forward_notifications
+_notify_queue: queue.Queue | None = None
+
+
+def set_notify_queue(notify_queue: queue.Queue | None) -> None:
+    global _notify_queue
+    _notify_queue = notify_queue
+
+
+def notify_capture(capture_id: int) -> None:
+    """Tells the server a capture was completed, if this process has a way to"""
+    if _notify_queue is None:
+        return
+    try:
+        _notify_queue.put_nowait(capture_id)
+    except Exception as e:
+        # the server falls back to noticing the change in the database
+        print(f"Failed to notify server of capture {capture_id}: {e}")
@@ -0,0 +1,335 @@
+import asyncio
+import contextlib
+import hmac
+import json
+import os
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+
+# longest line of JSON either side sends, batches of annotated images
+# being the largest
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+# seconds a worker waits before connecting to the server again
+RECONNECT_DELAY = 2
+# weight of the latest call in a worker's average latency
+LATENCY_SMOOTHING = 0.2
+
+
+class WorkerGone(Exception):
+    """The worker running a call disconnected or stopped answering"""
+
+
+class RemoteError(Exception):
+    """A call that raised on the worker"""
+
+
+class NoWorkers(Exception):
+    pass
+
+
+async def listen(address: str, handler) -> asyncio.Server:
+    """Accepts connections on host:port or unix:path"""
+    if address.startswith("unix:"):
+        path = address.removeprefix("unix:")
+        # left behind by a server that didn't shut down cleanly
+        if os.path.exists(path):
+            os.remove(path)
+        return await asyncio.start_unix_server(handler, path, limit=MAX_MESSAGE_SIZE)
+    (host, port) = address.rsplit(":", 1)
+    return await asyncio.start_server(handler, host, int(port), limit=MAX_MESSAGE_SIZE)
+
+
+async def connect(address: str) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    if address.startswith("unix:"):
+        return await asyncio.open_unix_connection(
+            address.removeprefix("unix:"), limit=MAX_MESSAGE_SIZE
+        )
+    (host, port) = address.rsplit(":", 1)
+    return await asyncio.open_connection(host, int(port), limit=MAX_MESSAGE_SIZE)
+
+
+async def send(writer: asyncio.StreamWriter, message: dict) -> None:
+    """Messages are single lines of JSON"""
+    writer.write(json.dumps(message).encode() + b"\n")
+    await writer.drain()
+
+
+async def receive(reader: asyncio.StreamReader) -> dict | None:
+    """The next message, or None once the other side hung up"""
+    line = await reader.readline()
+    if not line:
+        return None
+    return json.loads(line)
+
+
+class RemoteWorker:
+    """A worker connected to the server, and the calls it's running"""
+
+    def __init__(
+        self, name: str, kinds: list[str], capacity: int, writer: asyncio.StreamWriter
+    ) -> None:
+        self.name = name
+        # kinds of job it has the models loaded for
+        self.kinds = kinds
+        # calls it runs at once
+        self.capacity = capacity
+        self.writer = writer
+        # call id to the future of its result
+        self.calls: dict[int, asyncio.Future] = {}
+        self.running = 0
+        # smoothed seconds a call takes
+        self.latency: float | None = None
+        self.completed = 0
+
+    def load(self) -> float:
+        return self.running / self.capacity
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "kinds": self.kinds,
+            "capacity": self.capacity,
+            "running": self.running,
+            "completed": self.completed,
+            "latency": self.latency,
+        }
+
+
+class WorkerPool:
+    """
+    The server's side of the workers started with `poetry run worker`. They
+    connect to address and register the kinds of job they run and how many
+    at once, along with token, which is required for listening on TCP, as
+    anyone who can connect could otherwise pose as a worker. Each call goes
+    to the least loaded worker that runs its kind, the faster one on a tie.
+    Workers are pinged every ping_interval seconds and dropped if they
+    don't answer within ping_timeout, failing the calls they were running.
+    """
+
+    def __init__(
+        self, address: str, ping_interval: float, ping_timeout: float, token: str = ""
+    ) -> None:
+        self.address = address
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.token = token
+        self.workers: list[RemoteWorker] = []
+        # notified whenever a worker joins, leaves or finishes a call
+        self.changed = asyncio.Condition()
+        self.next_id = 0
+        self.server: asyncio.Server | None = None
+        self.health_task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        if not self.address.startswith("unix:") and not self.token:
+            raise ValueError(
+                "workers connecting over TCP need a token, see WORKER_TOKEN"
+            )
+        self.server = await listen(self.address, self.handle)
+        self.health_task = asyncio.create_task(self.check_health())
+        print(f"Waiting for inference workers on {self.address}")
+
+    async def stop(self) -> None:
+        if self.health_task is not None:
+            self.health_task.cancel()
+        if self.server is None:
+            return
+        self.server.close()
+        for worker in self.workers:
+            worker.writer.close()
+        # lets the connection handlers clean up
+        await self.server.wait_closed()
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            message = await asyncio.wait_for(receive(reader), self.ping_timeout)
+            register = message["register"]
+            if not hmac.compare_digest(
+                str(register.get("token", "")).encode(), self.token.encode()
+            ):
+                raise PermissionError("wrong token")
+            worker = RemoteWorker(
+                str(register["name"]),
+                list(register["kinds"]),
+                max(1, int(register["capacity"])),
+                writer,
+            )
+        except Exception as e:
+            print(f"Rejected worker connection: {e!r}")
+            writer.close()
+            return
+        print(
+            f"Worker {worker.name} registered for {', '.join(worker.kinds)},"
+            f" capacity {worker.capacity}"
+        )
+        async with self.changed:
+            self.workers.append(worker)
+            self.changed.notify_all()
+        try:
+            while (message := await receive(reader)) is not None:
+                future = worker.calls.pop(message.get("id"), None)
+                if future is None or future.done():
+                    continue
+                if "error" in message:
+                    future.set_exception(RemoteError(message["error"]))
+                else:
+                    future.set_result(message.get("result"))
+        except (OSError, ValueError) as e:
+            # ValueError is a malformed or oversized message
+            print(f"Lost worker {worker.name}: {e!r}")
+        finally:
+            print(f"Worker {worker.name} left")
+            writer.close()
+            for future in worker.calls.values():
+                if not future.done():
+                    future.set_exception(WorkerGone(f"worker {worker.name} left"))
+            worker.calls.clear()
+            async with self.changed:
+                self.workers.remove(worker)
+                self.changed.notify_all()
+
+    async def request(
+        self, worker: RemoteWorker, method: str, params: object
+    ) -> object:
+        self.next_id += 1
+        id = self.next_id
+        future = asyncio.get_running_loop().create_future()
+        worker.calls[id] = future
+        try:
+            await send(worker.writer, {"id": id, "method": method, "params": params})
+        except OSError as e:
+            worker.calls.pop(id, None)
+            raise WorkerGone(f"couldn't reach worker {worker.name}: {e!r}") from e
+        try:
+            return await future
+        finally:
+            worker.calls.pop(id, None)
+
+    async def acquire(self, kind: str) -> RemoteWorker:
+        async with self.changed:
+            while True:
+                free = [
+                    worker
+                    for worker in self.workers
+                    if kind in worker.kinds and worker.running < worker.capacity
+                ]
+                if len(free) > 0:
+                    worker = min(
+                        free, key=lambda worker: (worker.load(), worker.latency or 0)
+                    )
+                    worker.running += 1
+                    return worker
+                await self.changed.wait()
+
+    async def call(self, kind: str, params: object, wait: float) -> object:
+        """
+        Runs a job on a worker, waiting at most wait seconds for one to
+        have room for it
+        """
+        try:
+            worker = await asyncio.wait_for(self.acquire(kind), wait)
+        except TimeoutError as e:
+            raise NoWorkers(f"no worker free to run {kind} jobs") from e
+        start = time.monotonic()
+        try:
+            result = await self.request(worker, kind, params)
+        finally:
+            async with self.changed:
+                worker.running -= 1
+                self.changed.notify_all()
+        duration = time.monotonic() - start
+        if worker.latency is None:
+            worker.latency = duration
+        else:
+            worker.latency += LATENCY_SMOOTHING * (duration - worker.latency)
+        worker.completed += 1
+        return result
+
+    async def check_health(self) -> None:
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            await asyncio.gather(*(self.ping(worker) for worker in list(self.workers)))
+
+    async def ping(self, worker: RemoteWorker) -> None:
+        try:
+            await asyncio.wait_for(
+                self.request(worker, "ping", None), self.ping_timeout
+            )
+        except Exception as e:
+            print(f"Worker {worker.name} failed its health check: {e!r}")
+            # its connection handler cleans up
+            worker.writer.close()
+
+    def stats(self) -> dict:
+        return {
+            "address": self.address,
+            "workers": [worker.stats() for worker in self.workers],
+        }
+
+
+async def run_worker(
+    address: str,
+    name: str,
+    kinds: list[str],
+    capacity: int,
+    run: Callable[[str, object], object],
+    token: str = "",
+) -> None:
+    """
+    The worker's side, connects to the server at address, reconnecting
+    whenever it goes away, and answers its calls. run is called with the
+    kind of job and its params, in a thread so pings are still answered.
+    """
+    executor = ThreadPoolExecutor(capacity)
+    register = {"name": name, "kinds": kinds, "capacity": capacity, "token": token}
+    while True:
+        try:
+            (reader, writer) = await connect(address)
+        except OSError as e:
+            print(
+                f"Couldn't connect to {address}: {e!r}, retrying in {RECONNECT_DELAY}s"
+            )
+            await asyncio.sleep(RECONNECT_DELAY)
+            continue
+        print(f"Connected to {address} as {name}")
+        tasks = set()
+        try:
+            await send(writer, {"register": register})
+            while (message := await receive(reader)) is not None:
+                task = asyncio.create_task(answer(writer, message, run, executor))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            print("Server closed the connection")
+        except (OSError, ValueError) as e:
+            print(f"Lost connection to {address}: {e!r}")
+        finally:
+            writer.close()
+        # whatever was still running is retried by the server
+        await asyncio.sleep(RECONNECT_DELAY)
+
+
+async def answer(
+    writer: asyncio.StreamWriter,
+    message: dict,
+    run: Callable[[str, object], object],
+    executor: ThreadPoolExecutor,
+) -> None:
+    id = message.get("id")
+    method = message.get("method")
+    if method == "ping":
+        reply = {"id": id, "result": None}
+    else:
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(
+                executor, run, method, message.get("params")
+            )
+            reply = {"id": id, "result": result}
+        except Exception as e:
+            print(f"Failed to run {method} call {id}: {e!r}")
+            reply = {"id": id, "error": f"{type(e).__name__}: {e}"}
+    # the server retries the job once it notices the connection is gone
+    with contextlib.suppress(OSError):
+        await send(writer, reply)
@@ -4,60 +4,304 @@ import multiprocessing
 from asyncio import Event
 from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from typing import Optional
 from uuid import UUID, uuid4
 
 from quart import (
     Quart,
     Response,
     abort,
-    g,
     render_template,
     request,
-    send_from_directory,
+    send_file,
+    url_for,
 )
-
-from .broker import FeedBroker, ServerSentEvent, send_feed_updates, update_check
-from .db import CaptureCreatedBy, CaptureType, Db
-from .files import save_orig
-from .tasks import drink_detection, similarity
+from werkzeug.security import safe_join
+
+from .async_db import AsyncDb
+from .broker import (
+    FeedBroker,
+    ServerSentEvent,
+    close_on_shutdown,
+    forward_notifications,
+    send_feed_updates,
+    update_check,
+)
+from .db import (
+    PAGINATION_SIZE,
+    SERIES_RESOLUTIONS,
+    CaptureCreatedBy,
+    CaptureCursor,
+    CaptureRow,
+    CaptureType,
+    ConnectionPool,
+    JobRow,
+    JobState,
+    is_detection_result,
+)
+from .embeddings import EmbeddingStore
+from .ingest import ingest_image_set, ingest_images
+from .jobs import JobDispatcher, JobRunner, admission
+from .rpc import WorkerPool
+from .snapshot import SnapshotCache
+from .tasks import drink_detection, similarity, workers
+from .thumbnails import ThumbnailCache, content_hash
+
+# most buckets a single /stock/history response returns, the finest
+# resolution that fits the range is used
+MAX_SERIES_POINTS = 1500
+# seconds covered by each /stock/history?range= preset
+SERIES_RANGES = {
+    "day": 24 * 60 * 60,
+    "week": 7 * 24 * 60 * 60,
+    "month": 31 * 24 * 60 * 60,
+}
+# stored images never change, so browsers may keep them for a year
+IMAGE_MAX_AGE = 365 * 24 * 60 * 60
+# most captures a single history page can ask for
+MAX_PAGE_SIZE = 100
+# most similar captures a single /similar response returns
+MAX_SIMILAR_COUNT = 100
 
 app = Quart(__name__)
-app.background_futures = set()
+# annotated images being rendered on demand, keyed by capture id
+app.rendering: dict[int, asyncio.Task] = dict()
+# created once the config is loaded, see open_thumbnails
+app.thumbnails: ThumbnailCache | None = None
+app.embeddings: EmbeddingStore | None = None
+
+
+# created once the config is loaded, see open_db
+app.db_pool: ConnectionPool | None = None
+app.db: AsyncDb | None = None
+app.snapshot: SnapshotCache | None = None
+# replaced with one sized from the config, see manage_update_check
+app.broker: FeedBroker = FeedBroker()
+app.feed_shutdown_event: Event = Event()
+app.update_now_event: Event = Event()
+app.process_pool_executor: ProcessPoolExecutor = ProcessPoolExecutor()
+# created once the config is loaded, see start_inference_workers
+app.inference_executor: ProcessPoolExecutor | None = None
+app.dispatcher: JobDispatcher | None = None
+# set instead of inference_executor when the workers run on their own
+app.worker_pool: WorkerPool | None = None
+app.process_pool_manager: multiprocessing.Manager = multiprocessing.Manager()
+app.capture_loop_process: asyncio.Future | None = None
+app.capture_loop_stop: multiprocessing.Event = app.process_pool_manager.Event()
+# capture ids completed by the capture loop
+app.capture_notify_queue: multiprocessing.Queue = app.process_pool_manager.Queue()
 
 
-def get_db() -> Db:
-    if "db" not in g:
-        db = Db(app.config["DB"])
-        g.db = db
+@app.before_serving
+async def open_db():
+    app.db_pool = ConnectionPool.from_config(app.config)
+    app.db = AsyncDb(app.db_pool, app.config["DB_READER_THREADS"])
+    await app.db.migrate()
+    app.snapshot = SnapshotCache(app.db, app.config["STOCK_TYPES_BY_QUERY"])
 
-    return g.db
 
+# registered ahead of close_db, as after_serving functions run in order
+@app.after_serving
+async def stop_dispatcher():
+    if app.dispatcher is not None:
+        await app.dispatcher.stop()
 
-def close_db():
-    db = g.pop("db", None)
-    if db is not None:
-        db.close()
 
+@app.after_serving
+async def close_db():
+    if app.db is not None:
+        app.db.close()
+    if app.db_pool is not None:
+        app.db_pool.close()
 
-app.broker: FeedBroker = FeedBroker()
-app.feed_shutdown_event: Event = Event()
-app.update_now_event: Event = Event()
-app.process_pool_executor: ProcessPoolExecutor = ProcessPoolExecutor()
-app.process_pool_manager: multiprocessing.Manager = multiprocessing.Manager()
-app.capture_loop_process: Optional[asyncio.Future] = None
-app.capture_loop_stop: multiprocessing.Event = app.process_pool_manager.Event()
+
+@app.before_serving
+async def open_thumbnails():
+    app.thumbnails = ThumbnailCache(
+        app.config["THUMB_DIR"],
+        app.config["THUMB_WIDTHS"],
+        app.config["THUMB_CACHE_SIZE"] * 1024 * 1024,
+    )
+
+
+@app.before_serving
+async def open_embeddings():
+    app.embeddings = EmbeddingStore(
+        app.config["EMBEDDINGS_DIR"], app.config["IMG_FEAT_MODEL"]
+    )
 
 
 @app.before_serving
 async def manage_update_check():
+    app.broker = FeedBroker(
+        app.config["SSE_BUFFER_SIZE"], app.config["SSE_OVERFLOW_POLICY"]
+    )
+    app.add_background_task(close_on_shutdown, app.broker, app.feed_shutdown_event)
     app.add_background_task(
         update_check,
-        app.config["DB"],
+        app.snapshot,
         app.broker,
         app.feed_shutdown_event,
         app.update_now_event,
     )
+    app.add_background_task(
+        forward_notifications,
+        app.capture_notify_queue,
+        app.feed_shutdown_event,
+        app.update_now_event,
+    )
+
+
+@app.before_serving
+async def start_inference_workers():
+    if app.config["WORKER_LISTEN"]:
+        app.worker_pool = WorkerPool(
+            app.config["WORKER_LISTEN"],
+            app.config["WORKER_PING_INTERVAL"],
+            app.config["WORKER_PING_TIMEOUT"],
+            app.config["WORKER_TOKEN"],
+        )
+        await app.worker_pool.start()
+        slots = app.config["WORKER_SLOTS"]
+    else:
+        slots = app.config["WORKER_COUNT"]
+        print(f"Starting {slots} inference workers")
+        app.inference_executor = ProcessPoolExecutor(
+            max_workers=slots,
+            initializer=workers.init_worker,
+            initargs=(app.config,),
+        )
+        # the pool only starts processes on demand, so give each a job to
+        # have the models loaded before the first request comes in
+        for _ in range(slots):
+            app.inference_executor.submit(workers.ready)
+
+    def runner(kind: str, task, batch_size: int = 1, priority: int = 0) -> JobRunner:
+        """
+        Runs jobs with task's prepare_jobs, workers.run_jobs on a worker,
+        then task's save_result, so only the server writes to the database
+        """
+
+        async def run(jobs: list[JobRow]) -> list:
+            prepared = await task.prepare_jobs(app.db, app.config, app.embeddings, jobs)
+            calls = [
+                i for (i, params) in enumerate(prepared) if isinstance(params, dict)
+            ]
+            if len(calls) > 0:
+                params = [prepared[i] for i in calls]
+                if app.worker_pool is not None:
+                    # waits as long as the dispatcher would hold on to the jobs
+                    outcomes = await app.worker_pool.call(
+                        kind, params, app.config["JOB_LEASE"]
+                    )
+                else:
+                    outcomes = await asyncio.get_running_loop().run_in_executor(
+                        app.inference_executor,
+                        workers.run_jobs,
+                        kind,
+                        params,
+                        app.config,
+                    )
+                for i, outcome in zip(calls, outcomes, strict=True):
+                    prepared[i] = (
+                        Exception(outcome["error"])
+                        if "error" in outcome
+                        else outcome["result"]
+                    )
+            results = []
+            for job, result in zip(jobs, prepared, strict=True):
+                if isinstance(result, Exception):
+                    results.append(result)
+                    continue
+                try:
+                    results.append(
+                        await task.save_result(
+                            app.db, app.config, app.embeddings, job, result
+                        )
+                    )
+                except Exception as e:
+                    results.append(e)
+            return results
+
+        return JobRunner(run, batch_size, priority)
+
+    app.dispatcher = JobDispatcher(
+        app.db,
+        {
+            # single uploads are quick and someone is waiting on the feed,
+            # so they go first and are still taken when the queue is long
+            "detection": runner(
+                "detection", drink_detection, app.config["DETECTION_BATCH_SIZE"], 1
+            ),
+            "similarity": runner("similarity", similarity),
+        },
+        on_job_done,
+        slots,
+        app.config["JOB_LEASE"],
+        app.config["JOB_RETRY_DELAY"],
+        app.config["DETECTION_BATCH_WAIT"],
+        app.config["JOB_RETENTION"],
+    )
+    app.dispatcher.start()
+
+
+def on_job_done(job: JobRow, outcome: object, state: JobState) -> None:
+    print(f"{job.kind.capitalize()} job {job.id} is {state.value}")
+    match job.kind:
+        case "detection":
+            app.update_now_event.set()
+        case "similarity" if state != JobState.QUEUED:
+            if state == JobState.DONE:
+                app.update_now_event.set()
+            # null tells the page the comparison failed
+            matrix = outcome if state == JobState.DONE else None
+            app.broker.publish(
+                ServerSentEvent(json.dumps(matrix), "similarity"),
+                UUID(job.payload["uuid"]),
+            )
+
+
+async def overloaded(kind: str) -> Response | None:
+    """
+    A 429 or 503 response telling the client when to come back if the job
+    queue is too long to take another job of this kind, see jobs.admission
+    """
+    depth = await app.db.fetch_job_depth()
+    status = admission(
+        depth,
+        app.dispatcher.runners[kind].priority,
+        app.config["JOB_QUEUE_SOFT_LIMIT"],
+        app.config["JOB_QUEUE_LIMIT"],
+    )
+    if status is None:
+        return None
+    retry_after = app.dispatcher.retry_after(depth)
+    print(
+        f"Turning away {kind} request with {depth} jobs queued,"
+        f" retry after {retry_after}s"
+    )
+    return Response(
+        f"Too many requests queued, try again in {retry_after} seconds",
+        status,
+        {"Retry-After": str(retry_after)},
+    )
+
+
+@app.after_serving
+async def stop_inference_workers():
+    if app.inference_executor is not None:
+        app.inference_executor.shutdown(wait=False, cancel_futures=True)
+    if app.worker_pool is not None:
+        await app.worker_pool.stop()
+
+
+@app.context_processor
+async def label_colors():
+    """Colors the pages draw each detected label's boxes in"""
+    (query_items, _) = drink_detection.setup_query(app.config)
+    return {
+        "_label_colors": query_items,
+        "_other_color": app.config["OTHER_COLOR"],
+    }
 
 
 async def render(template_file, **kwargs):
@@ -72,50 +316,200 @@ async def render(template_file, **kwargs):
                 "Request",
                 ["capture_request_accept", "similarity_request_accept"],
             ),
-            ("stock", "Stock", [])
+            ("stock", "Stock", []),
         ],
-        _capture_task_active=app.capture_loop_process is not None and app.capture_loop_process.is_alive(),
+        _capture_task_active=app.capture_loop_process is not None
+        and app.capture_loop_process.is_alive(),
     )
 
 
 @app.route("/feed")
 async def feed():
-    db = get_db()
-    capture = db.fetch_latest_capture()
+    capture = (await app.snapshot.get()).capture
     if capture is None:
         return await render("empty_feed.html")
     return await render("feed.html", capture=capture)
 
 
-@app.route("/image/<run>", defaults={"ind": 0})
-@app.route("/image/<run>/<int:ind>")
+async def render_annotated(capture_id: int) -> str | None:
+    """
+    Renders and stores the annotated image of a capture saved without one,
+    see STORE_ANNOTATED. None if the capture has no detections to draw.
+    """
+    db = app.db
+    result = await db.fetch_result(capture_id)
+    if not is_detection_result(result):
+        return None
+    filename = await db.fetch_image_for_capture(capture_id, CaptureType.ORIG, 0)
+    if filename is None:
+        return None
+    anno_filename = await asyncio.to_thread(
+        drink_detection.render_annotated, app.config, capture_id, filename, result
+    )
+    await db.commit_unit(
+        db.unit_of_work(capture_id).add_file(
+            anno_filename, CaptureType.ANNO, datetime.now()
+        )
+    )
+    return anno_filename
+
+
+@app.route("/image/<int:run>", defaults={"ind": 0})
+@app.route("/image/<int:run>/<int:ind>")
 async def image(run, ind):
-    db = get_db()
+    db = app.db
     if "annotated" in request.args:
         typ = CaptureType.ANNO
         dir = app.config["ANNO_DIR"]
     else:
         typ = CaptureType.ORIG
         dir = app.config["ORIG_DIR"]
-    filename = db.fetch_image_for_capture(run, typ, ind)
+    filename = await db.fetch_image_for_capture(run, typ, ind)
+    if filename is None and typ == CaptureType.ANNO and ind == 0:
+        # concurrent requests for the same capture share one render
+        if run not in app.rendering:
+            app.rendering[run] = asyncio.create_task(render_annotated(run))
+            app.rendering[run].add_done_callback(lambda _: app.rendering.pop(run, None))
+        filename = await asyncio.shield(app.rendering[run])
     if filename is None:
         abort(404)
-    return await send_from_directory(dir, filename)
 
+    path = safe_join(dir, filename)
+    if path is None:
+        abort(404)
+    try:
+        etag = await content_hash(path)
+    except OSError:
+        abort(404)
+    width = request.args.get("w", type=int)
+    if width is not None:
+        width = app.thumbnails.fit_width(width)
+        etag = f"{etag}-w{width}"
+    if request.if_none_match.contains(etag):
+        return cache_forever(Response(status=304), etag)
+    if width is not None:
+        path = await app.thumbnails.get(path, width)
+    response = await send_file(path, add_etags=False, conditional=True)
+    return cache_forever(response, etag)
+
+
+def cache_forever(response: Response, etag: str) -> Response:
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = IMAGE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+
+@app.route("/similar/<int:run>", defaults={"ind": 0})
+@app.route("/similar/<int:run>/<int:ind>")
+async def similar(run, ind):
+    """
+    The past captures whose original images look most like this capture's,
+    as JSON, searching the stored embeddings. ?k= sets how many.
+    """
+    k = min(
+        request.args.get("k", app.config["SIMILAR_COUNT"], type=int), MAX_SIMILAR_COUNT
+    )
+    if k < 1:
+        abort(400)
+    file_id = await app.db.fetch_file_id_for_capture(run, CaptureType.ORIG, ind)
+    if file_id is None:
+        abort(404)
+    vector = await asyncio.to_thread(app.embeddings.get, file_id)
+    if vector is None:
+        # not embedded yet, or from before embeddings were stored
+        abort(404)
+    matches = await asyncio.to_thread(app.embeddings.search, vector, k, {file_id})
+    captures = await app.db.fetch_captures_for_files(
+        [file_id for (file_id, _) in matches]
+    )
+    return {
+        "capture_id": run,
+        "model": app.embeddings.model,
+        "matches": [
+            {
+                "file_id": match_id,
+                "similarity": score,
+                "capture_ids": [capture_id for (capture_id, _) in captures[match_id]],
+                "image": url_for(
+                    "image", run=captures[match_id][0][0], ind=captures[match_id][0][1]
+                ),
+            }
+            for (match_id, score) in matches
+            if len(captures[match_id]) > 0
+        ],
+    }
 
-@app.route("/feed/sse", defaults={"uuid":None})
+
+@app.route("/feed/sse", defaults={"uuid": None})
 @app.route("/feed/sse/<uuid:uuid>")
-async def feed_sse(uuid: Optional[UUID]):
-    return await send_feed_updates(app.broker, app.feed_shutdown_event, uuid)
+async def feed_sse(uuid: UUID | None):
+    return await send_feed_updates(app.broker, uuid)
+
+
+def format_cursor(cursor: CaptureCursor) -> str:
+    return f"{cursor[0]}:{cursor[1]}"
+
+
+def parse_cursor(cursor: str) -> CaptureCursor:
+    captured_at, id = cursor.split(":")
+    return (float(captured_at), int(id))
+
+
+def history_filters() -> dict:
+    """Reads the paging and filtering query parameters of the history views"""
+    args = request.args
+    try:
+        limit = min(int(args.get("limit", PAGINATION_SIZE)), MAX_PAGE_SIZE)
+        # SQLite reads a negative LIMIT as no limit at all
+        if limit < 1:
+            abort(400)
+        return {
+            "limit": limit,
+            "cap_type": [CaptureCreatedBy(v) for v in args.getlist("created_by")]
+            or None,
+            "after": parse_cursor(args["after"]) if "after" in args else None,
+            "since": float(args["since"]) if "since" in args else None,
+            "until": float(args["until"]) if "until" in args else None,
+        }
+    except ValueError:
+        abort(400)
+
+
+def next_page_url(captures: list[CaptureRow], limit: int) -> str | None:
+    if len(captures) < limit:
+        return None
+    args = request.args.to_dict(flat=False)
+    args["after"] = format_cursor(captures[-1].cursor)
+    return url_for("history_page", **args)
 
 
 @app.route("/history")
 async def history():
-    db = get_db()
-    captures = db.fetch_captures()
+    db = app.db
+    filters = history_filters()
+    captures = await db.fetch_captures(**filters)
     if len(captures) == 0:
         return await render("empty_feed.html")
-    return await render("history.html", captures=captures)
+    return await render(
+        "history.html",
+        captures=captures,
+        next_page=next_page_url(captures, filters["limit"]),
+    )
+
+
+@app.route("/history/page")
+async def history_page():
+    db = app.db
+    filters = history_filters()
+    captures = await db.fetch_captures(**filters)
+    return {
+        "captures": [capture.to_dict() for capture in captures],
+        "next": format_cursor(captures[-1].cursor) if len(captures) > 0 else None,
+        "next_page": next_page_url(captures, filters["limit"]),
+        "html": await render_template("history_items.html", captures=captures),
+    }
 
 
 @app.route("/request")
@@ -123,86 +517,128 @@ async def request_form():
     return await render(
         "request_form.html",
         obj_det_model=app.config["OBJ_DET_MODEL"],
-        img_feat_model=app.config["IMG_FEAT_MODEL"]
+        img_feat_model=app.config["IMG_FEAT_MODEL"],
+        similarity_max_images=app.config["SIMILARITY_MAX_IMAGES"],
     )
 
 
 @app.route("/detection_request", methods=["POST"])
 async def detection_request_accept():
-    image = (await request.files)["image"]
-    db = get_db()
+    db = app.db
     dt = datetime.now()
-    try:
-        file_id = await save_orig(db, app.config, image.stream, image.mimetype, dt)
-        capture_id = db.create_capture_with_files(
-            uuid4(),
-            app.config["OBJ_DET_MODEL"],
-            CaptureCreatedBy.REQUEST,
-            dt,
-            [file_id]
+    rejected = await overloaded("detection")
+    if rejected is not None:
+        return rejected
+    (image,) = await ingest_images(app.config, request, ["image"])
+    model = app.config["OBJ_DET_MODEL"]
+    (_, query) = drink_detection.setup_query(app.config)
+    uow = (
+        db.unit_of_work()
+        .create_capture(uuid4(), model, CaptureCreatedBy.REQUEST, dt)
+        .add_file(image.filename, CaptureType.ORIG, datetime.now(), image.sha256)
+    )
+    cached = await db.fetch_cached_result(image.sha256, model, query)
+    if cached is not None:
+        print("Image already processed, reusing its result")
+        await db.commit_unit(uow.complete(cached, datetime.now()))
+        app.update_now_event.set()
+        return await render("detection_result.html", cached=True)
+    print("Queueing image processing job")
+    # queued with the capture, so it's processed even if the server goes away now
+    await db.commit_unit(
+        uow.enqueue(
+            "detection", {"dt": dt.timestamp()}, 1, app.config["JOB_MAX_ATTEMPTS"]
         )
-    except OSError:
-        abort(400)
-
-    print("Starting image processing task")
-    process_future = asyncio.get_event_loop().run_in_executor(
-        app.process_pool_executor,
-        drink_detection.setup_and_process_image,
-        capture_id,
-        file_id,
-        app.config,
-        dt
     )
+    app.dispatcher.notify()
+    return await render("detection_result.html"), 202
 
-    def on_done(future):
-        print("Finished image processing task")
-        app.update_now_event.set()
-        app.background_futures.discard(future)
 
-    process_future.add_done_callback(on_done)
-    app.background_futures.add(process_future)
-    return await render("detection_result.html"), 202
+def parse_capture_ids(values: list[str]) -> list[int]:
+    """Capture ids from form values, each holding some separated by commas or spaces"""
+    try:
+        return [int(id) for value in values for id in value.replace(",", " ").split()]
+    except ValueError:
+        abort(400)
 
 
 @app.route("/similarity_request", methods=["POST"])
 async def similarity_request_accept():
-    files = await request.files
-    db = get_db()
+    """
+    Compares any number of images with each other, uploaded in the images
+    field (or image_1 and image_2) and taken from the earlier captures in
+    capture_ids. Every pair's similarity is computed in one batched run.
+    """
+    db = app.db
     dt = datetime.now()
-    image_1 = files["image_1"]
-    image_2 = files["image_2"]
-    try:
-        img_1_id = await save_orig(db, app.config, image_1.stream, image_1.mimetype, dt, 1)
-        img_2_id = await save_orig(db, app.config, image_2.stream, image_2.mimetype, dt, 2)
-        uuid = uuid4()
-        capture_id = db.create_capture_with_files(
-            uuid,
-            app.config["IMG_FEAT_MODEL"],
-            CaptureCreatedBy.SIMILARITY,
-            dt,
-            [img_1_id, img_2_id]
-        )
-    except OSError:
+    rejected = await overloaded("similarity")
+    if rejected is not None:
+        return rejected
+    max_images = app.config["SIMILARITY_MAX_IMAGES"]
+    (uploads, form) = await ingest_image_set(
+        app.config, request, ["images", "image_1", "image_2"], max_images
+    )
+    capture_ids = parse_capture_ids(form.get("capture_ids", []))
+    if not 2 <= len(uploads) + len(capture_ids) <= max_images:
         abort(400)
-
-    process_future = asyncio.get_event_loop().run_in_executor(
-        app.process_pool_executor,
-        similarity.find_similarity,
-        img_1_id,
-        img_2_id,
-        capture_id,
-        app.config,
+    linked_ids = []
+    for capture_id in capture_ids:
+        file_id = await db.fetch_file_id_for_capture(capture_id, CaptureType.ORIG, 0)
+        if file_id is None:
+            abort(400)
+        linked_ids.append(file_id)
+    uuid = uuid4()
+    model = app.config["IMG_FEAT_MODEL"]
+    uow = db.unit_of_work().create_capture(uuid, model, CaptureCreatedBy.SIMILARITY, dt)
+    for orig in uploads:
+        uow.add_file(orig.filename, CaptureType.ORIG, datetime.now(), orig.sha256)
+    for file_id in linked_ids:
+        uow.link_file(file_id)
+    hashes = await db.fetch_file_hashes(linked_ids)
+    key = similarity.similarity_key(
+        [orig.sha256 for orig in uploads]
+        + [hashes.get(file_id) for file_id in linked_ids]
     )
-
-    def on_done(future):
-        print("Finished image similarity task")
-        sse = ServerSentEvent(f"{future.result() * 100}%", "similarity")
-        asyncio.create_task(app.broker.publish(sse, uuid))
-        app.background_futures.discard(future)
-
-    process_future.add_done_callback(on_done)
-    app.background_futures.add(process_future)
-    return await render("similarity_result.html", capture_id=capture_id, uuid=uuid), 202
+    cached = None
+    if key is not None:
+        cached = await db.fetch_cached_result(key, model, similarity.SIMILARITY_QUERY)
+    if cached is not None:
+        print("Images already compared, reusing the result")
+        capture_id = await db.commit_unit(
+            uow.complete(
+                {"similarity": cached["similarity"]}, datetime.now(), with_file_ids=True
+            )
+        )
+        file_ids = uow.new_file_ids + linked_ids
+        app.update_now_event.set()
+    else:
+        print("Queueing image similarity job")
+        capture_id = await db.commit_unit(
+            uow.enqueue(
+                "similarity", {"uuid": uuid.hex}, 0, app.config["JOB_MAX_ATTEMPTS"]
+            )
+        )
+        file_ids = uow.new_file_ids + linked_ids
+        app.dispatcher.notify()
+    inds = {
+        file_id: ind
+        for (file_id, captures) in (await db.fetch_captures_for_files(file_ids)).items()
+        for (id, ind) in captures
+        if id == capture_id
+    }
+    if cached is not None:
+        return await render(
+            "similarity_result.html",
+            capture_id=capture_id,
+            inds=[inds[file_id] for file_id in file_ids],
+            matrix=cached["similarity"],
+        )
+    return await render(
+        "similarity_result.html",
+        capture_id=capture_id,
+        inds=[inds[file_id] for file_id in file_ids],
+        uuid=uuid,
+    ), 202
 
 
 @app.route("/capture_loop/on", methods=["PUT"])
@@ -214,7 +650,8 @@ async def capture_loop_on():
             app.process_pool_executor,
             drink_detection.drink_detection,
             app.config,
-            app.capture_loop_stop
+            app.capture_loop_stop,
+            app.capture_notify_queue,
         )
         return Response(status=200)
     else:
@@ -231,50 +668,81 @@ async def capture_loop_off():
         app.capture_loop_process.cancel()
         return Response(status=200)
 
+
 @app.route("/stock")
 async def stock():
-    db = get_db()
-    capture = db.fetch_latest_capture([CaptureCreatedBy.LOOP, CaptureCreatedBy.REQUEST])
-    if capture is None:
+    snapshot = await app.snapshot.get()
+    if snapshot.counts is None:
         return await render("empty_feed.html")
-    obj_counts = capture.object_counts()
-    total = sum(obj_counts.values())
-    obj_counts = [
-        (app.config["STOCK_TYPES_BY_QUERY"][key], val)
-        for key, val
-        in obj_counts.items()
-    ]
-    rows = [
-        { "title": st["name"], "amount": val, "categories": st["categories"] }
-        for (st, val)
-        in obj_counts
-        if st is not None
-    ]
     return await render(
         "stock.html",
-        total=total,
-        rows=rows,
-        categories=list(set([cat for row in rows for cat in row["categories"]]))
+        total=snapshot.total,
+        rows=snapshot.rows,
+        categories=snapshot.categories,
     )
 
+
 @app.route("/stock/search")
 async def stock_search():
     query = request.args.get("q") or ""
-    db = get_db()
-    latest = db.fetch_latest_capture([CaptureCreatedBy.LOOP, CaptureCreatedBy.REQUEST])
-    obj_counts = latest.object_counts().items()
-    obj_counts = [(app.config["STOCK_TYPES_BY_QUERY"][key], val) for key, val in obj_counts]
-    if latest is None:
-        res = []
-    else:
-        unfiltered = [
-            { "title": st["name"], "amount": val, "categories": st["categories"] }
-            for (st, val)
-            in obj_counts
-            if st is not None
-        ]
-        res = [row for row in unfiltered if query in row["title"]]
-    return json.dumps({
-        "data": res,
-        "categories": list(set([cat for row in unfiltered for cat in row["categories"]]))
-    })
+    snapshot = await app.snapshot.get()
+    res = [row for row in snapshot.rows if query in row["title"]]
+    return json.dumps(
+        {
+            "data": res,
+            "categories": snapshot.categories,
+        }
+    )
+
+
+@app.route("/stock/history")
+async def stock_history():
+    """
+    Stock levels over time as JSON, for ?range=day|week|month or an explicit
+    ?since=&until= in unix time. Each point covers one bucket and holds the
+    average, max and last count of every label seen in it.
+    """
+    now = datetime.now().timestamp()
+    try:
+        until = float(request.args.get("until", now))
+        if "since" in request.args:
+            since = float(request.args["since"])
+        else:
+            since = until - SERIES_RANGES[request.args.get("range", "day")]
+    except (KeyError, ValueError):
+        abort(400)
+    if since >= until:
+        abort(400)
+    resolution = next(
+        (
+            res
+            for res in sorted(SERIES_RESOLUTIONS)
+            if (until - since) / res <= MAX_SERIES_POINTS
+        ),
+        max(SERIES_RESOLUTIONS),
+    )
+    points = await app.db.fetch_stock_series(resolution, since, until)
+    stock_types = app.config["STOCK_TYPES_BY_QUERY"]
+    return {
+        "since": since,
+        "until": until,
+        "resolution": resolution,
+        "names": {
+            label: stock_types[label]["name"]
+            for label in {label for point in points for label in point["counts"]}
+            if label in stock_types
+        },
+        "points": points,
+    }
+
+
+@app.route("/metrics")
+async def metrics():
+    return {
+        "snapshot": app.snapshot.stats(),
+        "feed": app.broker.stats(),
+        "thumbnails": app.thumbnails.stats(),
+        "embeddings": app.embeddings.stats(),
+        "jobs": {**await app.db.fetch_job_counts(), **app.dispatcher.stats()},
+        "workers": None if app.worker_pool is None else app.worker_pool.stats(),
+    }
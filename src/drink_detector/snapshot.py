@@ -0,0 +1,138 @@
+import asyncio
+import functools
+import json
+from dataclasses import dataclass, field
+
+from quart import current_app
+
+from .async_db import AsyncDb
+from .db import CaptureCreatedBy, CaptureRow, DetectionRow
+
+# captures whose results are stock levels
+STOCK_CAPTURE_TYPES = [CaptureCreatedBy.LOOP, CaptureCreatedBy.REQUEST]
+
+
+def stock_rows(counts: dict[str, int], stock_types: dict) -> list[dict]:
+    return [
+        {"title": st["name"], "amount": val, "categories": st["categories"]}
+        for (st, val) in [(stock_types.get(key), val) for key, val in counts.items()]
+        if st is not None
+    ]
+
+
+@dataclass
+class Snapshot:
+    """The latest capture and the stock levels derived from it"""
+
+    capture: CaptureRow | None
+    # None if there is no completed detection capture yet
+    counts: dict[str, int] | None
+    rows: list[dict] = field(default_factory=list)
+    categories: list[str] = field(default_factory=list)
+
+    @property
+    def total(self) -> int:
+        return sum(self.counts.values()) if self.counts is not None else 0
+
+    @functools.cached_property
+    def payload(self) -> str:
+        """
+        The capture and stock levels as JSON, sent to every feed client so
+        pages can update in place. Built outside of any request, so the image
+        URLs come from the app's url_map directly rather than url_for.
+        """
+        capture = None
+        if self.capture is not None:
+            urls = current_app.url_map.bind("")
+            created_by = self.capture.created_by
+            capture = {
+                **self.capture.to_dict(),
+                "created_by": {
+                    "value": created_by.value,
+                    "title": created_by.title,
+                    "label_type": created_by.label_type,
+                    "label_class": created_by.label_class,
+                },
+                "objects": (
+                    self.capture.objects
+                    if isinstance(self.capture, DetectionRow)
+                    else None
+                ),
+                "images": {
+                    "orig": urls.build("image", {"run": self.capture.id}),
+                    "anno": urls.build(
+                        "image", {"run": self.capture.id, "annotated": True}
+                    ),
+                },
+            }
+            # the objects already carry everything else the raw result does
+            result = capture.pop("result")
+            capture["image_size"] = (
+                result.get("image_size") if isinstance(result, dict) else None
+            )
+        stock = None
+        if self.counts is not None:
+            stock = {
+                "total": self.total,
+                "rows": self.rows,
+            }
+        return json.dumps({"capture": capture, "stock": stock})
+
+
+class SnapshotCache:
+    """
+    Keeps the current Snapshot in memory so the feed and stock pages don't
+    query the database on every hit. update_check invalidates it whenever
+    a capture completes, and the next get loads it again.
+    """
+
+    def __init__(self, db: AsyncDb, stock_types: dict) -> None:
+        self.db = db
+        self.stock_types = stock_types
+        self.snapshot: Snapshot | None = None
+        # bumped by invalidate, so a load that raced with it isn't kept
+        self.generation = 0
+        self.lock = asyncio.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self) -> Snapshot:
+        snapshot = self.snapshot
+        if snapshot is not None:
+            self.hits += 1
+            return snapshot
+        async with self.lock:
+            # loaded by whoever held the lock before us
+            if self.snapshot is not None:
+                self.hits += 1
+                return self.snapshot
+            self.misses += 1
+            generation = self.generation
+            snapshot = await self.load()
+            if generation == self.generation:
+                self.snapshot = snapshot
+            return snapshot
+
+    async def load(self) -> Snapshot:
+        capture = await self.db.fetch_latest_capture()
+        counts = await self.db.fetch_stock_counts(STOCK_CAPTURE_TYPES)
+        if counts is None:
+            return Snapshot(capture, None)
+        rows = stock_rows(counts, self.stock_types)
+        return Snapshot(
+            capture,
+            counts,
+            rows,
+            list(set([cat for row in rows for cat in row["categories"]])),
+        )
+
+    def invalidate(self) -> None:
+        self.generation += 1
+        self.snapshot = None
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "cached": self.snapshot is not None,
+        }
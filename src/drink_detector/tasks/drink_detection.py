@@ -1,23 +1,41 @@
 import asyncio
+import base64
 import multiprocessing
 import os
 import os.path
+import queue
+from dataclasses import dataclass
 from datetime import datetime, timedelta
-from io import BytesIO
 from uuid import uuid4
 
 import cv2 as cv
+import numpy as np
 import torch
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageChops, ImageDraw, ImageFont, ImageStat
 from transformers import AutoModelForZeroShotObjectDetection, AutoProcessor
 
-from drink_detector.db import CaptureCreatedBy, Db
-from drink_detector.files import save_anno, save_raw_orig
+from drink_detector.async_db import AsyncDb
+from drink_detector.db import CaptureCreatedBy, CaptureType, Db, JobRow
+from drink_detector.embeddings import EmbeddingStore
+from drink_detector.files import orig_path, write_anno, write_encoded, write_orig_image
+from drink_detector.image_codec import encode_image, image_codec, save_image
+from drink_detector.notify import notify_capture, set_notify_queue
 
-from . import DEVICE
+from . import DEVICE, similarity
+
+# models already loaded in this process, keyed by model name
+_warm_models: dict[str, tuple] = {}
+# tokenized query, only the current one is kept
+_query_inputs: dict[str, dict] = {}
+# number of distinct input shapes to keep text encoder outputs for
+TEXT_CACHE_SIZE = 4
+# longest time in seconds the capture loop goes without checking for a stop
+STOP_POLL_INTERVAL = 1
+# side length frames are shrunk to before comparing them for changes
+GATE_SIZE = 64
+# seconds between log lines with the frame gate's counts
+GATE_LOG_INTERVAL = 10 * 60
 
-IMG_FMT = "PNG"
-IMG_EXT = ".png"
 
 def open_capture_device(capture_device: int) -> cv.VideoCapture:
     cap = cv.VideoCapture(capture_device)
@@ -37,12 +55,29 @@ def capture_image(cap) -> Image:
     return image
 
 
-def process_image(
-    image: Image, model, query: str, query_items: dict[str, str], other_color, processor, device
-) -> (Image, dict):
-    draw = ImageDraw.Draw(image)
-
-    inputs = processor(images=image, text=query, return_tensors="pt").to(device)
+def process_images(
+    images: list[Image],
+    model,
+    query: str,
+    query_items: dict[str, str],
+    other_color,
+    processor,
+    device,
+    annotate: bool = True,
+) -> list[(Image.Image | None, dict)]:
+    """
+    Runs detection on all images in a single forward pass, annotating each
+    of them unless annotate is False, in which case no image is returned
+    """
+    # the query is the same for every frame, so only the images need preprocessing
+    inputs = processor.image_processor(images=images, return_tensors="pt")
+    inputs.update(
+        {
+            key: val.repeat(len(images), 1)
+            for key, val in tokenize_query(processor, query).items()
+        }
+    )
+    inputs = inputs.to(device)
     with torch.no_grad():
         outputs = model(**inputs)
 
@@ -51,48 +86,173 @@ def process_image(
         inputs.input_ids,
         box_threshold=0.3,
         text_threshold=0.3,
-        target_sizes=[image.size[::-1]],
+        target_sizes=[image.size[::-1] for image in images],
     )
+    # boxes are in pixels of the original, which pages showing a resized
+    # copy need to scale them
+    for image, result in zip(images, results, strict=False):
+        result["image_size"] = list(image.size)
+
+    return [
+        (
+            annotate_image(image, result, query_items, other_color)
+            if annotate
+            else None,
+            result,
+        )
+        for image, result in zip(images, results, strict=False)
+    ]
+
 
-    # only processed one image
-    result = results[0]
-    scores_labels_boxes = list(zip(result["scores"], result["labels"], result["boxes"]))
+def process_image(
+    image: Image,
+    model,
+    query: str,
+    query_items: dict[str, str],
+    other_color,
+    processor,
+    device,
+    annotate: bool = True,
+) -> (Image.Image | None, dict):
+    return process_images(
+        [image], model, query, query_items, other_color, processor, device, annotate
+    )[0]
+
+
+def annotate_image(
+    image: Image, result: dict, query_items: dict[str, str], other_color
+) -> Image:
+    """Draws the boxes in result onto image, which can hold tensors or plain lists"""
+    draw = ImageDraw.Draw(image)
+
+    scores_labels_boxes = list(
+        zip(result["scores"], result["labels"], result["boxes"], strict=False)
+    )
     if len(scores_labels_boxes) == 0:
         print("No objects detected")
     else:
         for score, label, box in scores_labels_boxes:
             print(
                 f"Detected {label} with confidence "
-                f"{round(score.item(), 3)} at location "
+                f"{round(float(score), 3)} at location "
                 f"{box[0]}, {box[1]} to {box[2]}, {box[3]}"
             )
 
     font = ImageFont.load_default()
 
-    for score, label, box in zip(result["scores"], result["labels"], result["boxes"]):
+    for score, label, box in scores_labels_boxes:
         color = query_items.get(label, other_color)
-        x, y, x2, y2 = tuple([round(i.item(), 2) for i in box])
+        x, y, x2, y2 = tuple([round(float(i), 2) for i in box])
         print(x, y, x2, y2)
         draw.rectangle((x, y, x2, y2), outline=color, width=1)
-        text = f"{label}: {round(score.item() * 100, 3)}%"
+        text = f"{label}: {round(float(score) * 100, 3)}%"
         text_left, text_top, text_right, text_bottom = font.getbbox(text)
         text_width = text_right - text_left
         text_height = text_bottom - text_top
         draw.rectangle((x, y, x + text_width, y + text_height), fill=color)
         draw.text((x, y), text, fill="black")
 
-    return (image, result)
+    return image
 
 
-def setup_model(config):
+def render_annotated(config, capture_id: int, filename: str, result: dict) -> str:
+    """
+    Draws result onto the original stored as filename, for captures saved
+    without an annotated image. Unchanged frames can share an original, so
+    it's written to ANNO_DIR under a name including the capture id, which
+    is returned.
+    """
+    (query_items, _) = setup_query(config)
+    with Image.open(os.path.join(config["ORIG_DIR"], filename)) as orig_image:
+        image = orig_image.convert("RGB")
+    annotate_image(image, result, query_items, config["OTHER_COLOR"])
+    (format, ext, options) = image_codec(config)
+    anno_filename = f"{capture_id}_{os.path.splitext(filename)[0]}{ext}"
+    save_image(image, os.path.join(config["ANNO_DIR"], anno_filename), format, options)
+    return anno_filename
+
+
+def tokenize_query(processor, query: str) -> dict:
+    """Tokenizes the query, reusing the result until the query changes"""
+    if query not in _query_inputs:
+        _query_inputs.clear()
+        _query_inputs[query] = dict(
+            processor.tokenizer(text=query, return_tensors="pt")
+        )
+    return _query_inputs[query]
+
+
+def _same_inputs(a, b) -> bool:
+    if isinstance(a, torch.Tensor) or isinstance(b, torch.Tensor):
+        return (
+            isinstance(a, torch.Tensor)
+            and isinstance(b, torch.Tensor)
+            and a.shape == b.shape
+            and torch.equal(a, b)
+        )
+    if isinstance(a, (tuple, list)):
+        return len(a) == len(b) and all(
+            _same_inputs(x, y) for x, y in zip(a, b, strict=False)
+        )
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(_same_inputs(a[k], b[k]) for k in a)
+    return a == b
+
+
+class CachedTextBackbone(torch.nn.Module):
+    """
+    Wraps the text encoder of Grounding DINO, returning the earlier output
+    when called with the same inputs again. The query only changes along
+    with the stock types, so after the first frame only the image branch
+    and the fusion layers run. Any change to the query changes the token
+    ids, which makes it a cache miss.
+    """
+
+    def __init__(self, backbone: torch.nn.Module):
+        super().__init__()
+        self.backbone = backbone
+        self.cached: list[tuple[tuple, object]] = []
+
+    def forward(self, *args, **kwargs):
+        if torch.is_grad_enabled():
+            return self.backbone(*args, **kwargs)
+        inputs = (args, kwargs)
+        for cached_inputs, output in self.cached:
+            if _same_inputs(cached_inputs, inputs):
+                return output
+        output = self.backbone(*args, **kwargs)
+        self.cached = [(inputs, output)] + self.cached[: TEXT_CACHE_SIZE - 1]
+        return output
+
+
+def setup_query(config) -> (dict[str, str], str):
     queries = config["STOCK_TYPES_BY_QUERY"]
     query = " ".join(map(lambda key: f"{key}.", queries.keys()))
+    return (dict([(key, val["color"]) for key, val in queries.items()]), query)
+
+
+def setup_model(config):
+    (query_items, query) = setup_query(config)
 
     processor = AutoProcessor.from_pretrained(config["OBJ_DET_MODEL"])
     model = AutoModelForZeroShotObjectDetection.from_pretrained(
         config["OBJ_DET_MODEL"]
     ).to(DEVICE)
-    return (dict([(key, val["color"]) for key, val in queries.items()]), query, DEVICE, processor, model)
+    if hasattr(model, "model") and hasattr(model.model, "text_backbone"):
+        model.model.text_backbone = CachedTextBackbone(model.model.text_backbone)
+    return (query_items, query, DEVICE, processor, model)
+
+
+def get_model(config):
+    """Same as setup_model, but only loads the model once in this process"""
+    key = config["OBJ_DET_MODEL"]
+    if key not in _warm_models:
+        _warm_models[key] = setup_model(config)
+    (_, _, device, processor, model) = _warm_models[key]
+    # the query is cheap to build, and building it each time means
+    # changed stock types are picked up without reloading the model
+    (query_items, query) = setup_query(config)
+    return (query_items, query, device, processor, model)
 
 
 def extract_results(result: dict) -> dict:
@@ -100,123 +260,456 @@ def extract_results(result: dict) -> dict:
         "scores": result["scores"].tolist(),
         "labels": result["labels"],
         "boxes": result["boxes"].tolist(),
+        "image_size": result["image_size"],
     }
-    
-   
-def save_results(
-    db: Db,
-    config,
-    capture_id,
-    image,
-    ext,
-    result,
-    last_start,
-    created_by: CaptureCreatedBy
-) -> None:
-    result = extract_results(result)
-    print("Saving object detection results")
-    file_id = save_anno(db, config, image, ext, last_start)
 
-    capture_id = db.complete_capture(
-        capture_id,
-        result,
-        datetime.now().timestamp(),
-        [file_id]
-    )
 
+def detect_images(jobs: list[dict], config) -> list[dict]:
+    """
+    Runs detection on a batch of uploaded originals, each job given as its
+    filename in ORIG_DIR and whether to embed it, in a single forward pass.
+    Nothing is stored here, so workers need no access to the database.
+    Each job's outcome is {"result": ...}, with what save_result needs, or
+    {"error": ...}, so one bad upload doesn't fail the rest of the batch.
+    """
+    outcomes: list[dict | None] = [None] * len(jobs)
+    loaded = []
+    for i, job in enumerate(jobs):
+        try:
+            orig_image = Image.open(orig_path(config, job["filename"]))
+            orig_image.load()
+        except (OSError, ValueError) as e:
+            outcomes[i] = {"error": repr(e)}
+            continue
+        loaded.append((i, job, orig_image))
+
+    if len(loaded) == 0:
+        return outcomes
 
-def setup_and_process_image(capture_id: int, file_id: int, config, dt: datetime):
-    db = Db(config["DB"])
-    filename = db.fetch_image_name(file_id)
-    if filename is None:
-        raise Exception(f"couldn't find file: {file_id}")
-    orig_image = Image.open(os.path.join(config["ORIG_DIR"], filename))
-    ext = os.path.splitext(filename)[1]
-    (query_items, query, device, processor, model) = setup_model(config)
-    (image, result) = process_image(
-        orig_image.copy(),
+    embeddings: dict[int, np.ndarray] = {}
+    to_embed = [(i, orig_image) for (i, job, orig_image) in loaded if job["embed"]]
+    if len(to_embed) > 0:
+        try:
+            vectors = similarity.embed_images(
+                similarity.get_model(config),
+                [orig_image for (_, orig_image) in to_embed],
+            )
+            embeddings = dict(zip([i for (i, _) in to_embed], vectors, strict=True))
+        except Exception as e:
+            # detection doesn't depend on it, so carry on
+            print(f"Failed to embed images: {e}")
+
+    print(f"Processing batch of {len(loaded)} images")
+    (query_items, query, device, processor, model) = get_model(config)
+    annotate = config["STORE_ANNOTATED"]
+    processed = process_images(
+        [
+            orig_image.copy() if annotate else orig_image
+            for (_, _, orig_image) in loaded
+        ],
         model,
         query,
         query_items,
         config["OTHER_COLOR"],
         processor,
         device,
+        annotate,
     )
-    save_results(
-        db,
-        config,
-        capture_id,
-        image,
-        ext,
-        result,
-        dt,
-        CaptureCreatedBy.REQUEST
-    )
+    (format, ext, options) = image_codec(config)
+    for (i, _, _), (image, result) in zip(loaded, processed, strict=True):
+        anno = None
+        if image is not None:
+            anno = base64.b64encode(encode_image(image, format, options)).decode()
+        embedding = embeddings.get(i)
+        outcomes[i] = {
+            "result": {
+                "detection": extract_results(result),
+                "query": query,
+                "anno": anno,
+                "anno_ext": ext,
+                "embedding": None if embedding is None else embedding.tolist(),
+            }
+        }
+    return outcomes
+
+
+async def prepare_jobs(
+    db: AsyncDb, config, store: EmbeddingStore, jobs: list[JobRow]
+) -> list[dict | None | Exception]:
+    """
+    What a worker needs to run each job, see detect_images. None for a job
+    that's done already, which happens when its lease ran out while it was
+    being processed, and an exception if its upload is gone.
+    """
+    prepared = []
+    for job in jobs:
+        if await db.fetch_result(job.capture_id) is not None:
+            print(f"Capture {job.capture_id} already processed")
+            prepared.append(None)
+            continue
+        file_id = job.payload["file_ids"][0]
+        filename = await db.fetch_image_name(file_id)
+        if filename is None:
+            prepared.append(Exception(f"couldn't find file: {file_id}"))
+            continue
+        prepared.append(
+            {
+                "filename": filename,
+                "embed": config["EMBED_IMAGES"] and store.get(file_id) is None,
+            }
+        )
+    return prepared
+
+
+async def save_result(
+    db: AsyncDb, config, store: EmbeddingStore, job: JobRow, result: dict | None
+) -> None:
+    """
+    Completes a detection job's capture with what a worker sent back, the
+    annotated image and memoized result along with it in one transaction
+    """
+    if result is None:
+        return
+    print("Saving object detection results")
+    file_id = job.payload["file_ids"][0]
+    uow = db.unit_of_work(job.capture_id).complete(result["detection"], datetime.now())
+    sha256 = (await db.fetch_file_hashes([file_id])).get(file_id)
+    if sha256 is not None:
+        uow.memoize(sha256, config["OBJ_DET_MODEL"], result["query"])
+    if result["anno"] is not None:
+        filename = await asyncio.to_thread(
+            write_encoded,
+            config["ANNO_DIR"],
+            base64.b64decode(result["anno"]),
+            result["anno_ext"],
+            datetime.fromtimestamp(job.payload["dt"]),
+        )
+        uow.add_file(filename, CaptureType.ANNO, datetime.now())
+    await db.commit_unit(uow)
+    if result["embedding"] is not None:
+        try:
+            await asyncio.to_thread(
+                store.add, [file_id], np.asarray(result["embedding"], dtype=np.float32)
+            )
+        except (OSError, ValueError) as e:
+            print(f"Failed to store image embedding: {e}")
+
+
+def embed_frame(pipe, image: Image) -> np.ndarray | None:
+    """
+    Pooled embedding of a frame for the embedding store, None if there's no
+    pipe or it fails
+    """
+    if pipe is None:
+        return None
+    try:
+        return similarity.embed_images(pipe, [image])[0]
+    except Exception as e:
+        print(f"Failed to embed frame: {e}")
+        return None
 
 
-def drink_detection(config, stop_event: multiprocessing.Event):
+@dataclass
+class Frame:
+    started: datetime
+    image: Image
+
+
+@dataclass
+class DetectedFrame:
+    frame: Frame
+    # None unless STORE_ANNOTATED is set
+    anno_image: Image.Image | None
+    result: dict
+    # detection was reused from the previous frame
+    reused: bool = False
+    # pooled image embedding, None unless EMBED_IMAGES is set
+    embedding: np.ndarray | None = None
+
+
+class FrameGate:
+    """
+    Decides whether a frame changed enough from the last processed one to
+    be worth running the model on, comparing small grayscale copies of both.
+    Counts the frames it lets through and skips, and the differences it
+    saw, for tuning CHANGE_THRESHOLD.
+    """
+
+    def __init__(self, threshold: float, log_interval: float = GATE_LOG_INTERVAL):
+        self.threshold = threshold
+        self.log_interval = log_interval
+        self.last: Image.Image | None = None
+        self.processed = 0
+        self.skipped = 0
+        # of every frame compared with an earlier one
+        self.compared = 0
+        self.diff_total = 0.0
+        self.diff_max = 0.0
+        self.last_log = datetime.now()
+
+    def check(self, image: Image) -> (bool, float | None):
+        """
+        Returns whether to process the frame, and its difference from the last
+        processed one
+        """
+        small = image.convert("L").resize(
+            (GATE_SIZE, GATE_SIZE), Image.Resampling.BILINEAR
+        )
+        diff = None
+        if self.last is not None:
+            diff = ImageStat.Stat(ImageChops.difference(small, self.last)).mean[0]
+            self.compared += 1
+            self.diff_total += diff
+            self.diff_max = max(self.diff_max, diff)
+        if diff is not None and diff < self.threshold:
+            self.skipped += 1
+            return (False, diff)
+        self.last = small
+        self.processed += 1
+        return (True, diff)
+
+    def stats(self) -> dict:
+        return {
+            "threshold": self.threshold,
+            "processed": self.processed,
+            "skipped": self.skipped,
+            "diff_mean": self.diff_total / self.compared if self.compared > 0 else None,
+            "diff_max": self.diff_max,
+        }
+
+    def log_stats(self, force: bool = False) -> None:
+        """Prints the counts, at most once every log_interval seconds unless forced"""
+        now = datetime.now()
+        if not force and (now - self.last_log).total_seconds() < self.log_interval:
+            return
+        self.last_log = now
+        stats = self.stats()
+        diff_mean = (
+            "n/a" if stats["diff_mean"] is None else round(stats["diff_mean"], 2)
+        )
+        print(
+            f"Frame gate: {stats['processed']} frames processed,"
+            f" {stats['skipped']} skipped "
+            f"at threshold {stats['threshold']}, mean difference {diff_mean}, "
+            f"max {round(stats['diff_max'], 2)}"
+        )
+
+
+@dataclass
+class StoredFrame:
+    frame: Frame
+    result: dict
+    # name of the newly written file of each type, or None to link the
+    # file of that type from the previous capture
+    files: dict[CaptureType, str | None]
+    embedding: np.ndarray | None = None
+
+
+async def put_frame(queue: asyncio.Queue, item, drop_policy: str) -> None:
+    """Puts item on a bounded stage queue, handling a full one by the drop policy"""
+    match drop_policy:
+        case "drop_oldest":
+            while queue.full():
+                queue.get_nowait()
+                print("Stage queue full, dropping oldest frame")
+            queue.put_nowait(item)
+        case "drop_newest":
+            if queue.full():
+                print("Stage queue full, dropping newest frame")
+            else:
+                queue.put_nowait(item)
+        case _:
+            await queue.put(item)
+
+
+def drink_detection(
+    config, stop_event: multiprocessing.Event, notify_queue: queue.Queue | None = None
+):
+    set_notify_queue(notify_queue)
+    depth = config["CAPTURE_QUEUE_DEPTH"]
+    drop_policy = config["CAPTURE_DROP_POLICY"]
+
+    async def wait_for_stop(timeout: float) -> bool:
+        # wait in short slices, so a cancelled loop doesn't leave a
+        # thread blocked on the event for a whole RATE period
+        end = datetime.now() + timedelta(seconds=timeout)
+        while not stop_event.is_set():
+            rem = (end - datetime.now()).total_seconds()
+            if rem <= 0:
+                return False
+            await asyncio.to_thread(stop_event.wait, min(rem, STOP_POLL_INTERVAL))
+        return True
+
+    async def grab(cap, out_queue: asyncio.Queue):
+        try:
+            while not stop_event.is_set():
+                print("Capturing")
+                last_start = datetime.now()
+                orig_image = await asyncio.to_thread(capture_image, cap)
+                await put_frame(out_queue, Frame(last_start, orig_image), drop_policy)
+
+                next = last_start + timedelta(seconds=config["RATE"])
+                rem = max((next - datetime.now()).total_seconds(), 0)
+                print(f"Captured, waiting until next start in {round(rem)} seconds")
+                if await wait_for_stop(rem):
+                    break
+        finally:
+            await out_queue.put(None)
+
+    async def infer(
+        in_queue: asyncio.Queue, out_queue: asyncio.Queue, model_setup, embed_pipe
+    ):
+        (query_items, query, device, processor, model) = model_setup
+        gate = FrameGate(config["CHANGE_THRESHOLD"])
+        annotate = config["STORE_ANNOTATED"]
+        last: DetectedFrame | None = None
+        try:
+            while (frame := await in_queue.get()) is not None:
+                if stop_event.is_set():
+                    # remaining frames aren't worth a model run when stopping
+                    continue
+                (changed, _) = await asyncio.to_thread(gate.check, frame.image)
+                gate.log_stats()
+                if changed or last is None:
+                    print("Processing")
+                    ((image, result), embedding) = await asyncio.gather(
+                        asyncio.to_thread(
+                            process_image,
+                            frame.image.copy() if annotate else frame.image,
+                            model,
+                            query,
+                            query_items,
+                            config["OTHER_COLOR"],
+                            processor,
+                            device,
+                            annotate,
+                        ),
+                        asyncio.to_thread(embed_frame, embed_pipe, frame.image),
+                    )
+                    detected = DetectedFrame(
+                        frame, image, extract_results(result), embedding=embedding
+                    )
+                    last = detected
+                else:
+                    print("Scene unchanged, reusing last detection")
+                    detected = DetectedFrame(
+                        frame, last.anno_image, last.result, True, last.embedding
+                    )
+                await put_frame(out_queue, detected, drop_policy)
+        finally:
+            gate.log_stats(force=True)
+            await out_queue.put(None)
+
+    async def store(in_queue: asyncio.Queue, out_queue: asyncio.Queue):
+        # whether files were written for an earlier frame, which unchanged
+        # frames can link to instead of storing copies
+        stored_any = False
+        try:
+            while (detected := await in_queue.get()) is not None:
+                frame = detected.frame
+                reuse = detected.reused and stored_any
+                files = {CaptureType.ORIG: None, CaptureType.ANNO: None}
+                writes = {}
+                if not (reuse and config["SKIP_UNCHANGED_ORIG"]):
+                    writes[CaptureType.ORIG] = asyncio.to_thread(
+                        write_orig_image, config, frame.image, frame.started
+                    )
+                if not reuse and detected.anno_image is not None:
+                    writes[CaptureType.ANNO] = asyncio.to_thread(
+                        write_anno, config, detected.anno_image, frame.started
+                    )
+                # PIL lets go of the GIL while encoding, so both run at once
+                files.update(
+                    zip(
+                        writes.keys(),
+                        await asyncio.gather(*writes.values()),
+                        strict=False,
+                    )
+                )
+                stored_any = True
+                # never dropped, its files are already written and the next
+                # frame may link to them
+                await out_queue.put(
+                    StoredFrame(frame, detected.result, files, detected.embedding)
+                )
+        finally:
+            await out_queue.put(None)
+
+    async def commit(db: Db, in_queue: asyncio.Queue):
+        last_file_ids: dict[CaptureType, int] = {}
+        while (stored := await in_queue.get()) is not None:
+            print("Saving object detection results")
+            uow = (
+                db.unit_of_work()
+                .create_capture(
+                    uuid4(),
+                    config["OBJ_DET_MODEL"],
+                    CaptureCreatedBy.LOOP,
+                    stored.frame.started,
+                )
+                .complete(stored.result, stored.frame.started)
+            )
+            new_types = []
+            for type, filename in stored.files.items():
+                if filename is not None:
+                    uow.add_file(filename, type, datetime.now())
+                    new_types.append(type)
+                elif type in last_file_ids:
+                    uow.link_file(last_file_ids[type])
+            # captures, results, files and links all go in one transaction,
+            # which can wait on the database lock for up to its busy timeout
+            capture_id = await asyncio.to_thread(uow.commit)
+            last_file_ids.update(zip(new_types, uow.new_file_ids, strict=False))
+            notify_capture(capture_id)
+            if stored.embedding is not None and CaptureType.ORIG in new_types:
+                try:
+                    # opening the store reads its files, and adding writes to them
+                    store = await asyncio.to_thread(similarity.embedding_store, config)
+                    await asyncio.to_thread(
+                        store.add, [last_file_ids[CaptureType.ORIG]], stored.embedding
+                    )
+                except (OSError, ValueError) as e:
+                    print(f"Failed to store frame embedding: {e}")
+
     async def run():
+        stages: list[asyncio.Task] = []
         try:
-            db = Db(config["DB"])
+            db = Db.from_config(config)
             print("Opening camera")
             cap = open_capture_device(config["CAPTURE_DEVICE"])
             print("Camera interface opened, setting up model")
 
             if stop_event.is_set():
                 return
-            (query_items, query, device, processor, model) = setup_model(config)
+            model_setup = await asyncio.to_thread(setup_model, config)
+            embed_pipe = None
+            if config["EMBED_IMAGES"]:
+                embed_pipe = await asyncio.to_thread(similarity.get_model, config)
             print("Model ready")
 
             if stop_event.is_set():
                 return
-            print(f"Starting capture loop at rate of once per {config["RATE"]} seconds")
+            print(f"Starting capture loop at rate of once per {config['RATE']} seconds")
 
-            while True:
-                if stop_event.is_set():
-                    return
-                print("Capturing and processing")
-                last_start = datetime.now()
-                orig_image = capture_image(cap)
-                if stop_event.is_set():
-                    return
-                (image, result) = process_image(
-                    orig_image.copy(),
-                    model,
-                    query,
-                    query_items,
-                    config["OTHER_COLOR"],
-                    processor,
-                    device,
-                )
-                if stop_event.is_set():
-                    return
-
-                with BytesIO() as orig_bytes:
-                    orig_image.save(orig_bytes, IMG_FMT)
-                    orig_bytes.seek(0)
-                    orig_file_id = await save_raw_orig(db, config, orig_bytes, IMG_EXT, last_start)
-                if stop_event.is_set():
-                    return
-
-                result = extract_results(result)
-                print("Saving object detection results")
-                file_id = save_anno(db, config, image, IMG_EXT, last_start)
-                db.create_completed_capture(
-                    config["OBJ_DET_MODEL"],
-                    CaptureCreatedBy.LOOP,
-                    last_start,
-                    result,
-                    [orig_file_id, file_id]
-                )
-
-                next = last_start + timedelta(seconds=config["RATE"])
-                rem = max((next - datetime.now()).seconds, 0)
-                print(f"Finished, waiting until next start in {rem} seconds")
-                stop_event.wait(rem)
+            frames = asyncio.Queue(depth)
+            detected = asyncio.Queue(depth)
+            stored = asyncio.Queue(depth)
+            stages = [
+                asyncio.create_task(grab(cap, frames)),
+                asyncio.create_task(infer(frames, detected, model_setup, embed_pipe)),
+                asyncio.create_task(store(detected, stored)),
+                asyncio.create_task(commit(db, stored)),
+            ]
+            # each stage passes None on once its input runs out, so after
+            # stop_event is set the queued frames drain through in order
+            await asyncio.gather(*stages)
         except asyncio.CancelledError:
             print("Capture loop task cancelled")
         except Exception as e:
             print(f"Exception raised in capture loop: {e}")
         finally:
+            for stage in stages:
+                stage.cancel()
             print("Ending capture loop")
+
     asyncio.run(run())
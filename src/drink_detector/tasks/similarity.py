@@ -1,15 +1,26 @@
-import os
+import asyncio
+import hashlib
 from datetime import datetime
 
-import torch
+import numpy as np
 from PIL import Image
-from torch.nn.functional import cosine_similarity
 from transformers import pipeline
 
-from drink_detector.db import Db
+from drink_detector.async_db import AsyncDb
+from drink_detector.db import CaptureType, Db, JobRow
+from drink_detector.embeddings import EmbeddingStore, normalize
+from drink_detector.files import orig_path
 
 from . import DEVICE
 
+# pipelines already loaded in this process, keyed by model name
+_warm_pipes: dict[str, object] = {}
+_stores: dict[str, EmbeddingStore] = {}
+# most images embedded per pipeline call
+EMBED_BATCH_SIZE = 16
+# similarity takes no query, memoized results are stored under this one
+SIMILARITY_QUERY = ""
+
 
 def setup_model(config):
     return pipeline(
@@ -20,32 +31,173 @@ def setup_model(config):
     )
 
 
-def process_images(pipe, img_1, img_2):
-    outputs = pipe([img_1, img_2])
-    return cosine_similarity(torch.Tensor(outputs[0]), torch.Tensor(outputs[1]), dim=1)
+def get_model(config):
+    """Same as setup_model, but only loads the pipeline once in this process"""
+    key = config["IMG_FEAT_MODEL"]
+    if key not in _warm_pipes:
+        _warm_pipes[key] = setup_model(config)
+    return _warm_pipes[key]
 
 
-def save_results(db: Db, config, img_1_id: int, img_2_id: int, capture_id: int, result):
-    result = {"similarity": result}
-    print("Saving similarity results")
+def embedding_store(config) -> EmbeddingStore:
+    """The store for IMG_FEAT_MODEL embeddings, opened once per process"""
+    key = config["IMG_FEAT_MODEL"]
+    if key not in _stores:
+        _stores[key] = EmbeddingStore(config["EMBEDDINGS_DIR"], key)
+    return _stores[key]
+
+
+def embed_images(pipe, images: list[Image]) -> np.ndarray:
+    """Pooled embeddings of images, run through the model as one batch, one row each"""
+    outputs = pipe(images, batch_size=len(images))
+    return np.asarray(outputs, dtype=np.float32).reshape(len(images), -1)
+
+
+def similarity_matrix(embeddings: np.ndarray) -> np.ndarray:
+    """Cosine similarity of every pair of rows, as one matrix product"""
+    normalized = normalize(embeddings)
+    return normalized @ normalized.T
+
+
+def similarity_key(hashes: list[str | None]) -> str | None:
+    """
+    Hash the similarity of images with these content hashes is memoized
+    under, in order. None if one isn't known.
+    """
+    if any(sha256 is None for sha256 in hashes):
+        return None
+    return hashlib.sha256(" ".join(hashes).encode()).hexdigest()
 
-    capture_id = db.complete_capture(
-        capture_id,
-        result,
-        datetime.now().timestamp()
-    )
 
+def embed_files(files: list[tuple[int, str]], config) -> dict[int, np.ndarray]:
+    """
+    Embeds originals, given as their file id and filename in ORIG_DIR,
+    EMBED_BATCH_SIZE images per pipeline call. Returns the embeddings of
+    those that could be opened, by file id.
+    """
+    embeddings = {}
+    for start in range(0, len(files), EMBED_BATCH_SIZE):
+        loaded_ids = []
+        images = []
+        for file_id, filename in files[start : start + EMBED_BATCH_SIZE]:
+            try:
+                with Image.open(orig_path(config, filename)) as image:
+                    images.append(image.convert("RGB"))
+            except (OSError, ValueError) as e:
+                print(f"Failed to open {filename}: {e}")
+                continue
+            loaded_ids.append(file_id)
+        if len(images) > 0:
+            embeddings.update(
+                zip(loaded_ids, embed_images(get_model(config), images), strict=True)
+            )
+    return embeddings
+
+
+def run_job(job: dict, config) -> dict:
+    """
+    Embeds a similarity job's originals that aren't stored yet, see
+    prepare_jobs, for the server to store and compare with the rest
+    """
+    files = [(file_id, filename) for (file_id, filename) in job["files"]]
+    embeddings = embed_files(files, config)
+    missing = [file_id for (file_id, _) in files if file_id not in embeddings]
+    if len(missing) > 0:
+        raise Exception(f"couldn't embed files: {missing}")
+    return {
+        "embeddings": [
+            [file_id, vector.tolist()] for (file_id, vector) in embeddings.items()
+        ]
+    }
+
+
+async def prepare_jobs(
+    db: AsyncDb, config, store: EmbeddingStore, jobs: list[JobRow]
+) -> list[dict | None | Exception]:
+    """
+    What a worker needs to run each job, see run_job: the originals it
+    has that aren't embedded yet. None if there are none, or the job is
+    done already, and an exception if one of its files is gone.
+    """
+    prepared = []
+    for job in jobs:
+        if await db.fetch_result(job.capture_id) is not None:
+            prepared.append(None)
+            continue
+        files = []
+        for file_id in dict.fromkeys(job.payload["file_ids"]):
+            if store.get(file_id) is not None:
+                continue
+            filename = await db.fetch_image_name(file_id)
+            if filename is None:
+                files = Exception(f"couldn't find file: {file_id}")
+                break
+            files.append([file_id, filename])
+        if isinstance(files, Exception):
+            prepared.append(files)
+        else:
+            prepared.append({"files": files} if len(files) > 0 else None)
+    return prepared
+
+
+async def save_result(
+    db: AsyncDb, config, store: EmbeddingStore, job: JobRow, result: dict | None
+) -> list[list[float]]:
+    """
+    Stores the embeddings a worker sent back, then compares the job's
+    images and completes its capture with their similarity matrix, which
+    is returned. Each image is only ever embedded once, and those from
+    earlier captures usually were already.
+    """
+    existing = await db.fetch_result(job.capture_id)
+    if existing is not None:
+        return existing["similarity"]
+    if result is not None and len(result["embeddings"]) > 0:
+        (new_ids, vectors) = zip(*result["embeddings"], strict=True)
+        await asyncio.to_thread(
+            store.add, list(new_ids), np.asarray(vectors, dtype=np.float32)
+        )
+        print(f"Stored {len(new_ids)} image embeddings")
+    file_ids = job.payload["file_ids"]
+    embeddings = [store.get(file_id) for file_id in file_ids]
+    missing = [
+        file_id
+        for (file_id, vector) in zip(file_ids, embeddings, strict=True)
+        if vector is None
+    ]
+    if len(missing) > 0:
+        raise Exception(f"couldn't embed files: {missing}")
+    matrix = similarity_matrix(np.stack(embeddings)).tolist()
+    hashes = await db.fetch_file_hashes(file_ids)
+    key = similarity_key([hashes.get(file_id) for file_id in file_ids])
+    print("Saving similarity results")
+    # row and column i of the matrix are the image with file_ids[i]
+    uow = db.unit_of_work(job.capture_id).complete(
+        {"similarity": matrix, "file_ids": file_ids}, datetime.now()
+    )
+    if key is not None:
+        uow.memoize(key, config["IMG_FEAT_MODEL"], SIMILARITY_QUERY)
+    await db.commit_unit(uow)
+    return matrix
 
-def find_similarity(img_1_id: int, img_2_id: int, capture_id: int, config) -> float:
-    db = Db(config["DB"])
-    img_1_name = db.fetch_image_name(img_1_id)
-    img_2_name = db.fetch_image_name(img_2_id)
-    full_img_1_name = os.path.join(config["ORIG_DIR"], img_1_name)
-    full_img_2_name = os.path.join(config["ORIG_DIR"], img_2_name)
-    img_1 = Image.open(full_img_1_name)
-    img_2 = Image.open(full_img_2_name)
 
-    pipe = setup_model(config)
-    result = process_images(pipe, img_1, img_2).item()
-    save_results(db, config, img_1_id, img_2_id, capture_id, result)
-    return result
+def embed_stored_files(config) -> None:
+    """
+    Embeds every stored original that isn't yet, such as those from before
+    embeddings were kept
+    """
+    db = Db.from_config(config)
+    store = embedding_store(config)
+    file_ids = db.fetch_file_ids(CaptureType.ORIG)
+    files = [
+        (file_id, filename)
+        for file_id in file_ids
+        if store.get(file_id) is None
+        and (filename := db.fetch_image_name(file_id)) is not None
+    ]
+    added = 0
+    for start in range(0, len(files), EMBED_BATCH_SIZE):
+        embeddings = embed_files(files[start : start + EMBED_BATCH_SIZE], config)
+        if len(embeddings) > 0:
+            added += store.add(list(embeddings), np.stack(list(embeddings.values())))
+    print(f"Embedded {added} of {len(file_ids)} images")
@@ -0,0 +1,64 @@
+import asyncio
+import os
+import socket
+from functools import partial
+
+from drink_detector import rpc
+
+from . import drink_detection, similarity
+
+MODEL_LOADERS = {
+    "detection": drink_detection.get_model,
+    "similarity": similarity.get_model,
+}
+
+
+def init_worker(config) -> None:
+    """Pool initializer, loads the configured models once for the life of the worker"""
+    for name in config["WORKER_MODELS"]:
+        if name not in MODEL_LOADERS:
+            raise ValueError(f"unknown worker model: {name}")
+        print(f"Loading {name} model in worker {os.getpid()}")
+        MODEL_LOADERS[name](config)
+    print(f"Worker {os.getpid()} ready")
+
+
+def ready() -> int:
+    """No-op job, used to start up the pool's workers ahead of the first request"""
+    return os.getpid()
+
+
+def run_jobs(kind: str, jobs: list[dict], config) -> list[dict]:
+    """
+    Runs a batch of jobs of one kind, each given as what its task's
+    prepare_jobs made of it. Returns one {"result": ...} or {"error": ...}
+    per job, which the server saves, so outcomes are the same whether run
+    in the server's pool or remotely, and workers never write anything.
+    """
+    match kind:
+        case "detection":
+            return drink_detection.detect_images(jobs, config)
+        case "similarity":
+            outcomes = []
+            for job in jobs:
+                try:
+                    outcomes.append({"result": similarity.run_job(job, config)})
+                except Exception as e:
+                    outcomes.append({"error": repr(e)})
+            return outcomes
+    raise ValueError(f"unknown job kind: {kind}")
+
+
+def serve_worker(config) -> None:
+    """Runs jobs for a server listening on WORKER_CONNECT, see rpc.WorkerPool"""
+    init_worker(config)
+    asyncio.run(
+        rpc.run_worker(
+            config["WORKER_CONNECT"],
+            f"{socket.gethostname()}:{os.getpid()}",
+            config["WORKER_MODELS"],
+            config["WORKER_CAPACITY"],
+            partial(run_jobs, config=config),
+            config["WORKER_TOKEN"],
+        )
+    )
@@ -0,0 +1,111 @@
+import asyncio
+import collections
+import functools
+import hashlib
+import os
+
+from PIL import Image
+
+HASH_BUFFER_SIZE = 1 << 20
+
+
+@functools.lru_cache(maxsize=4096)
+def _hash_file_(path: str, mtime_ns: int, size: int) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while data := f.read(HASH_BUFFER_SIZE):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+async def content_hash(path: str) -> str:
+    """
+    sha256 of a file's contents, only read once per version of the file
+    since stored images never change
+    """
+    stat = await asyncio.to_thread(os.stat, path)
+    return await asyncio.to_thread(_hash_file_, path, stat.st_mtime_ns, stat.st_size)
+
+
+class ThumbnailCache:
+    """
+    Resized copies of images kept in a directory, generated on first use.
+    Once they take up more than max_bytes the least recently used ones are
+    deleted. Recency survives restarts through the files' mtimes.
+    """
+
+    def __init__(self, dir: str, widths: list[int], max_bytes: int) -> None:
+        self.dir = dir
+        self.widths = sorted(widths)
+        self.max_bytes = max_bytes
+        # filename to size, least recently used first
+        self.entries: collections.OrderedDict[str, int] = collections.OrderedDict()
+        self.size = 0
+        self.generating: dict[str, asyncio.Task] = dict()
+        os.makedirs(dir, exist_ok=True)
+        for entry in sorted(os.scandir(dir), key=lambda entry: entry.stat().st_mtime):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                self.entries[entry.name] = entry.stat().st_size
+                self.size += entry.stat().st_size
+
+    def fit_width(self, width: int) -> int:
+        """Smallest thumbnail width at least as wide as asked for"""
+        return next((w for w in self.widths if w >= width), self.widths[-1])
+
+    async def get(self, path: str, width: int) -> str:
+        """Path of the thumbnail of the image at path, width being one of widths"""
+        # originals and annotated images are stored under the same names in
+        # different directories, so thumbnails go by content instead
+        name = f"{width}_{await content_hash(path)}{os.path.splitext(path)[1]}"
+        if name in self.entries:
+            self.entries.move_to_end(name)
+            thumb_path = os.path.join(self.dir, name)
+            # keeps the order for the next scan, a missing file is remade below
+            try:
+                os.utime(thumb_path)
+                return thumb_path
+            except OSError:
+                self.size -= self.entries.pop(name)
+        # concurrent requests for the same thumbnail share one resize
+        if name not in self.generating:
+            self.generating[name] = asyncio.create_task(
+                self.generate(path, name, width)
+            )
+            self.generating[name].add_done_callback(
+                lambda _: self.generating.pop(name, None)
+            )
+        return await asyncio.shield(self.generating[name])
+
+    async def generate(self, path: str, name: str, width: int) -> str:
+        thumb_path = os.path.join(self.dir, name)
+        size = await asyncio.to_thread(self._resize_, path, thumb_path, width)
+        self.entries[name] = size
+        self.size += size
+        self.evict()
+        return thumb_path
+
+    @staticmethod
+    def _resize_(path: str, thumb_path: str, width: int) -> int:
+        with Image.open(path) as image:
+            format = image.format
+            image.thumbnail((width, image.height))
+            # written under a temporary name so no request sees half a file
+            temp_path = f"{thumb_path}.tmp"
+            image.save(temp_path, format)
+        os.replace(temp_path, thumb_path)
+        return os.path.getsize(thumb_path)
+
+    def evict(self) -> None:
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            name, size = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(os.path.join(self.dir, name))
+            except OSError as e:
+                print(f"Failed to evict thumbnail {name}: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "count": len(self.entries),
+            "bytes": self.size,
+        }
@@ -0,0 +1,110 @@
+import asyncio
+import json
+from datetime import datetime
+from uuid import uuid4
+
+import pytest
+
+from drink_detector.async_db import AsyncDb
+from drink_detector.broker import FeedBroker, ServerSentEvent, update_check
+from drink_detector.db import CaptureCreatedBy, CaptureType, ConnectionPool, Db
+from drink_detector.server import app
+from drink_detector.snapshot import SnapshotCache
+
+
+@pytest.fixture
+def db_url(tmp_path):
+    url = str(tmp_path / "drinks.db")
+    db = Db(url)
+    db.migrate()
+    db.close()
+    return url
+
+
+def publish_all(broker: FeedBroker, events: list[tuple[str, str]]) -> None:
+    for event, data in events:
+        broker.publish(ServerSentEvent(data, event))
+
+
+def drained_data(messages: str) -> list[str]:
+    return [
+        line.removeprefix("data: ")
+        for line in messages.splitlines()
+        if line.startswith("data: ")
+    ]
+
+
+def test_drop_oldest_keeps_the_newest_events():
+    broker = FeedBroker(buffer_size=2, policy="drop_oldest")
+    subscription = broker.subscribe()
+    publish_all(broker, [("capture", "1"), ("stock", "2"), ("capture", "3")])
+    assert subscription.dropped == 1
+    assert broker.stats() == {"subscribers": 1, "dropped": 1}
+    assert drained_data(asyncio.run(subscription.drain())) == ["2", "3"]
+
+
+def test_coalesce_replaces_pending_events_of_the_same_type():
+    broker = FeedBroker(buffer_size=2, policy="coalesce")
+    subscription = broker.subscribe()
+    publish_all(
+        broker, [("capture", "1"), ("stock", "2"), ("capture", "3"), ("capture", "4")]
+    )
+    # the older captures were replaced, the stock update kept its place
+    assert subscription.dropped == 2
+    assert drained_data(asyncio.run(subscription.drain())) == ["2", "4"]
+    # a new type of event still can't grow the buffer past its size
+    publish_all(broker, [("capture", "5"), ("stock", "6"), ("status", "7")])
+    assert subscription.dropped == 3
+    assert drained_data(asyncio.run(subscription.drain())) == ["6", "7"]
+    assert broker.stats()["dropped"] == 3
+
+
+def test_only_completed_captures_are_published(db_url):
+    async def run():
+        pool = ConnectionPool(db_url)
+        adb = AsyncDb(pool)
+        snapshot = SnapshotCache(adb, {})
+        broker = FeedBroker()
+        subscription = broker.subscribe()
+        shutdown = asyncio.Event()
+        writer = Db(db_url)
+        async with app.app_context():
+            checker = asyncio.create_task(
+                update_check(
+                    snapshot, broker, shutdown, asyncio.Event(), update_rate=0.05
+                )
+            )
+            try:
+                await asyncio.sleep(0.1)
+                uow = (
+                    writer.unit_of_work()
+                    .create_capture(
+                        uuid4(), "model", CaptureCreatedBy.REQUEST, datetime.now()
+                    )
+                    .add_file("upload.png", CaptureType.ORIG, datetime.now())
+                    .enqueue("detection", {}, 1, 3)
+                )
+                capture_id = uow.commit()
+                (job,) = writer.claim_jobs("a", 30, {"detection": 1})
+                writer.extend_job_leases([job.id], "a", 30)
+                await asyncio.sleep(0.2)
+                # only the first load, job writes didn't invalidate the snapshot
+                assert snapshot.misses == 1
+                assert len(subscription.pending) == 0
+
+                result = {"labels": ["coke"], "scores": [0.9], "boxes": [[0, 0, 1, 1]]}
+                writer.unit_of_work(capture_id).complete(
+                    result, datetime.now()
+                ).commit()
+                messages = await asyncio.wait_for(subscription.drain(), 5)
+                payload = json.loads(messages.removeprefix("data: "))
+                assert payload["capture"]["id"] == capture_id
+                assert payload["stock"]["total"] == 1
+            finally:
+                shutdown.set()
+                await checker
+                writer.close()
+                adb.close()
+                pool.close()
+
+    asyncio.run(run())
@@ -0,0 +1,280 @@
+import sqlite3
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+import pytest
+
+from drink_detector.db import MIGRATIONS, CaptureCreatedBy, CaptureType, Db
+
+START = datetime(2024, 10, 1, 12, 0, 0)
+
+
+class ExplainingCursor:
+    """Runs queries as usual, recording the plan of each one first"""
+
+    def __init__(self, con: sqlite3.Connection, plans: list):
+        self.con = con
+        self.plans = plans
+        self.cur = con.cursor()
+
+    def execute(self, sql, params=()):
+        plan = self.con.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+        self.plans.append((sql, [row["detail"] for row in plan]))
+        self.cur.execute(sql, params)
+        return self
+
+    def fetchone(self):
+        return self.cur.fetchone()
+
+    def fetchall(self):
+        return self.cur.fetchall()
+
+
+class ExplainingDb(Db):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.plans: list[tuple[str, list[str]]] = []
+
+    def __new_cur__(self):
+        return ExplainingCursor(self.con, self.plans)
+
+
+def seed(db: Db) -> None:
+    types = [
+        CaptureCreatedBy.LOOP,
+        CaptureCreatedBy.REQUEST,
+        CaptureCreatedBy.SIMILARITY,
+    ]
+    for i in range(60):
+        created_by = types[i % len(types)]
+        at = START + timedelta(seconds=i)
+        if created_by == CaptureCreatedBy.SIMILARITY:
+            result = {"similarity": [[1.0, 0.5], [0.5, 1.0]]}
+        else:
+            result = {
+                "labels": ["coke", "coke", "fanta"],
+                "scores": [0.9, 0.8, 0.7],
+                "boxes": [[0, 0, 1, 1]] * 3,
+            }
+        uow = (
+            db.unit_of_work()
+            .create_capture(uuid4(), "model", created_by, at)
+            .complete(result, at)
+            .add_file(f"{i}.png", CaptureType.ORIG, at)
+        )
+        if created_by == CaptureCreatedBy.LOOP:
+            uow.add_file(f"{i}.png", CaptureType.ANNO, at)
+        else:
+            kind = (
+                "similarity"
+                if created_by == CaptureCreatedBy.SIMILARITY
+                else "detection"
+            )
+            uow.enqueue(kind, {}, int(kind == "detection"), 3)
+        uow.commit()
+
+
+@pytest.fixture
+def db(tmp_path):
+    path = str(tmp_path / "drinks.db")
+    seeded = Db(path)
+    assert seeded.migrate() == len(MIGRATIONS)
+    seed(seeded)
+    seeded.close()
+    db = ExplainingDb(path)
+    yield db
+    db.close()
+
+
+def assert_indexed(plans: list[tuple[str, list[str]]]) -> None:
+    assert len(plans) > 0
+    for sql, plan in plans:
+        for step in plan:
+            assert not (step.startswith("SCAN") and "INDEX" not in step), (
+                f"{step} in plan of {sql}"
+            )
+            assert "TEMP B-TREE" not in step, f"{step} in plan of {sql}"
+
+
+def test_fetch_captures_single_type(db):
+    captures = db.fetch_captures(10, [CaptureCreatedBy.LOOP])
+    assert len(captures) == 10
+    assert all(c.created_by == CaptureCreatedBy.LOOP for c in captures)
+    assert_indexed(db.plans)
+
+
+def test_fetch_captures_several_types(db):
+    captures = db.fetch_captures(10, [CaptureCreatedBy.LOOP, CaptureCreatedBy.REQUEST])
+    assert len(captures) == 10
+    assert_indexed(db.plans)
+
+
+def test_fetch_captures_all_types(db):
+    assert len(db.fetch_captures(10)) == 10
+    assert_indexed(db.plans)
+
+
+def test_fetch_captures_after_cursor(db):
+    first = db.fetch_captures(10, [CaptureCreatedBy.LOOP, CaptureCreatedBy.REQUEST])
+    db.plans.clear()
+    second = db.fetch_captures(
+        10, [CaptureCreatedBy.LOOP, CaptureCreatedBy.REQUEST], after=first[-1].cursor
+    )
+    assert len(second) == 10
+    assert second[0].cursor < first[-1].cursor
+    assert_indexed(db.plans)
+    db.plans.clear()
+    db.fetch_captures(10, [CaptureCreatedBy.LOOP], after=first[-1].cursor)
+    assert_indexed(db.plans)
+
+
+def test_fetch_image_for_capture(db):
+    capture = db.fetch_latest_capture([CaptureCreatedBy.LOOP])
+    db.plans.clear()
+    assert db.fetch_image_for_capture(capture.id, CaptureType.ANNO, 0) == "57.png"
+    assert_indexed(db.plans)
+
+
+def test_fetch_stock_counts(db):
+    assert db.fetch_stock_counts([CaptureCreatedBy.LOOP, CaptureCreatedBy.REQUEST]) == {
+        "coke": 2,
+        "fanta": 1,
+    }
+    assert_indexed(db.plans)
+
+
+def test_claim_jobs(db):
+    jobs = db.claim_jobs("a", 30, {"detection": 2, "similarity": 1})
+    assert [job.kind for job in jobs] == ["detection", "detection"]
+    assert jobs[0].id < jobs[1].id
+    assert_indexed(db.plans)
+    db.plans.clear()
+    assert db.fetch_next_job_at(["detection", "similarity"]) is not None
+    assert_indexed(db.plans)
+
+
+@pytest.fixture
+def empty_db(tmp_path):
+    db = Db(str(tmp_path / "drinks.db"))
+    db.migrate()
+    yield db
+    db.close()
+
+
+def count_rows(db: Db) -> dict[str, int]:
+    return {
+        table: db.con.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        for table in [
+            "captures",
+            "capture_results",
+            "files",
+            "capture_files",
+            "detections",
+            "stock_counts",
+            "stock_series",
+            "cached_results",
+            "jobs",
+        ]
+    }
+
+
+def stored_file(db: Db, filename: str) -> int:
+    """Id of a new original, stored by an earlier capture that isn't complete"""
+    uow = (
+        db.unit_of_work()
+        .create_capture(uuid4(), "model", CaptureCreatedBy.REQUEST, START)
+        .add_file(filename, CaptureType.ORIG, START)
+    )
+    uow.commit()
+    return uow.new_file_ids[0]
+
+
+def test_unit_of_work_commits_everything_together(empty_db):
+    db = empty_db
+    linked = stored_file(db, "earlier.png")
+    result = {
+        "labels": ["coke", "coke", "fanta"],
+        "scores": [0.9, 0.8, 0.7],
+        "boxes": [[0, 0, 1, 1]] * 3,
+    }
+    with db.unit_of_work() as uow:
+        (
+            uow.create_capture(uuid4(), "model", CaptureCreatedBy.REQUEST, START)
+            .complete(result, START)
+            .memoize("abc", "model", "coke. fanta.")
+            .add_file("new.png", CaptureType.ORIG, START, "abc")
+            .add_file("new.png", CaptureType.ANNO, START)
+            # the same image given twice is stored and linked once
+            .add_file("new.png", CaptureType.ORIG, START, "abc")
+            .link_file(linked)
+            .enqueue("detection", {"dt": 1}, 1, 3)
+        )
+    assert uow.capture_id is not None
+    assert len(uow.new_file_ids) == 3
+    assert uow.new_file_ids[0] == uow.new_file_ids[2]
+    assert count_rows(db) == {
+        # along with the earlier one
+        "captures": 2,
+        "capture_results": 1,
+        "files": 3,
+        "capture_files": 4,
+        "detections": 3,
+        "stock_counts": 2,
+        # per label at every resolution
+        "stock_series": 6,
+        "cached_results": 1,
+        "jobs": 1,
+    }
+    (capture,) = db.fetch_captures()
+    assert capture.id == uow.capture_id
+    assert sorted(capture.filenames) == ["earlier.png", "new.png", "new.png"]
+    assert db.fetch_stock_counts() == {"coke": 2, "fanta": 1}
+    assert db.fetch_cached_result("abc", "model", "coke. fanta.") == result
+    (job,) = db.claim_jobs("a", 30, {"detection": 1})
+    assert job.capture_id == uow.capture_id
+    assert job.payload == {"dt": 1, "file_ids": [*uow.new_file_ids, linked]}
+
+
+def test_unit_of_work_writes_nothing_when_a_statement_fails(empty_db):
+    db = empty_db
+    linked = stored_file(db, "earlier.png")
+    before = count_rows(db)
+    uow = (
+        db.unit_of_work()
+        .create_capture(uuid4(), "model", CaptureCreatedBy.LOOP, START)
+        .complete({"labels": ["coke"], "scores": [0.9], "boxes": [[0, 0, 1, 1]]}, START)
+        .add_file("new.png", CaptureType.ORIG, START)
+        .link_file(linked)
+        # fails after the capture, result, files and links were written
+        .enqueue("detection", {"dt": object()}, 1, 3)
+    )
+    with pytest.raises(TypeError):
+        uow.commit()
+    assert uow.capture_id is None
+    assert count_rows(db) == before
+    assert not db.con.in_transaction
+
+
+def test_unit_of_work_skips_commit_on_exception(empty_db):
+    db = empty_db
+    with pytest.raises(RuntimeError), db.unit_of_work() as uow:
+        uow.create_capture(uuid4(), "model", CaptureCreatedBy.LOOP, START)
+        raise RuntimeError("stage failed")
+    assert count_rows(db)["captures"] == 0
+
+
+def test_unit_of_work_result_gets_file_ids(empty_db):
+    db = empty_db
+    linked = stored_file(db, "earlier.png")
+    uow = (
+        db.unit_of_work()
+        .create_capture(uuid4(), "model", CaptureCreatedBy.SIMILARITY, START)
+        .complete({"similarity": [[1.0, 0.5], [0.5, 1.0]]}, START, with_file_ids=True)
+        .add_file("new.png", CaptureType.ORIG, START, "abc")
+        .link_file(linked)
+        .memoize("key", "model", "")
+    )
+    capture_id = uow.commit()
+    result = db.fetch_result(capture_id)
+    assert result["file_ids"] == [uow.new_file_ids[0], linked]
+    assert db.fetch_cached_result("key", "model", "") == result
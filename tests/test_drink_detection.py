@@ -0,0 +1,63 @@
+import torch
+from PIL import Image
+
+from drink_detector.tasks.drink_detection import CachedTextBackbone, FrameGate
+
+
+def test_frame_gate_counts_skipped_frames():
+    gate = FrameGate(10)
+    dark = Image.new("RGB", (320, 240), (0, 0, 0))
+    light = Image.new("RGB", (320, 240), (100, 100, 100))
+    assert gate.check(dark) == (True, None)
+    assert gate.check(dark) == (False, 0.0)
+    (changed, diff) = gate.check(light)
+    assert changed
+    assert diff > 90
+    # compared with the last processed frame, not the last one seen
+    assert gate.check(light) == (False, 0.0)
+    stats = gate.stats()
+    assert stats["processed"] == 2
+    assert stats["skipped"] == 2
+    assert stats["diff_max"] == diff
+    assert stats["diff_mean"] == diff / 3
+
+
+def test_frame_gate_logs_periodically(capsys):
+    gate = FrameGate(10, log_interval=60)
+    gate.check(Image.new("RGB", (64, 64)))
+    gate.log_stats()
+    assert capsys.readouterr().out == ""
+    gate.log_stats(force=True)
+    assert "1 frames processed, 0 skipped" in capsys.readouterr().out
+
+
+class CountingBackbone(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def forward(self, input_ids, attention_mask=None):
+        self.calls += 1
+        return {"last_hidden_state": input_ids.float() * 2}
+
+
+def test_text_backbone_output_is_reused_across_batches():
+    inner = CountingBackbone()
+    backbone = CachedTextBackbone(inner)
+    query = torch.tensor([[101, 2000, 1012, 102]])
+    with torch.no_grad():
+        first = backbone(query, attention_mask=torch.ones_like(query))
+        # equal tensors from the next batch, not the same objects
+        again = backbone(query.clone(), attention_mask=torch.ones_like(query))
+        assert again is first
+        assert inner.calls == 1
+        backbone(
+            torch.tensor([[101, 2001, 1012, 102]]),
+            attention_mask=torch.ones_like(query),
+        )
+        assert inner.calls == 2
+        assert backbone(query, attention_mask=torch.ones_like(query)) is first
+        assert inner.calls == 2
+    # never cached while training
+    backbone(query, attention_mask=torch.ones_like(query))
+    assert inner.calls == 3
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from drink_detector.embeddings import EmbeddingStore
+
+
+def test_embeddings_survive_reopening(tmp_path):
+    store = EmbeddingStore(str(tmp_path), "org/features")
+    assert store.search([1.0, 0.0, 0.0], 3) == []
+    assert store.add([1, 2], [[2.0, 0.0, 0.0], [0.0, 3.0, 0.0]]) == 2
+    # stored ones and repeats within a batch are skipped
+    assert (
+        store.add([2, 3, 3], [[0.0, 1.0, 0.0], [1.0, 1.0, 0.0], [0.0, 0.0, 1.0]]) == 1
+    )
+    with pytest.raises(ValueError):
+        store.add([4], [[1.0, 0.0]])
+
+    reopened = EmbeddingStore(str(tmp_path), "org/features")
+    assert reopened.stats() == {"model": "org/features", "count": 3, "dim": 3}
+    assert np.allclose(reopened.get(2), [0.0, 1.0, 0.0])
+    assert reopened.get(4) is None
+    results = reopened.search([1.0, 0.2, 0.0], 2)
+    assert [file_id for file_id, _ in results] == [1, 3]
+    assert results[0][1] == pytest.approx(1 / np.sqrt(1.04), abs=1e-6)
+    assert [
+        file_id for file_id, _ in reopened.search([1.0, 0.2, 0.0], 5, exclude={1})
+    ] == [3, 2]
+
+    # rows appended by another process show up without reopening
+    reopened.add([5], [[0.0, 0.0, 1.0]])
+    assert store.get(5) is not None
+    assert len(store) == 4
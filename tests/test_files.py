@@ -0,0 +1,30 @@
+import os
+import time
+from datetime import datetime
+from uuid import uuid4
+
+from drink_detector.db import CaptureCreatedBy, CaptureType, Db
+from drink_detector.files import ORPHAN_MIN_AGE, remove_orphaned_origs
+
+
+def test_only_old_unreferenced_origs_are_removed(tmp_path):
+    orig_dir = tmp_path / "orig"
+    orig_dir.mkdir()
+    db = Db(str(tmp_path / "drinks.db"))
+    db.migrate()
+    (
+        db.unit_of_work()
+        .create_capture(uuid4(), "model", CaptureCreatedBy.REQUEST, datetime.now())
+        .add_file("linked.png", CaptureType.ORIG, datetime.now(), "abc")
+        .commit()
+    )
+    old = time.time() - ORPHAN_MIN_AGE - 60
+    for name in ["linked.png", "orphan.png", "upload.part", "recent.png"]:
+        (orig_dir / name).write_bytes(b"image")
+        if name != "recent.png":
+            os.utime(orig_dir / name, (old, old))
+    try:
+        assert remove_orphaned_origs({"ORIG_DIR": str(orig_dir)}, db) == 2
+    finally:
+        db.close()
+    assert sorted(os.listdir(orig_dir)) == ["linked.png", "recent.png"]
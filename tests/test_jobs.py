@@ -0,0 +1,282 @@
+import asyncio
+from datetime import datetime
+from uuid import uuid4
+
+import pytest
+
+from drink_detector.async_db import AsyncDb
+from drink_detector.db import CaptureCreatedBy, ConnectionPool, Db, JobState
+from drink_detector.jobs import JobDispatcher, JobRunner, admission
+from drink_detector.server import app, overloaded
+
+BATCH_SIZES = {"detection": 2, "similarity": 1}
+
+
+@pytest.fixture
+def db_url(tmp_path):
+    url = str(tmp_path / "drinks.db")
+    db = Db(url)
+    db.migrate()
+    db.close()
+    return url
+
+
+@pytest.fixture
+def db(db_url):
+    db = Db(db_url)
+    yield db
+    db.close()
+
+
+def enqueue(
+    db: Db, kind: str = "detection", priority: int = 0, max_attempts: int = 3
+) -> int:
+    uow = (
+        db.unit_of_work()
+        .create_capture(uuid4(), "model", CaptureCreatedBy.REQUEST, datetime.now())
+        .enqueue(kind, {"n": 1}, priority, max_attempts)
+    )
+    uow.commit()
+    return uow.new_job_ids[0]
+
+
+def job_row(db: Db, job_id: int):
+    return db.con.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+
+def make_ready(db: Db, job_id: int) -> None:
+    """Ends a job's backoff early"""
+    with db.con:
+        db.con.execute("UPDATE jobs SET available_at = 0 WHERE id = ?", (job_id,))
+
+
+def test_claim_batches_highest_priority_kind(db):
+    similarity = enqueue(db, "similarity")
+    detections = [enqueue(db, "detection", 1) for _ in range(3)]
+    jobs = db.claim_jobs("a", 30, BATCH_SIZES)
+    assert [job.id for job in jobs] == detections[:2]
+    assert all(job.attempts == 1 for job in jobs)
+    assert jobs[0].payload["file_ids"] == []
+    assert [job.id for job in db.claim_jobs("b", 30, BATCH_SIZES)] == detections[2:]
+    assert [job.id for job in db.claim_jobs("b", 30, BATCH_SIZES)] == [similarity]
+    assert db.claim_jobs("b", 30, BATCH_SIZES) == []
+    assert db.fetch_job_depth() == 4
+
+
+def test_claim_ignores_unknown_kinds(db):
+    enqueue(db, "other")
+    assert db.claim_jobs("a", 30, BATCH_SIZES) == []
+    assert db.fetch_next_job_at(list(BATCH_SIZES)) is None
+
+
+def test_expired_lease_is_reclaimed(db):
+    job_id = enqueue(db)
+    (job,) = db.claim_jobs("a", -1, BATCH_SIZES)
+    # the lease already ran out, as if its server had died
+    assert db.fetch_next_job_at(list(BATCH_SIZES)) <= datetime.now().timestamp()
+    (job,) = db.claim_jobs("b", 30, BATCH_SIZES)
+    assert job.id == job_id
+    assert job.attempts == 2
+    assert job_row(db, job_id)["lease_owner"] == "b"
+    # the old owner lost it
+    db.complete_job(job_id, "a")
+    assert job_row(db, job_id)["state"] == JobState.RUNNING
+    assert db.fail_job(job_id, "a", "late", 1) is None
+    db.complete_job(job_id, "b")
+    assert job_row(db, job_id)["state"] == JobState.DONE
+
+
+def test_live_lease_is_not_reclaimed(db):
+    enqueue(db)
+    db.claim_jobs("a", 30, BATCH_SIZES)
+    assert db.claim_jobs("b", 30, BATCH_SIZES) == []
+    assert db.fetch_next_job_at(list(BATCH_SIZES)) > datetime.now().timestamp() + 20
+
+
+def test_expired_lease_out_of_attempts_fails(db):
+    job_id = enqueue(db, max_attempts=1)
+    db.claim_jobs("a", -1, BATCH_SIZES)
+    assert db.claim_jobs("b", 30, BATCH_SIZES) == []
+    row = job_row(db, job_id)
+    assert row["state"] == JobState.FAILED
+    assert row["error"] == "lease expired"
+    assert db.fetch_job_depth() == 0
+
+
+def test_fail_job_backs_off_then_gives_up(db):
+    job_id = enqueue(db, max_attempts=3)
+    db.claim_jobs("a", 30, BATCH_SIZES)
+    before = datetime.now().timestamp()
+    assert db.fail_job(job_id, "a", "boom", 10) == JobState.QUEUED
+    row = job_row(db, job_id)
+    assert row["error"] == "boom"
+    assert row["lease_owner"] is None
+    assert before + 10 <= row["available_at"] <= before + 11
+    # not ready until the backoff runs out
+    assert db.claim_jobs("a", 30, BATCH_SIZES) == []
+    assert db.fetch_next_job_at(list(BATCH_SIZES)) == row["available_at"]
+
+    make_ready(db, job_id)
+    (job,) = db.claim_jobs("a", 30, BATCH_SIZES)
+    assert job.attempts == 2
+    before = datetime.now().timestamp()
+    assert db.fail_job(job_id, "a", "boom", 10) == JobState.QUEUED
+    # doubled for the second attempt
+    assert before + 20 <= job_row(db, job_id)["available_at"] <= before + 21
+
+    make_ready(db, job_id)
+    (job,) = db.claim_jobs("a", 30, BATCH_SIZES)
+    assert job.attempts == 3
+    assert db.fail_job(job_id, "a", "boom", 10) == JobState.FAILED
+    make_ready(db, job_id)
+    assert db.claim_jobs("a", 30, BATCH_SIZES) == []
+    assert db.fetch_job_counts() == {"failed": 1}
+
+
+def test_admission():
+    assert admission(0, 0, 2, 4) is None
+    assert admission(2, 0, 2, 4) == 429
+    assert admission(2, 1, 2, 4) is None
+    assert admission(4, 1, 2, 4) == 503
+
+
+class CountingDb(AsyncDb):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.claims = 0
+
+    async def claim_jobs(self, *args, **kwargs):
+        self.claims += 1
+        return await super().claim_jobs(*args, **kwargs)
+
+
+def test_dispatcher_sleeps_while_idle_and_wakes_on_notify(db_url):
+    async def run():
+        pool = ConnectionPool(db_url)
+        adb = CountingDb(pool)
+        done = asyncio.Queue()
+        runs = []
+
+        async def run_detection(jobs):
+            runs.append([job.id for job in jobs])
+            return ["ok" for _ in jobs]
+
+        dispatcher = JobDispatcher(
+            adb,
+            {"detection": JobRunner(run_detection, 2, 1)},
+            lambda job, outcome, state: done.put_nowait((job.id, outcome, state)),
+            slots=2,
+            lease=30,
+            retry_delay=1,
+            batch_wait=0,
+            retention=60,
+        )
+        dispatcher.start()
+        try:
+            await asyncio.sleep(0.2)
+            # an empty queue is only read, never written to
+            assert adb.claims == 0
+            writer = Db(db_url)
+            job_id = enqueue(writer)
+            writer.close()
+            dispatcher.notify()
+            assert await asyncio.wait_for(done.get(), 5) == (
+                job_id,
+                "ok",
+                JobState.DONE,
+            )
+            assert runs == [[job_id]]
+        finally:
+            await dispatcher.stop()
+            adb.close()
+            pool.close()
+
+    asyncio.run(run())
+
+
+def test_dispatcher_retries_after_backoff(db_url):
+    async def run():
+        pool = ConnectionPool(db_url)
+        adb = AsyncDb(pool)
+        done = asyncio.Queue()
+        attempts = []
+
+        async def run_detection(jobs):
+            attempts.append(jobs[0].attempts)
+            if jobs[0].attempts == 1:
+                return [Exception("first try")]
+            return ["ok"]
+
+        dispatcher = JobDispatcher(
+            adb,
+            {"detection": JobRunner(run_detection)},
+            lambda job, outcome, state: done.put_nowait(state),
+            slots=1,
+            lease=30,
+            retry_delay=0.1,
+            batch_wait=0,
+            retention=60,
+        )
+        writer = Db(db_url)
+        enqueue(writer)
+        writer.close()
+        dispatcher.start()
+        try:
+            assert await asyncio.wait_for(done.get(), 5) == JobState.QUEUED
+            # claimed again once the backoff runs out
+            assert await asyncio.wait_for(done.get(), 5) == JobState.DONE
+            assert attempts == [1, 2]
+        finally:
+            await dispatcher.stop()
+            adb.close()
+            pool.close()
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize(
+    ("depth", "kind", "status"),
+    [
+        (1, "similarity", None),
+        (2, "similarity", 429),
+        (2, "detection", None),
+        (4, "detection", 503),
+    ],
+)
+def test_overloaded_response(db_url, depth, kind, status):
+    async def run():
+        pool = ConnectionPool(db_url)
+        app.db = AsyncDb(pool)
+        app.dispatcher = JobDispatcher(
+            app.db,
+            {"detection": JobRunner(None, 1, 1), "similarity": JobRunner(None)},
+            None,
+            slots=2,
+            lease=30,
+            retry_delay=1,
+            batch_wait=0,
+            retention=60,
+        )
+        app.dispatcher.job_duration = 3.0
+        app.config["JOB_QUEUE_SOFT_LIMIT"] = 2
+        app.config["JOB_QUEUE_LIMIT"] = 4
+        db = Db(db_url)
+        for _ in range(depth):
+            enqueue(db)
+        db.close()
+        try:
+            async with app.app_context():
+                response = await overloaded(kind)
+        finally:
+            app.db.close()
+            app.db = None
+            app.dispatcher = None
+            pool.close()
+        if status is None:
+            assert response is None
+        else:
+            assert response.status_code == status
+            # depth jobs of 3s each across 2 slots
+            assert response.headers["Retry-After"] == str(-(-depth * 3 // 2))
+
+    asyncio.run(run())
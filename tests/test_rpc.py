@@ -0,0 +1,125 @@
+import asyncio
+import threading
+
+import pytest
+
+from drink_detector import rpc
+
+
+async def wait_for_workers(pool: rpc.WorkerPool, count: int) -> None:
+    async def wait():
+        async with pool.changed:
+            await pool.changed.wait_for(lambda: len(pool.workers) == count)
+
+    await asyncio.wait_for(wait(), 5)
+
+
+def test_calls_follow_load_and_dead_workers_are_dropped(tmp_path):
+    address = f"unix:{tmp_path / 'workers.sock'}"
+    # set to let a worker's running call finish
+    release = {"a": threading.Event(), "b": threading.Event()}
+
+    def runner(name: str):
+        def run(kind: str, params: object) -> object:
+            if params.get("wait"):
+                release[name].wait(5)
+            if params.get("fail"):
+                raise ValueError("bad job")
+            return {"worker": name, "kind": kind, "params": params}
+
+        return run
+
+    async def main():
+        pool = rpc.WorkerPool(address, ping_interval=0.1, ping_timeout=0.5)
+        await pool.start()
+        workers = [
+            asyncio.create_task(
+                rpc.run_worker(address, name, ["detection"], 1, runner(name))
+            )
+            for name in ["a", "b"]
+        ]
+        try:
+            await wait_for_workers(pool, 2)
+            assert sorted(worker.name for worker in pool.workers) == ["a", "b"]
+
+            # the first call keeps one worker busy, so the second goes to the other
+            first = asyncio.create_task(pool.call("detection", {"wait": True}, 5))
+            await asyncio.sleep(0.1)
+            busy = next(worker for worker in pool.workers if worker.running == 1)
+            second = await pool.call("detection", {"n": 2}, 5)
+            assert second["worker"] != busy.name
+            release[busy.name].set()
+            assert (await first)["worker"] == busy.name
+            assert sum(worker.completed for worker in pool.workers) == 2
+
+            with pytest.raises(rpc.RemoteError, match="bad job"):
+                await pool.call("detection", {"fail": True}, 5)
+            # nobody runs that kind, so it waits for a worker that never comes
+            with pytest.raises(rpc.NoWorkers):
+                await pool.call("similarity", {}, 0.1)
+
+            # a worker that stops answering fails its call and is dropped
+            (reader, writer) = await rpc.connect(address)
+            await rpc.send(
+                writer,
+                {
+                    "register": {
+                        "name": "silent",
+                        "kinds": ["similarity"],
+                        "capacity": 1,
+                    }
+                },
+            )
+            await wait_for_workers(pool, 3)
+            with pytest.raises(rpc.WorkerGone):
+                await pool.call("similarity", {}, 5)
+            await wait_for_workers(pool, 2)
+            assert "silent" not in [worker.name for worker in pool.workers]
+            writer.close()
+
+            # as is one that disconnects
+            workers[0].cancel()
+            await wait_for_workers(pool, 1)
+            assert (await pool.call("detection", {}, 5))["worker"] == "b"
+        finally:
+            for event in release.values():
+                event.set()
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            await pool.stop()
+
+    asyncio.run(main())
+
+
+def test_workers_need_the_token(tmp_path):
+    address = f"unix:{tmp_path / 'workers.sock'}"
+
+    async def main():
+        pool = rpc.WorkerPool(address, ping_interval=1, ping_timeout=1, token="secret")
+        await pool.start()
+        workers = [
+            asyncio.create_task(
+                rpc.run_worker(
+                    address, name, ["detection"], 1, lambda kind, params: None, token
+                )
+            )
+            for (name, token) in [("wrong", "guess"), ("right", "secret")]
+        ]
+        try:
+            await wait_for_workers(pool, 1)
+            await asyncio.sleep(0.2)
+            assert [worker.name for worker in pool.workers] == ["right"]
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            await pool.stop()
+
+    asyncio.run(main())
+
+
+def test_tcp_needs_a_token():
+    pool = rpc.WorkerPool("localhost:0", ping_interval=1, ping_timeout=1)
+    with pytest.raises(ValueError, match="token"):
+        asyncio.run(pool.start())
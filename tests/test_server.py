@@ -0,0 +1,121 @@
+import asyncio
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+import pytest
+
+from drink_detector.async_db import AsyncDb
+from drink_detector.db import CaptureCreatedBy, CaptureType, ConnectionPool, Db
+from drink_detector.server import MAX_PAGE_SIZE, app
+
+START = datetime(2024, 10, 1, 12, 0, 0)
+
+
+@pytest.fixture
+def db_url(tmp_path):
+    url = str(tmp_path / "drinks.db")
+    db = Db(url)
+    db.migrate()
+    for i in range(3):
+        at = START + timedelta(seconds=i)
+        (
+            db.unit_of_work()
+            .create_capture(uuid4(), "model", CaptureCreatedBy.REQUEST, at)
+            .complete({"labels": [], "scores": [], "boxes": []}, at)
+            .add_file(f"{i}.png", CaptureType.ORIG, at)
+            .commit()
+        )
+    db.close()
+    return url
+
+
+def get(db_url: str, path: str, stock_types: dict | None = None):
+    async def run():
+        pool = ConnectionPool(db_url)
+        app.db = AsyncDb(pool)
+        app.config["STOCK_TYPES_BY_QUERY"] = stock_types or {}
+        app.config["OTHER_COLOR"] = "chocolate"
+        try:
+            response = await app.test_client().get(path)
+            body = await response.get_json() if response.status_code == 200 else None
+            return (response.status_code, body)
+        finally:
+            app.db.close()
+            app.db = None
+            pool.close()
+
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("limit", ["0", "-1", "two"])
+def test_history_page_rejects_bad_limit(db_url, limit):
+    (status, _) = get(db_url, f"/history/page?limit={limit}")
+    assert status == 400
+
+
+def test_history_page_follows_cursor(db_url):
+    (status, body) = get(db_url, "/history/page?limit=2")
+    assert status == 200
+    assert len(body["captures"]) == 2
+    (status, body) = get(db_url, body["next_page"])
+    assert status == 200
+    assert len(body["captures"]) == 1
+    assert body["next_page"] is None
+
+
+def test_history_page_caps_limit(db_url):
+    (status, body) = get(db_url, f"/history/page?limit={MAX_PAGE_SIZE + 1}")
+    assert status == 200
+    assert len(body["captures"]) == 3
+
+
+def test_stock_history_series(db_url):
+    db = Db(db_url)
+    for seconds, labels in [(10, ["coke", "coke", "fanta"]), (70, ["coke"])]:
+        at = START + timedelta(seconds=seconds)
+        (
+            db.unit_of_work()
+            .create_capture(uuid4(), "model", CaptureCreatedBy.LOOP, at)
+            .complete(
+                {"labels": labels, "scores": [0.9] * len(labels), "boxes": []}, at
+            )
+            .commit()
+        )
+    db.close()
+    since = START.timestamp()
+    stock_types = {"coke": {"name": "Coca-Cola"}}
+
+    (status, body) = get(
+        db_url, f"/stock/history?since={since}&until={since + 120}", stock_types
+    )
+    assert status == 200
+    assert body["resolution"] == 60
+    assert body["names"] == {"coke": "Coca-Cola"}
+    (first, second) = body["points"]
+    assert first["bucket"] == since
+    # along with the three captures from the fixture that found nothing
+    assert first["samples"] == 4
+    assert first["counts"] == {
+        "coke": {"avg": 0.5, "max": 2, "last": 2},
+        "fanta": {"avg": 0.25, "max": 1, "last": 1},
+    }
+    assert second == {
+        "bucket": since + 60,
+        "samples": 1,
+        "counts": {"coke": {"avg": 1, "max": 1, "last": 1}},
+    }
+
+    # a week only fits in the series at hour resolution
+    (status, body) = get(db_url, f"/stock/history?range=week&until={since + 120}")
+    assert status == 200
+    assert body["resolution"] == 60 * 60
+    (point,) = body["points"]
+    assert point["samples"] == 5
+    # fanta wasn't seen in the latest capture
+    assert point["counts"] == {
+        "coke": {"avg": 0.6, "max": 2, "last": 1},
+        "fanta": {"avg": 0.2, "max": 1, "last": 0},
+    }
+
+    (status, _) = get(db_url, f"/stock/history?since={since}&until={since}")
+    assert status == 400
@@ -0,0 +1,31 @@
+import asyncio
+import os
+
+from PIL import Image
+
+from drink_detector.thumbnails import ThumbnailCache
+
+
+def save(path: str, color: str) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.new("RGB", (400, 200), color).save(path)
+
+
+def test_same_name_in_different_directories(tmp_path):
+    orig = str(tmp_path / "orig" / "2024-10-01T12:00:00.png")
+    anno = str(tmp_path / "anno" / "2024-10-01T12:00:00.png")
+    save(orig, "red")
+    save(anno, "blue")
+    cache = ThumbnailCache(str(tmp_path / "thumb"), [160, 320], 1024 * 1024)
+
+    async def run():
+        return (await cache.get(orig, 160), await cache.get(anno, 160))
+
+    (orig_thumb, anno_thumb) = asyncio.run(run())
+    assert orig_thumb != anno_thumb
+    with Image.open(orig_thumb) as image:
+        assert image.size == (160, 80)
+        assert image.getpixel((0, 0)) == (255, 0, 0)
+    with Image.open(anno_thumb) as image:
+        assert image.getpixel((0, 0)) == (0, 0, 255)
+    assert cache.stats()["count"] == 2
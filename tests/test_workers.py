@@ -0,0 +1,141 @@
+import asyncio
+import base64
+from datetime import datetime
+from uuid import uuid4
+
+import numpy as np
+import pytest
+
+from drink_detector.async_db import AsyncDb
+from drink_detector.db import CaptureCreatedBy, CaptureType, ConnectionPool, Db
+from drink_detector.embeddings import EmbeddingStore
+from drink_detector.tasks import drink_detection, similarity, workers
+
+CONFIG = {
+    "IMG_FEAT_MODEL": "features",
+    "OBJ_DET_MODEL": "detector",
+    "EMBED_IMAGES": True,
+}
+
+
+def test_similarity_jobs_fail_one_at_a_time(monkeypatch):
+    def run_job(job, config):
+        if job["files"] == [[2, "2.png"]]:
+            raise FileNotFoundError("gone")
+        return {"embeddings": []}
+
+    monkeypatch.setattr(similarity, "run_job", run_job)
+    outcomes = workers.run_jobs(
+        "similarity",
+        [{"files": [[id, f"{id}.png"]]} for id in [1, 2, 3]],
+        {},
+    )
+    assert outcomes == [
+        {"result": {"embeddings": []}},
+        {"error": "FileNotFoundError('gone')"},
+        {"result": {"embeddings": []}},
+    ]
+
+
+@pytest.fixture
+def env(tmp_path):
+    """A server side database and embedding store, and a writer to queue jobs with"""
+    url = str(tmp_path / "drinks.db")
+    writer = Db(url)
+    writer.migrate()
+    pool = ConnectionPool(url)
+    db = AsyncDb(pool)
+    store = EmbeddingStore(str(tmp_path / "embeddings"), CONFIG["IMG_FEAT_MODEL"])
+    anno_dir = tmp_path / "anno"
+    anno_dir.mkdir()
+    yield (writer, db, store, {**CONFIG, "ANNO_DIR": str(anno_dir)})
+    db.close()
+    pool.close()
+    writer.close()
+
+
+def queue_job(writer: Db, kind: str, filenames: list[str], dt: datetime):
+    created_by = (
+        CaptureCreatedBy.SIMILARITY
+        if kind == "similarity"
+        else CaptureCreatedBy.REQUEST
+    )
+    uow = writer.unit_of_work().create_capture(uuid4(), "model", created_by, dt)
+    for filename in filenames:
+        uow.add_file(filename, CaptureType.ORIG, dt, f"hash of {filename}")
+    uow.enqueue(kind, {"dt": dt.timestamp()}, 0, 3).commit()
+    (job,) = writer.claim_jobs("a", 30, {kind: 1})
+    return job
+
+
+def test_similarity_results_are_saved_by_the_server(env):
+    (writer, db, store, config) = env
+    job = queue_job(writer, "similarity", ["a.png", "b.png"], datetime.now())
+    (a, b) = job.payload["file_ids"]
+    store.add([a], [[1.0, 0.0]])
+
+    async def run():
+        (prepared,) = await similarity.prepare_jobs(db, config, store, [job])
+        # only the image without a stored embedding goes to the worker
+        assert prepared == {"files": [[b, "b.png"]]}
+        matrix = await similarity.save_result(
+            db, config, store, job, {"embeddings": [[b, [1.0, 1.0]]]}
+        )
+        assert np.allclose(matrix, [[1.0, 0.7071], [0.7071, 1.0]], atol=1e-4)
+        # nothing left to embed once it's done
+        assert await similarity.prepare_jobs(db, config, store, [job]) == [None]
+        return matrix
+
+    matrix = asyncio.run(run())
+    assert store.get(b) is not None
+    result = writer.fetch_result(job.capture_id)
+    assert result == {"similarity": matrix, "file_ids": [a, b]}
+    key = similarity.similarity_key(["hash of a.png", "hash of b.png"])
+    assert (
+        writer.fetch_cached_result(key, "features", similarity.SIMILARITY_QUERY)
+        == result
+    )
+
+
+def test_detection_results_are_saved_by_the_server(env):
+    (writer, db, store, config) = env
+    dt = datetime(2024, 10, 1, 12)
+    job = queue_job(writer, "detection", ["upload.png"], dt)
+    (file_id,) = job.payload["file_ids"]
+    detection = {
+        "scores": [0.9],
+        "labels": ["coke"],
+        "boxes": [[0, 0, 1, 1]],
+        "image_size": [2, 2],
+    }
+
+    async def run():
+        (prepared,) = await drink_detection.prepare_jobs(db, config, store, [job])
+        assert prepared == {"filename": "upload.png", "embed": True}
+        await drink_detection.save_result(
+            db,
+            config,
+            store,
+            job,
+            {
+                "detection": detection,
+                "query": "coke.",
+                "anno": base64.b64encode(b"annotated").decode(),
+                "anno_ext": ".png",
+                "embedding": [0.0, 1.0],
+            },
+        )
+        # a job run again after its lease ran out has nothing left to do
+        assert await drink_detection.prepare_jobs(db, config, store, [job]) == [None]
+
+    asyncio.run(run())
+    assert writer.fetch_result(job.capture_id) == detection
+    assert (
+        writer.fetch_cached_result("hash of upload.png", "detector", "coke.")
+        == detection
+    )
+    anno = writer.fetch_image_for_capture(job.capture_id, CaptureType.ANNO, 0)
+    assert anno == f"{dt.timestamp()}.png"
+    with open(f"{config['ANNO_DIR']}/{anno}", "rb") as f:
+        assert f.read() == b"annotated"
+    assert store.get(file_id) is not None